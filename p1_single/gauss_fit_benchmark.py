@@ -0,0 +1,67 @@
+from p1_functions import *
+from scipy.stats import norm
+from scipy.optimize import curve_fit
+
+
+# Finds Gaussian fit of array by interpolating histogram onto 10000 points (how gauss_fit used to work)
+def gauss_fit_interp(array, bins, n):
+    b_est, c_est = norm.fit(array)      # Calculates mean & standard deviation based on entire array
+    range_min1 = b_est - c_est          # Calculates lower limit of Gaussian fit (1sigma estimation)
+    range_max1 = b_est + c_est          # Calculates upper limit of Gaussian fit (1sigma estimation)
+
+    bins_range1 = np.linspace(range_min1, range_max1, 10000)    # Creates array of bins between upper & lower limits
+    n_range1 = np.interp(bins_range1, bins, n)              # Interpolates & creates array of y axis values
+    guess1 = [1, float(b_est), float(c_est)]                # Defines guess for values of a, b & c in Gaussian fit
+    popt1, pcov1 = curve_fit(func, bins_range1, n_range1, p0=guess1, maxfev=10000)      # Finds Gaussian fit
+    mu1 = float(format(popt1[1], '.2e'))                        # Calculates mean based on 1sigma guess
+    sigma1 = np.abs(float(format(popt1[2], '.2e')))     # Calculates standard deviation based on 1sigma estimation
+    range_min2 = mu1 - 2 * sigma1                       # Calculates lower limit of Gaussian fit (2sigma)
+    range_max2 = mu1 + 2 * sigma1                       # Calculates upper limit of Gaussian fit (2sigma)
+    bins_range2 = np.linspace(range_min2, range_max2, 10000)    # Creates array of bins between upper & lower limits
+    n_range2 = np.interp(bins_range2, bins, n)          # Interpolates & creates array of y axis values
+    guess2 = [1, mu1, sigma1]                           # Defines guess for values of a, b & c in Gaussian fit
+    popt2, pcov2 = curve_fit(func, bins_range2, n_range2, p0=guess2, maxfev=10000)      # Finds Gaussian fit
+
+    return bins_range2, popt2, pcov2
+
+
+# Finds bin centers & counts of histogram the same way plot_histogram does
+def hist_bins(array, nbins):
+    n, bins = np.histogram(array, nbins)
+    bins_diff = bins[1] - bins[0]
+    bins = bins[:-1] + bins_diff / 2
+    return bins, n
+
+
+# Times interpolated & binned Gaussian fits of an array and prints mean & standard deviation from each
+def benchmark(array, nbins, name, nrep):
+    bins, n = hist_bins(array, nbins)
+    for fit_name, fit in [('interpolated', gauss_fit_interp), ('binned', gauss_fit)]:
+        start_time = time.time()
+        for j in range(nrep):
+            bins_range, popt, pcov = fit(array, bins, n)
+        fit_time = (time.time() - start_time) / nrep
+        errors = np.sqrt(np.abs(np.diag(pcov)))
+        print('%s (%s): mean %.4e +/- %.1e, SD %.4e +/- %.1e, %.2f ms per fit' %
+              (name, fit_name, popt[1], errors[1], np.abs(popt[2]), errors[2], fit_time * 1e3))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog="gauss_fit_benchmark", description="Compares Gaussian fits of histograms")
+    parser.add_argument("--hist_file", type=str, help='hist_data file to fit (default=simulated spe charges)')
+    parser.add_argument("--nbins", type=int, help='number of bins (default=100)', default=100)
+    parser.add_argument("--nrep", type=int, help='number of times to repeat each fit (default=10)', default=10)
+    args = parser.parse_args()
+
+    if args.hist_file:
+        hist_array = np.loadtxt(args.hist_file)
+        benchmark(hist_array, args.nbins, Path(args.hist_file).name, args.nrep)
+    else:
+        # Simulated charges: Gaussian spe peak with 10% of values in a wide tail
+        np.random.seed(0)
+        for size in [1000, 10000, 100000]:
+            sim_array = np.concatenate((np.random.normal(1.6e-12, 4e-13, int(0.9 * size)),
+                                        np.random.uniform(0, 8e-12, int(0.1 * size))))
+            benchmark(sim_array, args.nbins, 'simulated (%d values, mean 1.6000e-12, SD 4.0000e-13)' % size,
+                      args.nrep)
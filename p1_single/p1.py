@@ -2,7 +2,7 @@ from p1_functions import *
 
 
 def p1(start, end, date, date_time, filter_band, nhdr, fsps, fc, numtaps, baseline, r, pmt_hv, gain, offset, trig_delay,
-       amp, band, nfilter):
+       amp, band, nfilter, nworkers=1, dpi=360, no_plots=False):
     gen_path, save_sort, data_sort, dest_path, data_shift, save_shift = initialize_folders(date, filter_band)
     make_folders(dest_path, data_shift, save_shift)
 
@@ -13,28 +13,135 @@ def p1(start, end, date, date_time, filter_band, nhdr, fsps, fc, numtaps, baseli
 
     # Shifts spes so that when t = 0, v = 50% max and baseline = 0
     print('Shifting waveforms...')
+    shift_nums = []
     for i in range(start, end + 1):
         if os.path.isfile(Path(str((data_shift / 'D1--waveforms--%05d.txt')) % i)):
-            shift_waveform(i, nhdr, data_shift, save_shift)
+            shift_nums.append(i)
+        if len(shift_nums) == 500 or (i == end and len(shift_nums) > 0):    # Shifts waveforms in blocks of 500
+            shift_waveforms(shift_nums, nhdr, data_shift, save_shift)
+            shift_nums = []
 
     # Creates arrays of beginning & end times of spe waveform, time of end of spe, charge, amplitude, fwhm, 10-90 &
     # 20-80 rise times, 10-90 & 20-80 fall times, and 10%, 20%, 80% & 90% jitter
     t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, \
         fall2080_array, time10_array, time20_array, time80_array, time90_array = make_arrays(save_shift, dest_path,
-                                                                                             data_sort, start, end,
-                                                                                             nhdr, r)
+                                                                                             start, end, nhdr, r)
 
     # Plots histograms of charge, amplitude, FWHM, 10-90 & 20-80 rise times, 10-90 & 20-80 fall times, and 10%, 20%, 80%
     # & 90% jitter
     p1_hist(charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array,
-            time10_array, time20_array, time80_array, time90_array, dest_path, 100, 'd1')
+            time10_array, time20_array, time80_array, time90_array, dest_path, 100, 'd1', nworkers)
 
     # Plots and saves average waveform
-    average_waveform(start, end, dest_path, save_shift, 'd1', nhdr)
+    average_waveform(start, end, dest_path, save_shift, 'd1', nhdr, nworkers)
 
     # Creates d1 info file
     info_file(date_time, data_sort, dest_path, pmt_hv, gain, offset, trig_delay, amp, fsps, band, nfilter, r)
 
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
+
+
+# Watches d0 folder while data is being acquired and sorts, shifts, and does calculations on each waveform file once it
+# has been completely written
+def p1_follow(date, date_time, filter_band, nhdr, fsps, fc, numtaps, baseline, r, pmt_hv, gain, offset, trig_delay,
+              amp, band, nfilter, poll, batch, hist_every, idle_exit, nworkers=1, dpi=360, no_plots=False):
+    gen_path, save_sort, data_sort, dest_path, data_shift, save_shift = initialize_folders(date, filter_band)
+    make_folders(dest_path, data_shift, save_shift)
+    info_file(date_time, data_sort, dest_path, pmt_hv, gain, offset, trig_delay, amp, fsps, band, nfilter, r)
+
+    arrays = initialize_arrays()
+    sizes = {}              # File sizes from last check of d0 folder
+    seen = set()            # File numbers that have been found
+    queue = []              # File numbers waiting to be processed
+    n_hist = 0              # Number of spes when histograms were last made
+    hist_accs = None        # Histogram accumulators, made once there are enough spes to choose bin edges
+    last_new = time.time()
+
+    print('Watching ' + str(data_sort) + ' for new waveforms...')
+    try:
+        while True:
+            new_files = find_new_files(data_sort, sizes, seen)
+            if len(new_files) > 0:
+                queue.extend(new_files)
+                last_new = time.time()
+            if len(queue) == 0:
+                if 0 < idle_exit < time.time() - last_new:
+                    break
+                time.sleep(poll)
+                continue
+
+            # Only processes up to batch files at a time so that file list is checked again during bursts
+            file_nums = queue[:batch]
+            queue = queue[batch:]
+            print('Processing files #%05d-#%05d (%d files waiting)' % (file_nums[0], file_nums[-1], len(queue)))
+
+            for i in file_nums:
+                p1_sort(i, nhdr, fsps, fc, numtaps, data_sort, save_sort, baseline, interactive=False)
+            shift_nums = [i for i in file_nums if os.path.isfile(Path(str((data_shift / 'D1--waveforms--%05d.txt'))
+                                                                          % i))]
+            if len(shift_nums) > 0:
+                shift_waveforms(shift_nums, nhdr, data_shift, save_shift)
+            new_arrays = make_arrays_list(save_shift, dest_path, shift_nums, nhdr, r)
+            arrays = [np.concatenate((array, new_array)) for array, new_array in zip(arrays, new_arrays)]
+
+            # Bin edges are fixed from first 100 spes (with room on each side), then each batch is added to histograms
+            n_spe = len(arrays[2])
+            if hist_accs is None and n_spe >= 100:
+                hist_accs = [init_hist_accumulator(hist_edges(array, 100, 0.5)) for array in arrays[2:]]
+                new_arrays = arrays
+            if hist_accs is not None:
+                for accumulator, new_array in zip(hist_accs, new_arrays[2:]):
+                    update_hist_accumulator(accumulator, new_array)
+
+            # Updates histograms every hist_every spes, or once all waiting files are done
+            if n_spe >= 100 and (n_spe - n_hist >= hist_every or (len(queue) == 0 and n_spe > n_hist)):
+                update_hist(hist_accs, dest_path)
+                n_hist = n_spe
+                if no_plots:
+                    clear_plots()
+                else:
+                    render_plots(dpi, nworkers)
+    except KeyboardInterrupt:
+        print('Stopping...')
+
+    # Histograms of all spes are remade with bins fitted to final arrays
+    if len(arrays[2]) >= 100:
+        final_hist(arrays, dest_path, nworkers)
+    if len(seen) > 0:
+        average_waveform(min(seen), max(seen), dest_path, save_shift, 'd1', nhdr, nworkers)
+
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
+
+
+# Saves and plots histograms of charge, amplitude, FWHM, 10-90 & 20-80 rise times, 10-90 & 20-80 fall times, and 10%,
+# 20%, 80% & 90% jitter from histogram accumulators so far
+def update_hist(hist_accs, dest_path):
+    try:
+        p1_hist_accumulators(hist_accs, dest_path, 'd1')
+    except (RuntimeError, ValueError) as e:             # Gaussian fit can fail with few spes
+        print('Could not update histograms: ' + str(e))
+
+
+# Plots histograms of charge, amplitude, FWHM, 10-90 & 20-80 rise times, 10-90 & 20-80 fall times, and 10%, 20%, 80% &
+# 90% jitter from all arrays
+def final_hist(arrays, dest_path, nworkers=1):
+    t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, \
+        fall2080_array, time10_array, time20_array, time80_array, time90_array = arrays
+    try:
+        p1_hist(charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array,
+                fall2080_array, time10_array, time20_array, time80_array, time90_array, dest_path, 100, 'd1',
+                nworkers)
+    except (RuntimeError, ValueError) as e:             # Gaussian fit can fail with few spes
+        print('Could not update histograms: ' + str(e))
+
 
 if __name__ == '__main__':
     import argparse
@@ -58,6 +165,18 @@ if __name__ == '__main__':
     parser.add_argument("--band", type=str, help='bandwidth of oscilloscope (Hz)')
     parser.add_argument("--nfilter", type=float, help='noise filter on oscilloscope (bits)')
     parser.add_argument("--info_file", type=str, help='path to d0 info file')
+    parser.add_argument("--follow", action='store_true', help='watch d0 folder and process files as they are written')
+    parser.add_argument("--poll", type=float, help='seconds between checks of d0 folder (default=1.)', default=1.)
+    parser.add_argument("--batch", type=int, help='max number of files to process at a time (default=500)',
+                        default=500)
+    parser.add_argument("--hist_every", type=int, help='number of spes between histogram updates (default=1000)',
+                        default=1000)
+    parser.add_argument("--idle_exit", type=float, help='stop following after this many seconds with no new files '
+                                                        '(default=0, never)', default=0.)
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for fitting histograms & averaging waveforms '
+                                                  '(default=1)', default=1)
     args = parser.parse_args()
 
     if not args.info_file:
@@ -65,15 +184,27 @@ if __name__ == '__main__':
                 args.gain or args.offset or args.trig_delay or args.amp or args.band or args.nfilter):
             print('Error: Must provide an info file or all other arguments')
         else:
-            p1(args.start, args.end, args.date, args.date_time, args.fil_band, args.nhdr, args.fsps, args.fc,
-               args.numtaps, args.baseline, args.r, args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp,
-               args.band, args.nfilter)
+            if args.follow:
+                p1_follow(args.date, args.date_time, args.fil_band, args.nhdr, args.fsps, args.fc, args.numtaps,
+                          args.baseline, args.r, args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp,
+                          args.band, args.nfilter, args.poll, args.batch, args.hist_every, args.idle_exit,
+                          args.cores, args.dpi, args.no_plots)
+            else:
+                p1(args.start, args.end, args.date, args.date_time, args.fil_band, args.nhdr, args.fsps, args.fc,
+                   args.numtaps, args.baseline, args.r, args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp,
+                   args.band, args.nfilter, args.cores, args.dpi, args.no_plots)
     else:
         myfile = open(args.info_file, 'r')
         i_date, i_date_time, i_fil_band, i_nhdr, i_fsps, i_baseline, i_r, i_pmt_hv, i_gain, i_offset, i_trig_delay, \
             i_amp, i_band, i_nfilter = read_info(myfile)
 
-        p1(args.start, args.end, i_date, i_date_time, i_fil_band, i_nhdr, i_fsps, args.fc, args.numtaps,
-           i_baseline, i_r, i_pmt_hv, i_gain, i_offset, i_trig_delay, i_amp, i_band, i_nfilter)
+        if args.follow:
+            p1_follow(i_date, i_date_time, i_fil_band, i_nhdr, i_fsps, args.fc, args.numtaps, i_baseline, i_r,
+                      i_pmt_hv, i_gain, i_offset, i_trig_delay, i_amp, i_band, i_nfilter, args.poll, args.batch,
+                      args.hist_every, args.idle_exit, args.cores, args.dpi, args.no_plots)
+        else:
+            p1(args.start, args.end, i_date, i_date_time, i_fil_band, i_nhdr, i_fsps, args.fc, args.numtaps,
+               i_baseline, i_r, i_pmt_hv, i_gain, i_offset, i_trig_delay, i_amp, i_band, i_nfilter, args.cores,
+               args.dpi, args.no_plots)
 
         myfile.close()
\ No newline at end of file
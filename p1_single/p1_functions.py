@@ -1,12 +1,12 @@
 import os
+import re
 import csv
+import time
+import hashlib
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
-from scipy.optimize import curve_fit
-from scipy.stats import norm
-from scipy import signal
+from multiprocessing import Pool
 
 # FILE READING/WRITING
 
@@ -163,11 +163,48 @@ def read_info(myfile):
         i_amp, i_band, i_nfilter
 
 
+# LEDGER
+
+
+# Reads ledger of waveform labels
+# Returns dictionary of waveform id: (status, reason, stage)
+def read_ledger(dest_path):
+    ledger = {}
+    file_name = Path(dest_path) / 'ledger.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):          # Later labels of a waveform replace earlier ones
+            ledger[row[0]] = (row[1], row[2], row[3])
+        myfile.close()
+
+    return ledger
+
+
+# Labels a waveform in ledger and adds label to ledger file
+def label_waveform(dest_path, ledger, waveform_id, status, reason, stage):
+    ledger[str(waveform_id)] = (status, reason, stage)
+    myfile = open(Path(dest_path) / 'ledger.txt', 'a')
+    myfile.write('%s,%s,%s,%s\n' % (waveform_id, status, reason, stage))
+    myfile.close()
+
+
+# Checks if a waveform has been rejected
+def check_rejected(ledger, waveform_id):
+    if str(waveform_id) in ledger and ledger[str(waveform_id)][0] == 'rejected':
+        return 'yes'
+    else:
+        return 'no'
+
+
 # SORT/SHIFT WAVEFORMS
 
 
 # Separates files into spe, non-spe, and maybe spe
-def p1_sort(file_num, nhdr, fsps, fc, numtaps, data_path, save_path, baseline):
+# If interactive is False, waveforms that cannot be sorted automatically are put into unsure_if_spe instead of being
+# shown to user
+def p1_sort(file_num, nhdr, fsps, fc, numtaps, data_path, save_path, baseline, interactive=True):
+    import matplotlib.pyplot as plt
+    from scipy import signal
     wc = 2. * np.pi * fc / fsps     # Discrete radial frequency
     lowpass = signal.firwin(numtaps, cutoff=wc/np.pi, window='blackman')    # Blackman windowed lowpass filter
 
@@ -212,6 +249,11 @@ def p1_sort(file_num, nhdr, fsps, fc, numtaps, data_path, save_path, baseline):
             ww(t2, v2, spe_name, hdr)           # Writes filtered waveform to file
             print("Length of /d1_raw/:", len(os.listdir(str(save_path / 'd1/d1_raw/'))))
 
+        # Otherwise, if not interactive, waveform is put into unsure_if_spe
+        elif not interactive:
+            ww(t2, v2, spe_unsure, hdr)         # Writes filtered waveform to file
+            print('File #%05d is unsure if spe' % file_num)
+
         # Otherwise, plots waveform for user to sort manually
         else:
             plt.figure()
@@ -241,28 +283,157 @@ def p1_sort(file_num, nhdr, fsps, fc, numtaps, data_path, save_path, baseline):
     return
 
 
-# Shifts spes so that baseline = 0 and when t = 0, v = 50% max
-def shift_waveform(file_num, nhdr, data_path, save_path):
-    file_name = 'D1--waveforms--%05d.txt' % file_num
+# Returns average baseline of each waveform in a block of waveforms (one waveform per row), using the same regions as
+# calculate_average (5% of the way into the waveform until 10% before the spe & 10% after the spe until 95% of the way
+# into the waveform)
+def calculate_baselines(v_block):
+    v_block = np.atleast_2d(v_block)
+    n_rows, length = v_block.shape
+    rows = np.arange(n_rows)
+
+    v_min = np.min(v_block, axis=1)
+    below = v_block <= 0.1 * v_min[:, None]                 # Points past 10% of min
+    idx1 = np.argmax(below, axis=1)                         # Index of beginning of spe
+    idx3 = length - 1 - np.argmax(below[:, ::-1], axis=1)   # Index of end of spe
+    idx_min = np.argmin(v_block, axis=1)                    # Index of minimum voltage
+
+    # Start & end indices of baseline regions before & after spe
+    start1 = np.full(n_rows, int(.05 * length))
+    end1 = np.trunc(idx1 - .1 * length).astype(int)
+    start2 = np.trunc(idx3 + .1 * length).astype(int)
+    end2 = np.full(n_rows, int(.95 * length))
+    start1, end1, start2, end2 = [np.clip(x, 0, length) for x in [start1, end1, start2, end2]]
+    end1 = np.maximum(end1, start1)
+    end2 = np.maximum(end2, start2)
+
+    v_cumsum = np.zeros((n_rows, length + 1))               # Cumulative sums give each region's sum in one lookup
+    np.cumsum(v_block, axis=1, out=v_cumsum[:, 1:])
+    v_sum = v_cumsum[rows, end1] - v_cumsum[rows, start1] + v_cumsum[rows, end2] - v_cumsum[rows, start2]
+    count = (end1 - start1) + (end2 - start2)
+
+    baseline = np.full(n_rows, np.inf)
+    # Waveforms with no end of spe after the minimum or no baseline points are given an infinite baseline
+    good = (count > 0) & (idx3 > idx_min)
+    baseline[good] = v_sum[good] / count[good]
+
+    return baseline
+
+
+# Returns time of 50% max on the falling edge of spe (interpolated between samples) and average baseline of each
+# waveform in a block of waveforms (one waveform per row)
+def calculate_shift(t_block, v_block):
+    t_block = np.atleast_2d(t_block)
+    v_block = np.atleast_2d(v_block)
+    n_rows, length = v_block.shape
+    rows = np.arange(n_rows)
+
+    baseline = calculate_baselines(v_block)
+    v_block = v_block - np.where(np.isfinite(baseline), baseline, 0)[:, None]     # Subtracts baseline
+    idx_min = np.argmin(v_block, axis=1)                    # Index of minimum voltage
+    half_max = v_block[rows, idx_min] / 2                   # 50% max
+
+    # Finds falling edge crossings of 50% max (v[i] above 50% max & v[i + 1] at or below it) before minimum voltage
+    crossing = (v_block[:, :-1] > half_max[:, None]) & (v_block[:, 1:] <= half_max[:, None]) & \
+        (np.arange(1, length)[None, :] <= idx_min[:, None])
+    found = np.any(crossing, axis=1)
+    idx = length - 2 - np.argmax(crossing[:, ::-1], axis=1)     # Index of last crossing before minimum voltage
+
+    # Linear interpolation between the points on either side of 50% max
+    v_a = v_block[rows, idx]
+    v_b = v_block[rows, idx + 1]
+    t_a = t_block[rows % t_block.shape[0], idx]
+    t_b = t_block[rows % t_block.shape[0], idx + 1]
+    frac = (v_a - half_max) / np.where(found, v_a - v_b, 1)
+    half_max_time = np.where(found, t_a + frac * (t_b - t_a), np.nan)
+
+    return half_max_time, baseline
+
+
+# Adds shift of a waveform (time of 50% max & baseline) to shift metadata file
+def save_shift(dest_path, file_num, half_max_time, baseline):
+    myfile = open(Path(dest_path) / 'shifts.txt', 'a')
+    myfile.write('%05d,%.10E,%.10E\n' % (file_num, half_max_time, baseline))
+    myfile.close()
 
-    if os.path.isfile(data_path / file_name):
-        if os.path.isfile(save_path / file_name):           # If file has already been shifted, does nothing
-            pass
-        else:
+
+# Reads shift metadata file
+# Returns dictionary of file number: (time of 50% max, baseline)
+def read_shifts(dest_path):
+    shifts = {}
+    file_name = Path(dest_path) / 'shifts.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):
+            shifts[int(row[0])] = (float(row[1]), float(row[2]))
+        myfile.close()
+
+    return shifts
+
+
+# Shifts a block of spes so that baseline = 0 and when t = 0, v = 50% max
+# Exact (interpolated) time of 50% max & baseline are saved as metadata, and shifted files are written with t = 0 on the
+# sample nearest to 50% max so that later stages can find it by index
+def shift_waveforms(file_nums, nhdr, data_path, save_path):
+    dest_path = Path(save_path).parent
+    waveforms = {}
+
+    for file_num in file_nums:
+        file_name = 'D1--waveforms--%05d.txt' % file_num
+        if os.path.isfile(data_path / file_name) and not os.path.isfile(save_path / file_name):
             t, v, hdr = rw(data_path / file_name, nhdr)     # Reads waveform file
-            half_max = min(v) / 2                           # Calculates 50% max
-            differential = np.diff(v)                       # Calculates derivative of every point in voltage array
-            difference_value = np.abs(v - half_max)    # Finds difference between every point in voltage array & 50% max
-            for i in range(0, len(differential)):       # Sets every value in difference_value array with a positive
-                if differential[i] > 0:                 # derivative equal to infinity
-                    difference_value[i] = np.inf
-            index = np.argmin(difference_value)  # Finds index of closest voltage to 50% max with a negative derivative
-            half_max_time = t[index]                # Finds time at 50% max
-            t2 = t - half_max_time                  # Subtracts time of 50% max from time array
-            avg = calculate_average(t, v)           # Calculates average baseline
-            v2 = v - avg                            # Subtracts average baseline voltage from voltage array
-            ww(t2, v2, save_path / file_name, hdr)          # Writes shifted waveform to file
-            print('Length of /d1_shifted/:', len(os.listdir(str(save_path))))
+            waveforms[file_num] = (t, v, hdr)
+
+    # Waveforms of the same length are shifted together as one block
+    lengths = sorted(set(len(waveforms[file_num][0]) for file_num in waveforms))
+    for length in lengths:
+        block_nums = [file_num for file_num in waveforms if len(waveforms[file_num][0]) == length]
+        t_block = np.array([waveforms[file_num][0] for file_num in block_nums])
+        v_block = np.array([waveforms[file_num][1] for file_num in block_nums])
+        half_max_times, baselines = calculate_shift(t_block, v_block)
+
+        for j in range(len(block_nums)):
+            file_num = block_nums[j]
+            t, v, hdr = waveforms[file_num]
+            # If no 50% max crossing or baseline is found, waveform is not shifted
+            if not (np.isfinite(half_max_times[j]) and np.isfinite(baselines[j])):
+                print('Could not shift file #%05d' % file_num)
+                continue
+            index = np.argmin(np.abs(t - half_max_times[j]))    # Finds index of point closest to 50% max
+            t2 = t - t[index]                       # Subtracts time of 50% max from time array
+            v2 = v - baselines[j]                   # Subtracts average baseline voltage from voltage array
+            ww(t2, v2, save_path / ('D1--waveforms--%05d.txt' % file_num), hdr)     # Writes shifted waveform to file
+            save_shift(dest_path, file_num, half_max_times[j], baselines[j])
+
+    print('Shifted', len(waveforms), 'files')
+
+
+# Shifts spe so that baseline = 0 and when t = 0, v = 50% max
+def shift_waveform(file_num, nhdr, data_path, save_path):
+    shift_waveforms([file_num], nhdr, data_path, save_path)
+
+
+# Finds waveform files in d0 folder that have been completely written (file size is the same as at the last check)
+# sizes holds file sizes from the last check and seen holds file numbers that have already been found
+# Returns sorted list of new file numbers
+def find_new_files(data_sort, sizes, seen):
+    new_files = []
+
+    for file_name in os.listdir(data_sort):
+        # Only files named as the scope writes them (C2--waveforms--%05d.txt) are processed, other names are skipped
+        match = re.match(r'C2--waveforms--(\d{5,})\.txt$', file_name)
+        if match is not None and file_name == 'C2--waveforms--%05d.txt' % int(match.group(1)):
+            i = int(match.group(1))
+            if i in seen:
+                continue
+            size = os.path.getsize(Path(data_sort) / file_name)
+            if size > 0 and sizes.get(i) == size:       # File is done being written if size has not changed
+                new_files.append(i)
+                seen.add(i)
+                del sizes[i]
+            else:
+                sizes[i] = size
+
+    return sorted(new_files)
 
 
 # CALCULATIONS
@@ -312,14 +483,14 @@ def calculate_average(t, v):
     t1, t2 = calculate_t1_t2(t, v)
 
     try:
-        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0] - (.1 * len(t)))):
+        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0][0] - (.1 * len(t)))):
             v_sum += v[i]
 
-        for i in range(int(np.where(t == t2)[0] + (.1 * len(t))), int(.95 * len(t))):
+        for i in range(int(np.where(t == t2)[0][0] + (.1 * len(t))), int(.95 * len(t))):
             v_sum += v[i]
 
-        average = v_sum / ((int(np.where(t == t1)[0] - (.1 * len(t))) - int(.05 * len(t))) +
-                        (int(.95 * len(t)) - int(np.where(t == t2)[0] + (.1 * len(t)))))
+        average = v_sum / ((int(np.where(t == t1)[0][0] - (.1 * len(t))) - int(.05 * len(t))) +
+                        (int(.95 * len(t)) - int(np.where(t == t2)[0][0] + (.1 * len(t)))))
 
         return average
 
@@ -543,14 +714,9 @@ def append_arrays(t1, t2, charge, amplitude, fwhm, rise1090, rise2080, fall1090,
         fall1090_array, fall2080_array, time10_array, time20_array, time80_array, time90_array
 
 
-# Removes spe waveform from all spe folders
-def remove_spe(path_1, path_2, path_3, number, nhdr):
-    t, v, hdr = rw(str(path_1 / 'C2--waveforms--%05d.txt') % number, nhdr)
-    ww(t, v, str(path_2 / 'not_spe' / 'D1--not_spe--%05d.txt') % number, hdr)
-    if os.path.isfile(str(path_3 / 'D1--waveforms--%05d.txt') % number):
-        os.remove(str(path_3 / 'D1--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(path_2 / 'calculations' / 'D1--waveforms--%05d.txt') % number):
-        os.remove(str(path_2 / 'calculations' / 'D1--waveforms--%05d.txt') % number)
+# Removes spe waveform from data set by labeling it as rejected in ledger
+def remove_spe(dest_path, ledger, number):
+    label_waveform(dest_path, ledger, '%05d' % number, 'rejected', 'impossible values', 'p1')
 
 
 # Calculates beginning & end times of spe waveform, charge, amplitude, fwhm, 10-90 & 20-80 rise times, 10-90 & 20-80
@@ -585,15 +751,15 @@ def read_calculations(filename):
 
 # Removes spe file if values are impossible, appends values to arrays if not, and creates calculations file if it does
 # not already exist
-def create_arrays(calc_file, path_1, path_2, path_3, number, t1_array, t2_array, charge_array, amplitude_array,
+def create_arrays(calc_file, dest_path, ledger, number, t1_array, t2_array, charge_array, amplitude_array,
                   fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, time10_array,
                   time20_array, time80_array, time90_array, t1, t2, charge, amplitude, fwhm, rise1090, rise2080,
-                  fall1090, fall2080, time10, time20, time80, time90, possibility, nhdr):
+                  fall1090, fall2080, time10, time20, time80, time90, possibility):
 
-    # Any spe waveform that returns impossible values is put into the not_spe folder
+    # Any spe waveform that returns impossible values is rejected
     if possibility == 'impossible':
         print('Removing file #%05d' % number)
-        remove_spe(path_1, path_2, path_3, number, nhdr)
+        remove_spe(dest_path, ledger, number)
 
     # All other spe waveforms' calculations are placed into arrays
     else:
@@ -604,8 +770,8 @@ def create_arrays(calc_file, path_1, path_2, path_3, number, t1_array, t2_array,
                           rise2080_array, fall1090_array, fall2080_array, time10_array, time20_array, time80_array,
                           time90_array)
         if not os.path.isfile(calc_file):
-            save_calculations(path_2, number, t1, t2, charge, amplitude, fwhm, rise1090, rise2080, fall1090, fall2080,
-                              time10, time20, time80, time90)
+            save_calculations(dest_path, number, t1, t2, charge, amplitude, fwhm, rise1090, rise2080, fall1090,
+                              fall2080, time10, time20, time80, time90)
 
     return t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, \
         fall1090_array, fall2080_array, time10_array, time20_array, time80_array, time90_array
@@ -615,15 +781,24 @@ def create_arrays(calc_file, path_1, path_2, path_3, number, t1_array, t2_array,
 # fall times, and 10%, 20%, 80% & 90% jitter for each spe file
 # Returns arrays of beginning & end times of spe waveform, charge, amplitude, fwhm, 10-90 & 20-80 rise times, 10-90 &
 # 20-80 fall times, and 10%, 20%, 80% & 90% jitter
-def make_arrays(save_shift, dest_path, data_sort, start, end, nhdr, r):
+def make_arrays(save_shift, dest_path, start, end, nhdr, r):
+    return make_arrays_list(save_shift, dest_path, range(start, end + 1), nhdr, r)
+
+
+# Calculates beginning & end times of spe waveform, charge, amplitude, fwhm, 10-90 & 20-80 rise times, 10-90 & 20-80
+# fall times, and 10%, 20%, 80% & 90% jitter for each spe file in a list of file numbers
+# Returns arrays of beginning & end times of spe waveform, charge, amplitude, fwhm, 10-90 & 20-80 rise times, 10-90 &
+# 20-80 fall times, and 10%, 20%, 80% & 90% jitter
+def make_arrays_list(save_shift, dest_path, numbers, nhdr, r):
     t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, \
         fall2080_array, time10_array, time20_array, time80_array, time90_array = initialize_arrays()
+    ledger = read_ledger(dest_path)
 
-    for i in range(start, end + 1):
+    for i in numbers:
         file_name1 = str(save_shift / 'D1--waveforms--%05d.txt') % i
         file_name2 = str(dest_path / 'calculations' / 'D1--waveforms--%05d.txt') % i
 
-        if os.path.isfile(file_name1):
+        if os.path.isfile(file_name1) and check_rejected(ledger, '%05d' % i) == 'no':
             # If the calculations were done previously, they are read from a file
             if os.path.isfile(file_name2):
                 print("Reading calculations from file #%05d" % i)
@@ -640,11 +815,10 @@ def make_arrays(save_shift, dest_path, data_sort, start, end, nhdr, r):
 
             t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, \
                 fall1090_array, fall2080_array, time10_array, time20_array, time80_array, time90_array = \
-                create_arrays(file_name2, data_sort, dest_path, save_shift, i, t1_array, t2_array, charge_array,
-                              amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array,
-                              fall2080_array, time10_array, time20_array, time80_array, time90_array, t1, t2, charge,
-                              amplitude, fwhm, rise1090, rise2080, fall1090, fall2080, time10, time20, time80, time90,
-                              possibility, nhdr)
+                create_arrays(file_name2, dest_path, ledger, i, t1_array, t2_array, charge_array, amplitude_array,
+                              fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, time10_array,
+                              time20_array, time80_array, time90_array, t1, t2, charge, amplitude, fwhm, rise1090,
+                              rise2080, fall1090, fall2080, time10, time20, time80, time90, possibility)
 
     return t1_array, t2_array, charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, \
         fall1090_array, fall2080_array, time10_array, time20_array, time80_array, time90_array
@@ -659,132 +833,636 @@ def func(x, a, b, c):
     return gauss
 
 
-# Finds Gaussian fit of array
+# Finds Gaussian fit of histogram (bin centers & counts) of array, starting from mean & standard deviation of array
 def gauss_fit(array, bins, n):
-    b_est, c_est = norm.fit(array)      # Calculates mean & standard deviation based on entire array
-    range_min1 = b_est - c_est          # Calculates lower limit of Gaussian fit (1sigma estimation)
-    range_max1 = b_est + c_est          # Calculates upper limit of Gaussian fit (1sigma estimation)
-
-    bins_range1 = np.linspace(range_min1, range_max1, 10000)    # Creates array of bins between upper & lower limits
-    n_range1 = np.interp(bins_range1, bins, n)              # Interpolates & creates array of y axis values
-    guess1 = [1, float(b_est), float(c_est)]                # Defines guess for values of a, b & c in Gaussian fit
-    popt1, pcov1 = curve_fit(func, bins_range1, n_range1, p0=guess1, maxfev=10000)      # Finds Gaussian fit
-    mu1 = float(format(popt1[1], '.2e'))                        # Calculates mean based on 1sigma guess
-    sigma1 = np.abs(float(format(popt1[2], '.2e')))     # Calculates standard deviation based on 1sigma estimation
-    range_min2 = mu1 - 2 * sigma1                       # Calculates lower limit of Gaussian fit (2sigma)
-    range_max2 = mu1 + 2 * sigma1                       # Calculates upper limit of Gaussian fit (2sigma)
-    bins_range2 = np.linspace(range_min2, range_max2, 10000)    # Creates array of bins between upper & lower limits
-    n_range2 = np.interp(bins_range2, bins, n)          # Interpolates & creates array of y axis values
-    guess2 = [1, mu1, sigma1]                           # Defines guess for values of a, b & c in Gaussian fit
-    popt2, pcov2 = curve_fit(func, bins_range2, n_range2, p0=guess2, maxfev=10000)      # Finds Gaussian fit
-
-    return bins_range2, popt2, pcov2
+    return gauss_fit_bins(bins, n, float(np.mean(array)), float(np.std(array)))
+
+
+# Finds Gaussian fit of histogram (bin centers & counts) by least squares on the bins, weighting each bin by its Poisson
+# error, first within 1 sigma of mean mu and then within 2 sigma of the last fit until fit stops changing
+# Uncertainties of fit parameters are square roots of diagonal of pcov
+# Raises RuntimeError if there are not enough bins to fit or the first fit does not converge
+def gauss_fit_bins(bins, n, mu, sigma):
+    from scipy.optimize import curve_fit
+    bins = np.asarray(bins, dtype=float)
+    n = np.asarray(n, dtype=float)
+    width = 1                                   # Fits within 1 sigma first (estimation), then 2 sigma
+    fitted = False
+
+    for j in range(10):
+        in_range = (bins >= mu - width * sigma) & (bins <= mu + width * sigma)
+        if np.count_nonzero(in_range) < 4:      # Not enough bins to fit
+            break
+        guess = [np.max(n[in_range]), mu, sigma]                # Defines guess for values of a, b & c
+        try:
+            popt, pcov = curve_fit(func, bins[in_range], n[in_range], p0=guess,
+                                   sigma=np.sqrt(np.maximum(n[in_range], 1)), absolute_sigma=True, maxfev=1000)
+        except RuntimeError:
+            break
+        fitted = True
+        popt[2] = np.abs(popt[2])
+        done = width == 2 and np.abs(popt[1] - mu) < 1e-3 * sigma and np.abs(popt[2] - sigma) < 1e-3 * sigma
+        mu = float(popt[1])
+        sigma = float(popt[2])
+        width = 2
+        if done:
+            break
+    if not fitted:
+        raise RuntimeError('Could not fit Gaussian to histogram (mean %.2e, SD %.2e)' % (mu, sigma))
+
+    bins_range = np.linspace(mu - 2 * sigma, mu + 2 * sigma, 1000)      # Creates array of x values within 2 sigma
+
+    return bins_range, popt, pcov
+
+
+# Histogram specifications for p1 calculations: (column of results table, x axis label, title, units)
+p1_hist_specs = [('charge', 'Charge', 'Charge', 'C'), ('amplitude', 'Voltage', 'Amplitude', 'V'),
+                 ('fwhm', 'Time', 'FWHM', 's'), ('rise1090', 'Time', '10-90 Rise Time', 's'),
+                 ('rise2080', 'Time', '20-80 Rise Time', 's'), ('fall1090', 'Time', '10-90 Fall Time', 's'),
+                 ('fall2080', 'Time', '20-80 Fall Time', 's'), ('time10', 'Time', '10% Jitter', 's'),
+                 ('time20', 'Time', '20% Jitter', 's'), ('time80', 'Time', '80% Jitter', 's'),
+                 ('time90', 'Time', '90% Jitter', 's')]
+
+
+# Bins array into histogram accumulator, finds Gaussian fit, and bootstraps mean, SD & fit (can run in worker process,
+# with resamples drawn from a random generator seeded from seed)
+def fit_histogram(array, nbins, nboot=1000, nfit=100, seed=None):
+    rng = np.random.default_rng(seed)
+    accumulator = init_hist_accumulator(hist_edges(array, nbins))
+    update_hist_accumulator(accumulator, array)
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit, rng)
+    means, sds = bootstrap_stats(array, nboot, rng=rng)
+    rows = bootstrap_rows(np.mean(array), np.std(array), means, sds, popt, params)
+
+    return accumulator, bins_range, popt, rows
+
+
+# Saves histogram data, histogram accumulator & bootstrap intervals of fitted histogram and queues its plot
+def save_histogram(array, result, dest_path, xaxis, title, units, filename):
+    accumulator, bins_range, popt, rows = result
+    write_hist_data(array, dest_path, filename + '.txt')
+    save_hist_accumulator(accumulator, Path(dest_path) / 'hist_data' / str(filename + '.npz'))
+    save_bootstrap(rows, Path(dest_path) / 'hist_data' / str(filename + '_bootstrap.txt'))
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
 
 
 # Creates histogram given an array
 def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename):
+    save_histogram(array, fit_histogram(array, nbins), dest_path, xaxis, title, units, filename)
+
+
+# Makes histograms of columns of results table (dict of arrays) given by specs ((column, file name, x axis label, title,
+# units, number of bins)), fitting them in nworkers processes, then saves them and writes one summary table
+def hist_batch(table, specs, dest_path, summary_name, nworkers=1):
+    seeds = np.random.SeedSequence().spawn(len(specs))      # Independent random streams of histograms
+    jobs = [(table[spec[0]], spec[5], 1000, 100, seed) for spec, seed in zip(specs, seeds)]
+    if nworkers > 1 and len(jobs) > 1:
+        pool = Pool(min(nworkers, len(jobs)))
+        results = pool.starmap(fit_histogram, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [fit_histogram(*job) for job in jobs]
 
-    path = Path(Path(dest_path) / 'plots')
-    n, bins, patches = plt.hist(array, nbins)           # Plots histogram
-    bins = np.delete(bins, len(bins) - 1)
-    bins_diff = bins[1] - bins[0]
-    bins = np.linspace(bins[0] + bins_diff / 2, bins[len(bins) - 1] + bins_diff / 2, len(bins))
+    summary = []
+    for (column, filename, xaxis, title, units, nbins), result in zip(specs, results):
+        save_histogram(table[column], result, dest_path, xaxis, title, units, filename)
+        summary.append((filename, result[0], result[3]))
+    write_hist_summary(summary, Path(dest_path) / 'hist_data' / summary_name)
+
+    return dict(zip([spec[1] for spec in specs], results))
 
-    bins_range, popt, pcov = gauss_fit(array, bins, n)                  # Finds Gaussian fit
-    plt.plot(bins_range, func(bins_range, *popt), color='red')          # Plots Gaussian fit (mean +/- 2sigma)
 
+# Plots histograms for each calculation array
+def p1_hist(charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array,
+            time10_array, time20_array, time80_array, time90_array, dest_path, bins, version, nworkers=1):
+    print('Creating histograms')
+    table = {'charge': charge_array, 'amplitude': amplitude_array, 'fwhm': fwhm_array, 'rise1090': rise1090_array,
+             'rise2080': rise2080_array, 'fall1090': fall1090_array, 'fall2080': fall2080_array,
+             'time10': time10_array, 'time20': time20_array, 'time80': time80_array, 'time90': time90_array}
+    specs = [(column, column + '_' + version, xaxis, title, units, bins) for column, xaxis, title, units in
+             p1_hist_specs]
+    hist_batch(table, specs, dest_path, 'hist_summary_' + version + '.txt', nworkers)
+
+
+# Saves and plots histogram accumulators of charge, amplitude, FWHM, 10-90 & 20-80 rise times, 10-90 & 20-80 fall times,
+# and 10%, 20%, 80% & 90% jitter (in the same order as arrays given to p1_hist)
+def p1_hist_accumulators(accumulators, dest_path, version):
+    print('Updating histograms')
+    for accumulator, (column, xaxis, title, units) in zip(accumulators, p1_hist_specs):
+        save_hist_accumulator(accumulator, Path(dest_path) / 'hist_data' / str(column + '_' + version + '.npz'))
+        plot_hist_accumulator(accumulator, dest_path, xaxis, title, units, column + '_' + version)
+
+
+# HISTOGRAM ACCUMULATOR
+
+
+# Finds fixed bin edges for histogram accumulator from calibration array: nbins bins between minimum & maximum of array
+# (same as np.histogram) plus bins of the same width covering margin (fraction of range) on each side for later values
+def hist_edges(array, nbins, margin=0.):
+    low = float(np.min(array))
+    high = float(np.max(array))
+    if low == high:
+        low = low - 0.5
+        high = high + 0.5
+    n_pad = int(np.ceil(margin * nbins))
+    width = (high - low) / nbins
+    edges = np.linspace(low - n_pad * width, high + n_pad * width, nbins + 2 * n_pad + 1)
+    return edges
+
+
+# Creates histogram accumulator with fixed bin edges that also keeps mean & variance of values (Welford's method)
+def init_hist_accumulator(edges):
+    accumulator = {'edges': np.asarray(edges, dtype=float), 'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+                   'under': 0, 'over': 0, 'n': 0, 'mean': 0., 'm2': 0.}
+    return accumulator
+
+
+# Adds a value or array of values to histogram accumulator (values outside bin edges are only counted as under/over)
+def update_hist_accumulator(accumulator, values):
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    n_b = len(values)
+    if n_b == 0:
+        return accumulator
+    edges = accumulator['edges']
+    accumulator['counts'] += np.histogram(values, edges)[0]
+    accumulator['under'] += int(np.count_nonzero(values < edges[0]))
+    accumulator['over'] += int(np.count_nonzero(values > edges[-1]))
+
+    # Combines mean & sum of squared differences of values with those of accumulator (Chan et al.)
+    mean_b = float(np.mean(values))
+    m2_b = float(np.sum((values - mean_b) ** 2))
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    return accumulator
+
+
+# Combines two histogram accumulators with the same bin edges (e.g. from different workers or runs) into a new one
+def merge_hist_accumulators(acc_a, acc_b):
+    if not np.array_equal(acc_a['edges'], acc_b['edges']):
+        raise ValueError('Histogram accumulators have different bin edges')
+    accumulator = init_hist_accumulator(acc_a['edges'])
+    accumulator['counts'] = acc_a['counts'] + acc_b['counts']
+    accumulator['under'] = acc_a['under'] + acc_b['under']
+    accumulator['over'] = acc_a['over'] + acc_b['over']
+    n = acc_a['n'] + acc_b['n']
+    if n > 0:
+        delta = acc_b['mean'] - acc_a['mean']
+        accumulator['n'] = n
+        accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+        accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+    return accumulator
+
+
+# Saves histogram accumulator to .npz file
+def save_hist_accumulator(accumulator, file_name):
+    np.savez(file_name, **accumulator)
+
+
+# Reads histogram accumulator from .npz file
+def load_hist_accumulator(file_name):
+    myfile = np.load(file_name)
+    accumulator = {'edges': myfile['edges'], 'counts': myfile['counts'], 'under': int(myfile['under']),
+                   'over': int(myfile['over']), 'n': int(myfile['n']), 'mean': float(myfile['mean']),
+                   'm2': float(myfile['m2'])}
+    myfile.close()
+    return accumulator
+
+
+# Returns mean & standard deviation of all values added to histogram accumulator
+def hist_accumulator_stats(accumulator):
+    if accumulator['n'] == 0:
+        return np.nan, np.nan
+    return accumulator['mean'], np.sqrt(accumulator['m2'] / accumulator['n'])
+
+
+# Finds Gaussian fit of histogram in accumulator (starting from mean & standard deviation of all values)
+def fit_hist_accumulator(accumulator):
+    edges = accumulator['edges']
+    bins = (edges[:-1] + edges[1:]) / 2                 # Bin centers
+    mu, sigma = hist_accumulator_stats(accumulator)
+    return gauss_fit_bins(bins, accumulator['counts'], mu, sigma)
+
+
+# Fits histogram in accumulator, bootstraps fit from nfit resampled histograms, and queues plot of histogram with
+# Gaussian fit, returns fit parameters & bootstrap rows
+def plot_hist_accumulator(accumulator, dest_path, xaxis, title, units, filename, nfit=100):
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit)
+    mean, sd = hist_accumulator_stats(accumulator)
+    rows = bootstrap_rows(mean, sd, np.array([]), np.array([]), popt, params)
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
+
+    return popt, rows
+
+
+# Returns ' +/- ' and half width of bootstrap confidence interval in row, or '' if there is no interval
+def error_text(row):
+    name, value, low, high = row
+    if np.isnan(low) or np.isnan(high):
+        return ''
+    return ' +/- ' + str(float(format((high - low) / 2, '.1e')))
+
+
+# Queues plot of histogram in accumulator with Gaussian fit (uncertainties are half widths of bootstrap intervals)
+def queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename):
+    path = Path(Path(dest_path) / 'plots')
     mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
     sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
 
-    # mu2 = np.mean(array)
-    # sigma2 = np.std(array)
+    # Queues histogram with Gaussian fit (mean +/- 2sigma) to be plotted
+    queue_plot('histogram', path / str(filename + '.png'),
+               {'arrays': [], 'counts': [(accumulator['edges'], accumulator['counts'])],
+                'fits': [(bins_range, popt, 'red')], 'xlabel': xaxis + ' (' + units + ')', 'fontsize': 'large',
+                'title': title + ' of SPE\n mean: ' + str(mu2) + error_text(rows[2]) + ' ' + units + ', SD: ' +
+                         str(sigma2) + error_text(rows[3]) + ' ' + units})
+
+
+# BOOTSTRAP
+
+
+# Resamples array with replacement nboot times, using matrices of random indices (at most max_size values at a time),
+# and returns mean & standard deviation of each resample (drawn with random generator rng, or a new one if rng is None)
+def bootstrap_stats(array, nboot=1000, max_size=10000000, rng=None):
+    rng = np.random.default_rng(rng)
+    array = np.asarray(array, dtype=float)
+    n = len(array)
+    center = np.mean(array)
+    array = array - center                      # Centered so that standard deviation does not lose precision
+    means = np.zeros(nboot)
+    sds = np.zeros(nboot)
+    chunk = max(1, min(nboot, max_size // max(n, 1)))
+
+    for j in range(0, nboot, chunk):
+        idx = rng.integers(0, n, (min(chunk, nboot - j), n))            # Each row is one resample
+        samples = array[idx]
+        means_j = np.mean(samples, axis=1)
+        means[j:j + len(idx)] = means_j + center
+        sds[j:j + len(idx)] = np.sqrt(np.maximum(np.mean(samples ** 2, axis=1) - means_j ** 2, 0))
+
+    return means, sds
+
+
+# Resamples histogram counts nboot times (multinomial, same as resampling the values in the histogram) and returns fit
+# parameters of Gaussian fit of each resampled histogram that could be fitted (one row per resample), starting each fit
+# from popt (resamples are drawn with random generator rng, or a new one if rng is None)
+def bootstrap_fit(bins, n, popt, nboot=100, rng=None):
+    n = np.asarray(n, dtype=float)
+    total = int(np.sum(n))
+    params = np.zeros((nboot, 3))
+    if total == 0 or nboot == 0:
+        return params[:0]
+    resamples = np.random.default_rng(rng).multinomial(total, n / total, size=nboot)
+
+    for j in range(nboot):
+        try:
+            bins_range, params[j], pcov = gauss_fit_bins(bins, resamples[j], popt[1], popt[2])
+            if not np.all(np.isfinite(pcov)):
+                params[j] = np.nan
+        except RuntimeError:
+            params[j] = np.nan
+
+    # Resamples that could not be fitted are dropped so they do not narrow confidence intervals
+    fitted = np.all(np.isfinite(params), axis=1)
+    if not np.all(fitted):
+        print('Dropped %d of %d bootstrap fits that could not be fitted' % (nboot - np.count_nonzero(fitted), nboot))
+
+    return params[fitted]
+
+
+# Returns lower & upper limits of central confidence interval (cl in %) of bootstrap values
+def confidence_interval(values, cl=68.27):
+    return np.percentile(values, 50 - cl / 2, axis=0), np.percentile(values, 50 + cl / 2, axis=0)
+
+
+# Returns rows of (name, value, lower limit, upper limit) of central confidence intervals (cl in %) of mean & standard
+# deviation of values (from bootstrap means & sds) and of mean & standard deviation of Gaussian fit (from params)
+def bootstrap_rows(mean, sd, means, sds, popt, params, cl=68.27):
+    values = [('mean', mean, means), ('sd', sd, sds), ('fit_mean', popt[1], params[:, 1]),
+              ('fit_sd', np.abs(popt[2]), np.abs(params[:, 2]))]
+    rows = []
+    for name, value, resampled in values:
+        if len(resampled) > 0:
+            low, high = confidence_interval(resampled, cl)
+        else:
+            low, high = np.nan, np.nan
+        rows.append((name, float(value), float(low), float(high)))
+    return rows
 
-    plt.xlabel(xaxis + ' (' + units + ')')
-    plt.title(title + ' of SPE\n mean: ' + str(mu2) + ' ' + units + ', SD: ' + str(sigma2) + ' ' + units)
-    plt.savefig(path / str(filename + '.png'), dpi=360)         # Plots histogram with Gaussian fit
 
-    write_hist_data(array, dest_path, filename + '.txt')
+# Saves bootstrap confidence intervals of a histogram
+def save_bootstrap(rows, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('name,value,low,high\n')
+    for name, value, low, high in rows:
+        myfile.write('%s,%s,%s,%s\n' % (name, str(value), str(low), str(high)))
+    myfile.close()
+
+
+# Writes table with number of values (in, below & above bins) and bootstrap confidence intervals of each histogram
+def write_hist_summary(summary, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('histogram,n,under,over')
+    for name in ['mean', 'sd', 'fit_mean', 'fit_sd']:
+        myfile.write(',%s,%s_low,%s_high' % (name, name, name))
+    myfile.write('\n')
+    for filename, accumulator, rows in summary:
+        myfile.write('%s,%d,%d,%d' % (filename, accumulator['n'], accumulator['under'], accumulator['over']))
+        for name, value, low, high in rows:
+            myfile.write(',%s,%s,%s' % (str(value), str(low), str(high)))
+        myfile.write('\n')
+    myfile.close()
+
+
+# PLOTTING
+
+
+plot_queue = []         # Plots waiting to be rendered by render_plots
+
 
+# Adds a plot to plot queue (kind is 'histogram' or 'waveform', and data holds what is needed to draw it)
+def queue_plot(kind, file_name, data):
+    plot_queue.append((kind, str(file_name), data))
+
+
+# Draws a queued plot with the non-interactive Agg backend and saves it
+def draw_plot(kind, file_name, data, dpi):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    if kind == 'histogram':
+        for array in data['arrays']:
+            plt.hist(array, data['nbins'])                                  # Plots histogram
+        for edges, counts in data.get('counts', []):
+            plt.hist(edges[:-1], edges, weights=counts)                     # Plots histogram from accumulator
+        for bins_range, popt, color in data['fits']:
+            plt.plot(bins_range, func(bins_range, *popt), color=color)      # Plots Gaussian fit (mean +/- 2sigma)
+        plt.xlabel(data['xlabel'])
+        plt.title(data['title'], fontsize=data['fontsize'])
+    if kind == 'waveform':
+        plt.plot(data['t'], data['v'])
+        plt.fill_between(data['t'], data['v_low'], data['v_high'], alpha=0.3)     # Plots band with 68% of waveforms
+        plt.xlabel('Time (s)')
+        plt.ylabel('Normalized Voltage')
+        plt.title(data['title'])
+    plt.savefig(file_name, dpi=dpi)
     plt.close()
 
 
-# Plots histograms for each calculation array
-def p1_hist(charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array,
-            time10_array, time20_array, time80_array, time90_array, dest_path, bins, version):
-    print('Creating histograms')
-    plot_histogram(charge_array, dest_path, bins, 'Charge', 'Charge', 'C', 'charge_' + version)
-    plot_histogram(amplitude_array, dest_path, bins, 'Voltage', 'Amplitude', 'V', 'amplitude_' + version)
-    plot_histogram(fwhm_array, dest_path, bins, 'Time', 'FWHM', 's', 'fwhm_' + version)
-    plot_histogram(rise1090_array, dest_path, bins, 'Time', '10-90 Rise Time', 's', 'rise1090_' + version)
-    plot_histogram(rise2080_array, dest_path, bins, 'Time', '20-80 Rise Time', 's', 'rise2080_' + version)
-    plot_histogram(fall1090_array, dest_path, bins, 'Time', '10-90 Fall Time', 's', 'fall1090_' + version)
-    plot_histogram(fall2080_array, dest_path, bins, 'Time', '20-80 Fall Time', 's', 'fall2080_' + version)
-    plot_histogram(time10_array, dest_path, bins, 'Time', '10% Jitter', 's', 'time10_' + version)
-    plot_histogram(time20_array, dest_path, bins, 'Time', '20% Jitter', 's', 'time20_' + version)
-    plot_histogram(time80_array, dest_path, bins, 'Time', '80% Jitter', 's', 'time80_' + version)
-    plot_histogram(time90_array, dest_path, bins, 'Time', '90% Jitter', 's', 'time90_' + version)
+# Renders queued plots in nworkers processes and empties plot queue
+def render_plots(dpi=360, nworkers=1):
+    plots = [(kind, file_name, data, dpi) for kind, file_name, data in plot_queue]
+    del plot_queue[:]
+    print('Rendering %d plots' % len(plots))
+    if nworkers > 1 and len(plots) > 1:
+        pool = Pool(min(nworkers, len(plots)))
+        pool.starmap(draw_plot, plots)
+        pool.close()
+        pool.join()
+    else:
+        for plot in plots:
+            draw_plot(*plot)
+
+
+# Empties plot queue without rendering (for runs with no plots)
+def clear_plots():
+    del plot_queue[:]
+
+
+# WAVEFORM ACCUMULATOR
+
+
+# Creates accumulator for mean & variance of waveforms (Welford's method) that also keeps a random sample of up to keep
+# waveforms for percentile bands
+def init_accumulator(keep=500):
+    accumulator = {'n': 0, 'mean': None, 'm2': None, 'keep': keep, 'reservoir': None, 'n_res': 0}
+    return accumulator
+
+
+# Adds a waveform (1-D array) or block of waveforms (2-D array, one waveform per row) to accumulator, sampling its
+# reservoir with random generator rng (a new one if rng is None)
+def update_accumulator(accumulator, v, rng=None):
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    n_b = len(v)
+    if n_b == 0:
+        return accumulator
+    if accumulator['mean'] is None:
+        accumulator['mean'] = np.zeros(v.shape[1])
+        accumulator['m2'] = np.zeros(v.shape[1])
+        accumulator['reservoir'] = np.zeros((accumulator['keep'], v.shape[1]))
+
+    # Combines mean & sum of squared differences of block with those of accumulator (Chan et al.)
+    mean_b = np.mean(v, axis=0)
+    m2_b = np.sum((v - mean_b) ** 2, axis=0)
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    # Keeps each waveform in reservoir with probability keep / n
+    rng = np.random.default_rng(rng)
+    for j in range(n_b):
+        if accumulator['n_res'] < accumulator['keep']:
+            accumulator['reservoir'][accumulator['n_res']] = v[j]
+            accumulator['n_res'] += 1
+        else:
+            k = rng.integers(0, n_a + j + 1)
+            if k < accumulator['keep']:
+                accumulator['reservoir'][k] = v[j]
+
+    return accumulator
+
+
+# Adds each waveform from an iterable of waveforms (list of arrays, generator, or 2-D array) to accumulator
+def accumulate_waveforms(accumulator, waveforms, rng=None):
+    rng = np.random.default_rng(rng)
+    for v in waveforms:
+        update_accumulator(accumulator, v, rng)
+    return accumulator
+
+
+# Combines two accumulators (e.g. from different workers) into a new accumulator, sampling its reservoir with random
+# generator rng (a new one if rng is None)
+def merge_accumulators(acc_a, acc_b, rng=None):
+    if acc_a['n'] == 0:
+        return acc_b
+    if acc_b['n'] == 0:
+        return acc_a
+    accumulator = init_accumulator(max(acc_a['keep'], acc_b['keep']))
+    n = acc_a['n'] + acc_b['n']
+    delta = acc_b['mean'] - acc_a['mean']
+    accumulator['n'] = n
+    accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+    accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+
+    # Combines reservoirs, choosing waveforms from each in proportion to number of waveforms each reservoir stands for
+    res = np.concatenate((acc_a['reservoir'][:acc_a['n_res']], acc_b['reservoir'][:acc_b['n_res']]))
+    weights = np.concatenate((np.full(acc_a['n_res'], acc_a['n'] / acc_a['n_res']),
+                              np.full(acc_b['n_res'], acc_b['n'] / acc_b['n_res'])))
+    n_res = min(accumulator['keep'], len(res))
+    idx = np.random.default_rng(rng).choice(len(res), n_res, replace=False, p=weights / np.sum(weights))
+    accumulator['reservoir'] = np.zeros((accumulator['keep'], res.shape[1]))
+    accumulator['reservoir'][:n_res] = res[idx]
+    accumulator['n_res'] = n_res
+
+    return accumulator
+
+
+# Returns mean, standard deviation, and lower & upper percentile bands of waveforms in accumulator
+def accumulator_stats(accumulator, low=15.87, high=84.13):
+    n = accumulator['n']
+    if n == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    mean = accumulator['mean']
+    if n > 1:
+        sd = np.sqrt(accumulator['m2'] / (n - 1))
+    else:
+        sd = np.zeros(len(mean))
+    res = accumulator['reservoir'][:accumulator['n_res']]
+    band_low = np.percentile(res, low, axis=0)
+    band_high = np.percentile(res, high, axis=0)
+
+    return mean, sd, band_low, band_high
 
 
 # AVERAGE/PLOT WAVEFORM
 
 
+# Returns index where averaging window of a waveform starts given its first time point t0, time step dt, and number of
+# points, or -1 if waveform does not have n_before points before t = 0 and length points in total
+def window_index(t0, dt, n_before, length, array_length):
+    idx0 = int(round(-t0 / dt))                     # Finds index of t = 0 point
+    idx_start = idx0 - n_before
+    if idx_start < 0 or idx_start + length > array_length - 1:
+        return -1
+    return idx_start
+
+
+# Chooses averaging window from a waveform file
+# Returns number of points before t = 0, number of points in window, and time step
+def average_window(file_name, nhdr):
+    t, v, hdr = rw(file_name, nhdr)
+    array_length = len(t)
+    dt = (t[-1] - t[0]) / (array_length - 1)
+    # Window of points before t = 0 & after the spe
+    n_before = array_length - int(0.87 * array_length)
+    length = int(0.99 * array_length)
+    return n_before, length, dt
+
+
+# Reads a shard of waveform files and adds each aligned, normalized waveform to the accumulator of its group
+# jobs is a list of (group, file name) and windows holds number of points before t = 0 & window length of each group
+# Returns dictionary of accumulator for each group (reservoirs are sampled with a random generator seeded from seed)
+def average_shard(jobs, nhdr, windows, seed=None):
+    rng = np.random.default_rng(seed)
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of aligned waveforms
+    ks = {}
+
+    for group, file_name in jobs:
+        n_before, length = windows[group]
+        if group not in accs:
+            accs[group] = init_accumulator()
+            blocks[group] = np.empty((500, length))
+            ks[group] = 0
+        print('Reading file', Path(file_name).name)
+        t, v, hdr = rw(file_name, nhdr)             # Reads a waveform file
+        array_length = len(t)
+        dt = (t[-1] - t[0]) / (array_length - 1)
+        idx_start = window_index(t[0], dt, n_before, length, array_length)
+        # Only averages waveform files that have enough points before t = 0 & after the spe
+        if idx_start >= 0:
+            k = ks[group]
+            blocks[group][k] = v[idx_start:idx_start + length]
+            blocks[group][k] /= min(v)              # Normalizes voltages
+            ks[group] = k + 1
+            if ks[group] == len(blocks[group]):     # Adds full block of waveforms to accumulator
+                update_accumulator(accs[group], blocks[group], rng)
+                ks[group] = 0
+    for group in accs:
+        update_accumulator(accs[group], blocks[group][:ks[group]], rng)
+
+    return accs
+
+
+# Averages waveform files of every group in one pass, splitting them into one shard per worker process and merging the
+# accumulators at the end (jobs is a list of (group, file name))
+# Returns dictionaries of accumulator and time array of average waveform for each group
+def average_files(jobs, nhdr, nworkers=1):
+    windows = {}
+    times = {}
+    for group, file_name in jobs:                   # Chooses window of each group from its first file
+        if group not in windows:
+            n_before, length, dt = average_window(file_name, nhdr)
+            windows[group] = (n_before, length)
+            times[group] = (np.arange(length) - n_before) * dt
+
+    if nworkers > 1 and len(jobs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(jobs[j * len(jobs) // nworkers:(j + 1) * len(jobs) // nworkers], nhdr, windows, seeds[j])
+                  for j in range(nworkers)]
+        pool = Pool(nworkers)
+        shard_accs = pool.starmap(average_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        shard_accs = [average_shard(jobs, nhdr, windows)]
+
+    accs = {}
+    for group in windows:
+        accs[group] = init_accumulator()
+        for shard_acc in shard_accs:
+            if group in shard_acc:
+                accs[group] = merge_accumulators(accs[group], shard_acc[group])
+
+    return accs, times
+
+
 # Calculates average waveform of spe
-def average_waveform(start, end, dest_path, data_file, version, nhdr):
+def average_waveform(start, end, dest_path, data_file, version, nhdr, nworkers=1):
     save_file = Path(Path(dest_path) / 'plots')
-    tsum = 0
-    vsum = 0
-    n = 0
-
+    ledger = read_ledger(dest_path)
+    jobs = []
     for i in range(start, end + 1):
         file_name = 'D1--waveforms--%05d.txt' % i
-        if os.path.isfile(data_file / file_name):
-            print('Reading file #', i)
-            t, v, hdr = rw(data_file / file_name, nhdr)     # Reads a waveform file
-            array_length = len(t)
-            v = v / min(v)                                  # Normalizes voltages
-            idx = np.where(t == 0)                          # Finds index of t = 0 point
-            idx = int(idx[0])
-            t = np.roll(t, -idx)                            # Rolls time array so that t = 0 point is at index 0
-            v = np.roll(v, -idx)                            # Rolls voltage array so that 50% max point is at index 0
-            idx2 = np.where(t == min(t))                    # Finds index of point of minimum t
-            idx2 = int(idx2[0])
-            idx3 = np.where(t == max(t))                    # Finds index of point of maximum t
-            idx3 = int(idx3[0])
-            # Only averages waveform files that have enough points before t = 0 & after the spe
-            if idx2 <= int(0.87 * array_length):
-                # Removes points between point of maximum t & chosen minimum t in time & voltage arrays
-                t = np.concatenate((t[:idx3], t[int(0.87 * array_length):]))
-                v = np.concatenate((v[:idx3], v[int(0.87 * array_length):]))
-                # Rolls time & voltage arrays so that point of chosen minimum t is at index 0
-                t = np.roll(t, -idx3)
-                v = np.roll(v, -idx3)
-                if len(t) >= int(0.99 * array_length):
-                    # Removes points after chosen point of maximum t in time & voltage arrays
-                    t = t[:int(0.99 * array_length)]
-                    v = v[:int(0.99 * array_length)]
-                    # Sums time & voltage arrays
-                    tsum += t
-                    vsum += v
-                    n += 1
-    # Finds average time & voltage arrays
-    t_avg = tsum / n
-    v_avg = vsum / n
-
-    # Plots average waveform & saves image
-    plt.plot(t_avg, v_avg)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveform')
-    plt.savefig(save_file / str('avg_waveform_' + version + '.png'), dpi=360)
+        if os.path.isfile(data_file / file_name) and check_rejected(ledger, '%05d' % i) == 'no':
+            jobs.append((version, str(data_file / file_name)))
+
+    # Reads and averages waveforms in nworkers processes
+    accs, times = average_files(jobs, nhdr, nworkers)
+
+    if version not in accs or accs[version]['n'] == 0:
+        print('No waveforms to average')
+        return
+    t_avg = times[version]
+
+    # Finds average voltage array and standard deviation & 68% band of voltage arrays
+    v_avg, v_sd, v_low, v_high = accumulator_stats(accs[version])
 
     # Saves average waveform data
     file_name = Path(dest_path) / str(Path('hist_data') / str('avg_waveform_' + version + '.txt'))
     hdr = 'Average Waveform\n\n\n\nTime,Ampl'
     ww(t_avg, v_avg, file_name, hdr)
+    ww(t_avg, v_sd, str(file_name)[:-4] + '_sd.txt', 'Waveform Standard Deviation\n\n\n\nTime,Ampl')
+
+    # Queues average waveform & 68% band to be plotted
+    queue_plot('waveform', save_file / str('avg_waveform_' + version + '.png'),
+               {'t': t_avg, 'v': v_avg, 'v_low': v_low, 'v_high': v_high,
+                'title': 'Average Waveform'})
 
 
 # Shows a waveform plot to user
 def show_waveform(file_name, version):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(file_name, 5)
     print("\nHeader:\n\n" + str(hdr))
     plt.plot(t, v)
@@ -837,27 +1515,6 @@ def make_folders(dest_path, data_shift, save_shift):
 # P1B
 
 
-# Creates arrays for p1b
-def initialize_arrays_2():
-    charge_array = np.array([])
-    amplitude_array = np.array([])
-    fwhm_array = np.array([])
-    rise1090_array = np.array([])
-    rise2080_array = np.array([])
-    fall1090_array = np.array([])
-    fall2080_array = np.array([])
-    time10_array = np.array([])
-    time20_array = np.array([])
-    time80_array = np.array([])
-    time90_array = np.array([])
-    jitter_array1 = np.array([])
-    jitter_array2 = np.array([])
-    p1b_spe_array = np.array([])
-
-    return charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, \
-        time10_array, time20_array, time80_array, time90_array, jitter_array1, jitter_array2, p1b_spe_array
-
-
 # Creates p1b folder names
 def initialize_folders_2(dest_path):
     file_path_calc = Path(Path(dest_path) / 'calculations')
@@ -878,64 +1535,109 @@ def make_folders_2(file_path_shift_d1b, file_path_not_spe):
         os.mkdir(file_path_not_spe)
 
 
-# Assigns variables to mean values of FWHM, charge, 10-90 falltime, and amplitude
-def mean_values(val1, val2, val3, val4):
-    mean_fwhm = val1
-    mean_charge = val2
-    mean_fall1090 = val3
-    mean_amplitude = val4
+# Returns md5 checksum of file numbers & FWHM, charge, 10-90 fall time, and amplitude columns of calculations table
+def calc_table_md5(numbers, calcs):
+    checksum = hashlib.md5(np.asarray(numbers, dtype=np.int64).tobytes())
+    for name in ['fwhm', 'charge', 'fall1090', 'amplitude']:
+        checksum.update(np.asarray(calcs[name], dtype=np.float64).tobytes())
+    return checksum.hexdigest()
 
-    return mean_fwhm, mean_charge, mean_fall1090, mean_amplitude
 
+# Returns central values of FWHM, charge, 10-90 fall time, and amplitude of a data set (medians of calculations table)
+# Values are saved to a file with the checksum of the table they came from, and are read from that file instead of
+# being recalculated as long as the files & their calculations have not changed
+def central_values(dest_path, numbers, calcs):
+    file_name = Path(dest_path) / 'hist_data' / 'central_values.txt'
+    n = len(calcs['fwhm'])
+    table_md5 = calc_table_md5(numbers, calcs)
+
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        values = {}
+        for row in csv.reader(myfile):
+            values[row[0]] = row[1]
+        myfile.close()
+        if values.get('md5') == table_md5:
+            print('Reading central values from file')
+            return float(values['fwhm']), float(values['charge']), float(values['fall1090']), \
+                float(values['amplitude'])
+        print('Calculations have changed since central values were saved')
+
+    print('Calculating central values')
+    median_fwhm = np.median(calcs['fwhm'])
+    median_charge = np.median(calcs['charge'])
+    median_fall1090 = np.median(calcs['fall1090'])
+    median_amplitude = np.median(calcs['amplitude'])
+
+    myfile = open(file_name, 'w')
+    myfile.write('n,' + str(n))
+    myfile.write('\nmd5,' + table_md5)
+    myfile.write('\nfwhm,' + str(median_fwhm))
+    myfile.write('\ncharge,' + str(median_charge))
+    myfile.write('\nfall1090,' + str(median_fall1090))
+    myfile.write('\namplitude,' + str(median_amplitude))
+    myfile.close()
+
+    return median_fwhm, median_charge, median_fall1090, median_amplitude
 
-# Checks if jitter times are reasonable
-def check_jitter(myfile):
-    csv_reader = csv.reader(myfile)
-    file_array = np.array([])
-    for row in csv_reader:  # Creates array with calculation data
-        file_array = np.append(file_array, float(row[1]))
-    time10 = file_array[9]
-    time20 = file_array[10]
-    time80 = file_array[11]
-    time90 = file_array[12]
-
-    if time10 <= -4e-9 or time20 <= -2.5e-9 or time80 >= 2.5e-9 or time90 >= 3.5e-9:
-        possibility = 'no'
-    elif time10 <= -2e-9 or time20 <= -1.5e-9 or time80 >= 1.5e-9 or time90 >= 2e-9:
-        possibility = 'maybe'
-    else:
-        possibility = 'yes'
+
+# Reads calculation files of every spe in a range into a table
+# Returns array of file numbers and dictionary of calculation name: array of values (one value per file), which is
+# empty if there are no calculation files in range
+def read_calc_table(file_path_calc, start, end, ledger):
+    calc_files = set(os.listdir(file_path_calc))
+    numbers = []
+    names = []
+    rows = []
+
+    for i in range(start, end + 1):
+        file_name = 'D1--waveforms--%05d.txt' % i
+        if file_name in calc_files and check_rejected(ledger, '%05d' % i) == 'no':
+            myfile = open(file_path_calc / file_name, 'r')      # Opens file with calculations
+            file_rows = list(csv.reader(myfile))
+            myfile.close()
+            names = [row[0] for row in file_rows]
+            rows.append([float(row[1]) for row in file_rows])
+            numbers.append(i)
+
+    numbers = np.array(numbers, dtype=int)
+    rows = np.array(rows).reshape(len(numbers), len(names))
+    calcs = {}
+    for j in range(len(names)):                 # Creates a column for each calculation
+        calcs[names[j]] = rows[:, j]
+
+    return numbers, calcs
+
+
+# Checks if jitter times are reasonable (works on single values or arrays of values)
+def check_jitter(time10, time20, time80, time90):
+    no = (time10 <= -4e-9) | (time20 <= -2.5e-9) | (time80 >= 2.5e-9) | (time90 >= 3.5e-9)
+    maybe = (time10 <= -2e-9) | (time20 <= -1.5e-9) | (time80 >= 1.5e-9) | (time90 >= 2e-9)
+    possibility = np.where(no, 'no', np.where(maybe, 'maybe', 'yes'))
 
     return possibility
 
 
-# Checks if FWHM, charge, amplitude, and 10-90 fall time values are reasonable
+# Checks if FWHM, charge, amplitude, and 10-90 fall time values are reasonable (works on single values or arrays of
+# values)
 def check_vals(fwhm, charge, fall, amp, mean_fwhm, mean_charge, mean_fall, mean_amp):
-    if (charge > 2 * mean_charge and (fwhm > 2 * mean_fwhm or fall > 2 * mean_fall or amp > 2 * mean_amp)) or fwhm >= \
-            3e-8:
-        possibility = 'no'
-    else:
-        possibility = 'yes'
+    no = ((charge > 2 * mean_charge) & ((fwhm > 2 * mean_fwhm) | (fall > 2 * mean_fall) | (amp > 2 * mean_amp))) | \
+        (fwhm >= 3e-8)
+    possibility = np.where(no, 'no', 'yes')
 
     return possibility
 
 
-# Sorts whether waveform is spe for p1b
-def p1b_sort(i, nhdr, jitter_array1, jitter_array2, p1b_spe_array, file_path_shift, file_path_shift_d1b,
-             file_path_not_spe):
-    val = 0
-    for j in range(len(jitter_array1)):
-        if jitter_array1[j] == i:
-            val = 1
-    for j in range(len(jitter_array2)):
-        if jitter_array2[j] == i:
-            val = 2
-    if val == 1:    # If a file had unreasonable jitter times, it is not spe
+# Sorts whether waveform is spe for p1b given result of jitter check
+# Returns 'yes' if waveform is spe and 'no' if it is not
+def p1b_sort(i, nhdr, jitter, file_path_shift, file_path_shift_d1b, file_path_not_spe):
+    import matplotlib.pyplot as plt
+    is_spe = 'no'
+    t, v, hdr = rw(str(file_path_shift / 'D1--waveforms--%05d.txt') % i, nhdr)     # Reads waveform
+    if jitter == 'no':          # If a file had unreasonable jitter times, it is not spe
         print('File #%05d is not spe' % i)
-        t, v, hdr = rw(str(file_path_shift / 'D1--waveforms--%05d.txt') % i, nhdr)
         ww(t, v, str(file_path_not_spe / 'D1--waveforms--%05d.txt') % i, hdr)
-    elif val == 2:  # If a file had potentially unreasonable jitter times, plots waveform for user to sort manually
-        t, v, hdr = rw(str(file_path_shift / 'D1--waveforms--%05d.txt') % i, nhdr)  # Reads waveform
+    elif jitter == 'maybe':     # If a file had potentially unreasonable jitter times, plots waveform for user to sort
         print('Displaying file #%05d' % i)
         plt.figure()
         plt.plot(t, v)
@@ -949,35 +1651,13 @@ def p1b_sort(i, nhdr, jitter_array1, jitter_array2, p1b_spe_array, file_path_shi
         if spe_check == 'y':
             print('File #%05d is spe' % i)
             ww(t, v, str(file_path_shift_d1b / 'D1--waveforms--%05d.txt') % i, hdr)
-            p1b_spe_array = np.append(p1b_spe_array, i)     # File numbers of spes are added to an array
+            is_spe = 'yes'
         elif spe_check == 'n':
             print('File #%05d is not spe' % i)
             ww(t, v, str(file_path_not_spe / 'D1--waveforms--%05d.txt') % i, hdr)
         plt.close()
-    else:  # If a file did not have unreasonable jitter times, it is spe
-        t, v, hdr = rw(str(file_path_shift / 'D1--waveforms--%05d.txt') % i, nhdr)
+    else:                       # If a file did not have unreasonable jitter times, it is spe
         ww(t, v, str(file_path_shift_d1b / 'D1--waveforms--%05d.txt') % i, hdr)
-        p1b_spe_array = np.append(p1b_spe_array, i)         # File numbers of spes are added to an array
-
-    return p1b_spe_array
-
-
-# Creates p1b calculation arrays
-def p1b_calc_arrays(charge, amp, fwhm, rise1090, rise2080, fall1090, fall2080, j10, j20, j80, j90, charge_array,
-                    amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array,
-                    time10_array, time20_array, time80_array, time90_array):
-    charge_array = np.append(charge_array, charge)
-    amplitude_array = np.append(amplitude_array, amp)
-    fwhm_array = np.append(fwhm_array, fwhm)
-    rise1090_array = np.append(rise1090_array, rise1090)
-    rise2080_array = np.append(rise2080_array, rise2080)
-    fall1090_array = np.append(fall1090_array, fall1090)
-    fall2080_array = np.append(fall2080_array, fall2080)
-    time10_array = np.append(time10_array, j10)
-    time20_array = np.append(time20_array, j20)
-    time80_array = np.append(time80_array, j80)
-    time90_array = np.append(time90_array, j90)
-
-    return charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, \
-        time10_array, time20_array, time80_array, time90_array
+        is_spe = 'yes'
 
+    return is_spe
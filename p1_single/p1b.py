@@ -1,74 +1,64 @@
 from p1_functions import *
 
 
-def p1b(start, end, dest_path, nhdr):
-
-    charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, \
-        time10_array, time20_array, time80_array, time90_array, jitter_array1, jitter_array2, p1b_spe_array = \
-        initialize_arrays_2()
+def p1b(start, end, dest_path, nhdr, nworkers=1, dpi=360, no_plots=False):
     file_path_calc, file_path_shift, file_path_shift_d1b, file_path_not_spe = initialize_folders_2(dest_path)
     make_folders_2(file_path_shift_d1b, file_path_not_spe)
+    ledger = read_ledger(dest_path)
 
-    # Mean p1 values
-    mean_fwhm, mean_charge, mean_fall1090, mean_amplitude = mean_values(7.51e-9, 1.26e-12, 1.88e-8, 0.00658)
-
-    # Checks jitter times
+    # Reads calculations of every spe into a table
     print('Reading files...')
-    for i in range(start, end + 1):
-        if os.path.isfile(str(file_path_calc / 'D1--waveforms--%05d.txt') % i):
-            myfile = open(str(file_path_calc / 'D1--waveforms--%05d.txt') % i, 'r')     # Opens file with calculations
-            possibility = check_jitter(myfile)
-            myfile.close()
-
-            # If jitter times are unreasonable, adds file number to a list
-            if possibility == 'no':
-                jitter_array1 = np.append(jitter_array1, int(i))
-            elif possibility == 'maybe':
-                jitter_array2 = np.append(jitter_array2, int(i))
-
-    for i in range(start, end + 1):
-        if os.path.isfile(str(file_path_not_spe / 'D1--waveforms--%05d.txt') % i):
-            pass
-        elif os.path.isfile(str(file_path_shift_d1b / 'D1--waveforms--%05d.txt') % i):
-            p1b_spe_array = np.append(p1b_spe_array, i)
+    numbers, calcs = read_calc_table(file_path_calc, start, end, ledger)
+    if len(numbers) == 0:
+        print('Error: No calculations of spes from #%05d to #%05d (run p1 first)' % (start, end))
+        return
+
+    # Central p1 values (medians of data set)
+    mean_fwhm, mean_charge, mean_fall1090, mean_amplitude = central_values(dest_path, numbers, calcs)
+    print('Central values:', mean_fwhm, mean_charge, mean_fall1090, mean_amplitude)
+
+    # Checks jitter times and FWHM, charge, 10-90 fall time & amplitude values of every spe at once
+    jitter = check_jitter(calcs['time10'], calcs['time20'], calcs['time80'], calcs['time90'])
+    possibility = check_vals(calcs['fwhm'], calcs['charge'], calcs['fall1090'], calcs['amplitude'], mean_fwhm,
+                             mean_charge, mean_fall1090, mean_amplitude)
+
+    not_spe_files = set(os.listdir(file_path_not_spe))
+    d1b_files = set(os.listdir(file_path_shift_d1b))
+    shift_files = set(os.listdir(file_path_shift))
+    is_spe = np.zeros(len(numbers), dtype=bool)
+
+    for j in range(len(numbers)):
+        i = numbers[j]
+        file_name = 'D1--waveforms--%05d.txt' % i
+        if file_name in not_spe_files:          # If file has already been sorted as not spe, does not sort it again
             pass
-        else:
-            if os.path.isfile(str(file_path_shift / 'D1--waveforms--%05d.txt') % i):
-                t, v, hdr = rw(str(file_path_shift / 'D1--waveforms--%05d.txt') % i, nhdr)      # Reads waveform file
-
-                t1, t2, charge, amp, fwhm, rise1090, rise2080, fall1090, fall2080, j10, j20, j80, j90 = \
-                    read_calc(str(file_path_calc / 'D1--waveforms--%05d.txt') % i)
-
-                # If FWHM, charge, or 10-90 fall time is over twice the mean value, waveform is not spe
-                possibility2 = check_vals(fwhm, charge, fall1090, amp, mean_fwhm, mean_charge, mean_fall1090,
-                                          mean_amplitude)
-
-                if possibility2 == 'no':
-                    print('File #%05d is not spe' % i)
-                    ww(t, v, str(file_path_not_spe / 'D1--waveforms--%05d.txt') % i, hdr)
-                else:
-                    p1b_sort(i, nhdr, jitter_array1, jitter_array2, p1b_spe_array, file_path_shift, file_path_shift_d1b,
-                             file_path_not_spe)
-
-    for i in range(start, end + 1):
-        if i in p1b_spe_array:      # If a waveform is spe as sorted by p1b, its calculations are added to arrays
-            print("Reading calculations from shifted file #%05d" % i)
-
-            t1, t2, charge, amp, fwhm, rise1090, rise2080, fall1090, fall2080, j10, j20, j80, j90 = \
-                read_calc(str(file_path_calc / 'D1--waveforms--%05d.txt') % i)
-            charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array, \
-                time10_array, time20_array, time80_array, time90_array = \
-                p1b_calc_arrays(charge, amp, fwhm, rise1090, rise2080, fall1090, fall2080, j10, j20, j80, j90,
-                                charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array,
-                                fall1090_array, fall2080_array, time10_array, time20_array, time80_array, time90_array)
+        elif file_name in d1b_files:            # If file has already been sorted as spe, does not sort it again
+            is_spe[j] = True
+        elif file_name in shift_files:
+            # If FWHM, charge, or 10-90 fall time is over twice the mean value, waveform is not spe
+            if possibility[j] == 'no':
+                print('File #%05d is not spe' % i)
+                t, v, hdr = rw(file_path_shift / file_name, nhdr)       # Reads waveform file
+                ww(t, v, file_path_not_spe / file_name, hdr)
+            else:
+                is_spe[j] = p1b_sort(i, nhdr, jitter[j], file_path_shift, file_path_shift_d1b,
+                                     file_path_not_spe) == 'yes'
 
     # Plots histograms of charge, amplitude, FWHM, 10-90 & 20-80 rise times, 10-90 & 20-80 fall times, and 10%, 20%, 80%
-    # & 90% jitter
-    p1_hist(charge_array, amplitude_array, fwhm_array, rise1090_array, rise2080_array, fall1090_array, fall2080_array,
-            time10_array, time20_array, time80_array, time90_array, dest_path, 100, 'd1b')
+    # & 90% jitter for waveforms that are spe as sorted by p1b
+    p1_hist(calcs['charge'][is_spe], calcs['amplitude'][is_spe], calcs['fwhm'][is_spe], calcs['rise1090'][is_spe],
+            calcs['rise2080'][is_spe], calcs['fall1090'][is_spe], calcs['fall2080'][is_spe], calcs['time10'][is_spe],
+            calcs['time20'][is_spe], calcs['time80'][is_spe], calcs['time90'][is_spe], dest_path, 100, 'd1b',
+            nworkers)
 
     # Plots and saves average waveform
-    average_waveform(start, end, dest_path, file_path_shift_d1b, 'd1b', nhdr)
+    average_waveform(start, end, dest_path, file_path_shift_d1b, 'd1b', nhdr, nworkers)
+
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
 
 
 if __name__ == '__main__':
@@ -79,6 +69,10 @@ if __name__ == '__main__':
     parser.add_argument("--end", type=int, help='file number to end at', default=99999)
     parser.add_argument("--nhdr", type=int, help='number of header lines to skip', default=5)
     parser.add_argument("--dest_path", type=str, help='folder to read from', default=data)
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for fitting histograms & averaging waveforms '
+                                                  '(default=1)', default=1)
     args = parser.parse_args()
 
-    p1b(args.start, args.end, args.dest_path, args.nhdr)
\ No newline at end of file
+    p1b(args.start, args.end, args.dest_path, args.nhdr, args.cores, args.dpi, args.no_plots)
\ No newline at end of file
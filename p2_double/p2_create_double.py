@@ -2,69 +2,95 @@ from p2_functions import *
 
 
 # Creates data set of double spe waveforms (and set of single spe waveforms for comparison)
-def create_double_spe(nloops, date, filter_band, nhdr, delay, delay_folder, fsps):
+# If virtual, only a manifest of pairs is saved and double spe waveforms are generated from it in memory
+def create_double_spe(nloops, date, filter_band, nhdr, delay, delay_folder, fsps, nworkers=1, dpi=360, no_plots=False,
+                      virtual=False, seed=None):
     gen_path, save_path, dest_path, single_path, filt_path1, filt_path2, filt_path4, filt_path8, delay_path1, \
     delay_path2, delay_path4, delay_path8, filt_path1_s, filt_path2_s, filt_path4_s, filt_path8_s = \
         initialize_folders(date, filter_band, delay_folder)
     make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8, delay_path1, delay_path2, delay_path4,
                  delay_path8, filt_path1_s, filt_path2_s, filt_path4_s, filt_path8_s, delay_folder)
 
-    single_file_array, single_file_array2, double_file_array = initial_arrays(single_path, filt_path1_s, delay_path1)
-
-    # Creates double spe files
-    print('Adding double files...')
-    for i in range(nloops):
-        double_file_array = add_spe(single_file_array, double_file_array, delay, delay_path1, nloops, single_path, nhdr)
+    # Taus & gain factors of shapings are read from calibration made by p2
+    calibration = load_calibration(save_path, dest_path, fsps)
+    if calibration is None:
+        return
+    tau_list, factor_list = calibration
+
+    ledger = read_ledger(dest_path)
+    single_file_array, single_file_array2, double_file_array = initial_arrays(single_path, filt_path1_s, delay_path1,
+                                                                              ledger)
+
+    # Creates double spe files, or chooses pairs of single spe files for virtual data set
+    if virtual:
+        manifest = make_manifest(dest_path, delay_folder, single_file_array, nloops, delay, fsps, seed)
+    else:
+        print('Adding double files...')
+        for i in range(nloops):
+            double_file_array = add_spe(single_file_array, double_file_array, delay, delay_path1, nloops, single_path,
+                                        nhdr)
 
     # Creates single spe files
     print('Adding single files...')
     for i in range(nloops):
         single_file_array2 = single_set(single_file_array, single_file_array2, nloops, single_path, filt_path1_s, nhdr)
 
-    # Shapes single and double waveforms
+    # Shapes single waveforms
     for item in single_file_array2:
         save_name1 = str(filt_path1_s / 'D2--waveforms--%05d.txt') % item
         save_name2 = str(filt_path2_s / 'D2--waveforms--%05d.txt') % item
         save_name4 = str(filt_path4_s / 'D2--waveforms--%05d.txt') % item
         save_name8 = str(filt_path8_s / 'D2--waveforms--%05d.txt') % item
 
-        shaping(save_name1, save_name2, save_name4, save_name8, item, fsps, nhdr)
-
-    for item in double_file_array:
-        save_name1 = str(delay_path1 / 'D2--waveforms--%s.txt') % item
-        save_name2 = str(delay_path2 / 'D2--waveforms--%s.txt') % item
-        save_name4 = str(delay_path4 / 'D2--waveforms--%s.txt') % item
-        save_name8 = str(delay_path8 / 'D2--waveforms--%s.txt') % item
-
-        shaping(save_name1, save_name2, save_name4, save_name8, item, fsps, nhdr)
+        shaping(save_name1, save_name2, save_name4, save_name8, item, tau_list, factor_list, fsps, nhdr)
 
     # Creates name of delay folder
     delay_name = delay_names(delay_folder)
 
-    # Plots average waveform for 1x rise time
-    print('Calculating rt_1 average waveform...')
-    average_waveform(double_file_array, dest_path, 'rt_1', 'No Shaping', delay_path1, delay_name, delay_folder, nhdr)
-
-    # Plots average waveform for 2x rise time
-    print('Calculating rt_2 average waveform...')
-    average_waveform(double_file_array, dest_path, 'rt_2', '2x Shaping', delay_path2, delay_name, delay_folder, nhdr)
-
-    # Plots average waveform for 4x rise time
-    print('Calculating rt_4 average waveform...')
-    average_waveform(double_file_array, dest_path, 'rt_4', '4x Shaping', delay_path4, delay_name, delay_folder, nhdr)
-
-    # Plots average waveform for 8x rise time
-    print('Calculating rt_8 average waveform...')
-    average_waveform(double_file_array, dest_path, 'rt_8', '8x Shaping', delay_path8, delay_name, delay_folder, nhdr)
-
-    # Calculates 10-90 rise times for each double spe waveform and puts them into arrays
-    print('Doing calculations...')
-    rt_1_array, rt_2_array, rt_4_array, rt_8_array = make_arrays(double_file_array, delay_path1, delay_path2,
-                                                                 delay_path4, delay_path8, dest_path, delay_folder,
-                                                                 nhdr)
+    if virtual:
+        # Generates and shapes each double spe waveform in memory, then plots average waveforms and calculates 10-90
+        # rise times for 1x, 2x, 4x, and 8x rise time in the same pass
+        print('Calculating virtual double spe waveforms...')
+        rt_arrays, accs, times = virtual_arrays(manifest, single_path, tau_list, factor_list, nhdr, nworkers)
+        for shaping_type, shaping_name in [('rt_1', 'No Shaping'), ('rt_2', '2x Shaping'), ('rt_4', '4x Shaping'),
+                                           ('rt_8', '8x Shaping')]:
+            if accs[shaping_type]['n'] > 0:
+                save_average(accs[shaping_type], times[shaping_type], dest_path, shaping_type, shaping_name,
+                             delay_name, delay_folder)
+            else:
+                print('No ' + delay_folder + ' ' + shaping_type + ' waveforms to average')
+        rt_1_array, rt_2_array, rt_4_array, rt_8_array = [rt_arrays[shaping_type] for shaping_type in double_shapings]
+    else:
+        for item in double_file_array:
+            save_name1 = str(delay_path1 / 'D2--waveforms--%s.txt') % item
+            save_name2 = str(delay_path2 / 'D2--waveforms--%s.txt') % item
+            save_name4 = str(delay_path4 / 'D2--waveforms--%s.txt') % item
+            save_name8 = str(delay_path8 / 'D2--waveforms--%s.txt') % item
+
+            shaping(save_name1, save_name2, save_name4, save_name8, item, tau_list, factor_list, fsps, nhdr)
+
+        # Plots average waveforms for 1x, 2x, 4x, and 8x rise time, reading each waveform id once
+        print('Calculating average waveforms...')
+        average_waveforms([(double_file_array, 'rt_1', 'No Shaping', delay_path1, delay_name, delay_folder),
+                           (double_file_array, 'rt_2', '2x Shaping', delay_path2, delay_name, delay_folder),
+                           (double_file_array, 'rt_4', '4x Shaping', delay_path4, delay_name, delay_folder),
+                           (double_file_array, 'rt_8', '8x Shaping', delay_path8, delay_name, delay_folder)],
+                          dest_path, nhdr, nworkers)
+
+        # Calculates 10-90 rise times for each double spe waveform and puts them into arrays
+        print('Doing calculations...')
+        rt_1_array, rt_2_array, rt_4_array, rt_8_array = make_arrays(double_file_array, delay_path1, delay_path2,
+                                                                     delay_path4, delay_path8, dest_path,
+                                                                     delay_folder, nhdr)
 
     # Creates histograms of 10-90 rise times for 1x, 2x, 4x, and 8x the initial rise time for double spe waveforms
-    p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, dest_path, 100, delay_name, delay_folder)
+    p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, dest_path, 100, delay_name, delay_folder, nworkers)
+
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
 
 
 if __name__ == '__main__':
@@ -79,6 +105,14 @@ if __name__ == '__main__':
     parser.add_argument("--delay_folder", type=str, help='folder name for delay (default=no_delay)', default='no_delay')
     parser.add_argument("--fsps", type=float, help='samples per second (Hz) (default=20000000000.)',
                         default=20000000000.)
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for fitting histograms & averaging waveforms '
+                                                  '(default=1)', default=1)
+    parser.add_argument("--virtual", action='store_true', help='only save manifest of pairs and generate double spe '
+                                                               'waveforms from it in memory')
+    parser.add_argument("--seed", type=int, help='random seed for choosing pairs of virtual data set (default=random)')
     args = parser.parse_args()
 
-    create_double_spe(args.nloops, args.date, args.fil_band, args.nhdr, args.delay, args.delay_folder, args.fsps)
+    create_double_spe(args.nloops, args.date, args.fil_band, args.nhdr, args.delay, args.delay_folder, args.fsps,
+                      args.cores, args.dpi, args.no_plots, args.virtual, args.seed)
@@ -1,11 +1,11 @@
 import os
 import csv
+import time
+import hashlib
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
-from scipy.optimize import curve_fit
-from scipy.stats import norm
+from multiprocessing import Pool
 
 
 # FILE READING/WRITING
@@ -143,71 +143,589 @@ def read_info(myfile):
         i_amp, i_band, i_nfilter
 
 
+# Returns md5 checksum of a file
+def file_md5(file_name):
+    myfile = open(file_name, 'rb')
+    checksum = hashlib.md5(myfile.read()).hexdigest()
+    myfile.close()
+    return checksum
+
+
+# Writes calibration file (dict of name & value rows, e.g. md5 checksum of average waveform template, taus & gain
+# factors of shapings)
+def write_calibration(file_name, calibration):
+    myfile = open(file_name, 'w', newline='')
+    csv_writer = csv.writer(myfile)
+    for name in calibration:
+        csv_writer.writerow([name, calibration[name]])
+    myfile.close()
+
+
+# Reads calibration file into dict (values are strings), or returns None if there is no calibration file
+def read_calibration(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    calibration = {}
+    for row in csv.reader(myfile):
+        calibration[row[0]] = row[1]
+    myfile.close()
+    return calibration
+
+
+# LEDGER
+
+
+# Reads ledger of waveform labels
+# Returns dictionary of waveform id: (status, reason, stage)
+def read_ledger(dest_path):
+    ledger = {}
+    file_name = Path(dest_path) / 'ledger.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):          # Later labels of a waveform replace earlier ones
+            ledger[row[0]] = (row[1], row[2], row[3])
+        myfile.close()
+
+    return ledger
+
+
+# Checks if a waveform has been rejected
+def check_rejected(ledger, waveform_id):
+    if str(waveform_id) in ledger and ledger[str(waveform_id)][0] == 'rejected':
+        return 'yes'
+    else:
+        return 'no'
+
+
+# HISTOGRAM ACCUMULATOR
+
+
+# Finds fixed bin edges for histogram accumulator from calibration array: nbins bins between minimum & maximum of array
+# (same as np.histogram) plus bins of the same width covering margin (fraction of range) on each side for later values
+def hist_edges(array, nbins, margin=0.):
+    low = float(np.min(array))
+    high = float(np.max(array))
+    if low == high:
+        low = low - 0.5
+        high = high + 0.5
+    n_pad = int(np.ceil(margin * nbins))
+    width = (high - low) / nbins
+    edges = np.linspace(low - n_pad * width, high + n_pad * width, nbins + 2 * n_pad + 1)
+    return edges
+
+
+# Creates histogram accumulator with fixed bin edges that also keeps mean & variance of values (Welford's method)
+def init_hist_accumulator(edges):
+    accumulator = {'edges': np.asarray(edges, dtype=float), 'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+                   'under': 0, 'over': 0, 'n': 0, 'mean': 0., 'm2': 0.}
+    return accumulator
+
+
+# Adds a value or array of values to histogram accumulator (values outside bin edges are only counted as under/over)
+def update_hist_accumulator(accumulator, values):
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    n_b = len(values)
+    if n_b == 0:
+        return accumulator
+    edges = accumulator['edges']
+    accumulator['counts'] += np.histogram(values, edges)[0]
+    accumulator['under'] += int(np.count_nonzero(values < edges[0]))
+    accumulator['over'] += int(np.count_nonzero(values > edges[-1]))
+
+    # Combines mean & sum of squared differences of values with those of accumulator (Chan et al.)
+    mean_b = float(np.mean(values))
+    m2_b = float(np.sum((values - mean_b) ** 2))
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    return accumulator
+
+
+# Combines two histogram accumulators with the same bin edges (e.g. from different workers or runs) into a new one
+def merge_hist_accumulators(acc_a, acc_b):
+    if not np.array_equal(acc_a['edges'], acc_b['edges']):
+        raise ValueError('Histogram accumulators have different bin edges')
+    accumulator = init_hist_accumulator(acc_a['edges'])
+    accumulator['counts'] = acc_a['counts'] + acc_b['counts']
+    accumulator['under'] = acc_a['under'] + acc_b['under']
+    accumulator['over'] = acc_a['over'] + acc_b['over']
+    n = acc_a['n'] + acc_b['n']
+    if n > 0:
+        delta = acc_b['mean'] - acc_a['mean']
+        accumulator['n'] = n
+        accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+        accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+    return accumulator
+
+
+# Saves histogram accumulator to .npz file
+def save_hist_accumulator(accumulator, file_name):
+    np.savez(file_name, **accumulator)
+
+
+# Reads histogram accumulator from .npz file
+def load_hist_accumulator(file_name):
+    myfile = np.load(file_name)
+    accumulator = {'edges': myfile['edges'], 'counts': myfile['counts'], 'under': int(myfile['under']),
+                   'over': int(myfile['over']), 'n': int(myfile['n']), 'mean': float(myfile['mean']),
+                   'm2': float(myfile['m2'])}
+    myfile.close()
+    return accumulator
+
+
+# Returns mean & standard deviation of all values added to histogram accumulator
+def hist_accumulator_stats(accumulator):
+    if accumulator['n'] == 0:
+        return np.nan, np.nan
+    return accumulator['mean'], np.sqrt(accumulator['m2'] / accumulator['n'])
+
+
+# Finds Gaussian fit of histogram in accumulator (starting from mean & standard deviation of all values)
+def fit_hist_accumulator(accumulator):
+    edges = accumulator['edges']
+    bins = (edges[:-1] + edges[1:]) / 2                 # Bin centers
+    mu, sigma = hist_accumulator_stats(accumulator)
+    return gauss_fit_bins(bins, accumulator['counts'], mu, sigma)
+
+
+# Fits histogram in accumulator, bootstraps fit from nfit resampled histograms, and queues plot of histogram with
+# Gaussian fit, returns fit parameters & bootstrap rows
+def plot_hist_accumulator(accumulator, dest_path, xaxis, title, units, filename, nfit=100):
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit)
+    mean, sd = hist_accumulator_stats(accumulator)
+    rows = bootstrap_rows(mean, sd, np.array([]), np.array([]), popt, params)
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
+
+    return popt, rows
+
+
+# Returns ' +/- ' and half width of bootstrap confidence interval in row, or '' if there is no interval
+def error_text(row):
+    name, value, low, high = row
+    if np.isnan(low) or np.isnan(high):
+        return ''
+    return ' +/- ' + str(float(format((high - low) / 2, '.1e')))
+
+
+# Queues plot of histogram in accumulator with Gaussian fit (uncertainties are half widths of bootstrap intervals)
+def queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename):
+    path = Path(Path(dest_path) / 'plots')
+    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
+    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
+
+    # Queues histogram with Gaussian fit (mean +/- 2sigma) to be plotted
+    queue_plot('histogram', path / str(filename + '.png'),
+               {'arrays': [], 'counts': [(accumulator['edges'], accumulator['counts'])],
+                'fits': [(bins_range, popt, 'red')], 'xlabel': xaxis + ' (' + units + ')', 'fontsize': 'large',
+                'title': title + ' of SPE\n mean: ' + str(mu2) + error_text(rows[2]) + ' ' + units + ', SD: ' +
+                         str(sigma2) + error_text(rows[3]) + ' ' + units})
+
+
+# BOOTSTRAP
+
+
+# Resamples array with replacement nboot times, using matrices of random indices (at most max_size values at a time),
+# and returns mean & standard deviation of each resample (drawn with random generator rng, or a new one if rng is None)
+def bootstrap_stats(array, nboot=1000, max_size=10000000, rng=None):
+    rng = np.random.default_rng(rng)
+    array = np.asarray(array, dtype=float)
+    n = len(array)
+    center = np.mean(array)
+    array = array - center                      # Centered so that standard deviation does not lose precision
+    means = np.zeros(nboot)
+    sds = np.zeros(nboot)
+    chunk = max(1, min(nboot, max_size // max(n, 1)))
+
+    for j in range(0, nboot, chunk):
+        idx = rng.integers(0, n, (min(chunk, nboot - j), n))            # Each row is one resample
+        samples = array[idx]
+        means_j = np.mean(samples, axis=1)
+        means[j:j + len(idx)] = means_j + center
+        sds[j:j + len(idx)] = np.sqrt(np.maximum(np.mean(samples ** 2, axis=1) - means_j ** 2, 0))
+
+    return means, sds
+
+
+# Resamples histogram counts nboot times (multinomial, same as resampling the values in the histogram) and returns fit
+# parameters of Gaussian fit of each resampled histogram that could be fitted (one row per resample), starting each fit
+# from popt (resamples are drawn with random generator rng, or a new one if rng is None)
+def bootstrap_fit(bins, n, popt, nboot=100, rng=None):
+    n = np.asarray(n, dtype=float)
+    total = int(np.sum(n))
+    params = np.zeros((nboot, 3))
+    if total == 0 or nboot == 0:
+        return params[:0]
+    resamples = np.random.default_rng(rng).multinomial(total, n / total, size=nboot)
+
+    for j in range(nboot):
+        try:
+            bins_range, params[j], pcov = gauss_fit_bins(bins, resamples[j], popt[1], popt[2])
+            if not np.all(np.isfinite(pcov)):
+                params[j] = np.nan
+        except RuntimeError:
+            params[j] = np.nan
+
+    # Resamples that could not be fitted are dropped so they do not narrow confidence intervals
+    fitted = np.all(np.isfinite(params), axis=1)
+    if not np.all(fitted):
+        print('Dropped %d of %d bootstrap fits that could not be fitted' % (nboot - np.count_nonzero(fitted), nboot))
+
+    return params[fitted]
+
+
+# Returns lower & upper limits of central confidence interval (cl in %) of bootstrap values
+def confidence_interval(values, cl=68.27):
+    return np.percentile(values, 50 - cl / 2, axis=0), np.percentile(values, 50 + cl / 2, axis=0)
+
+
+# Returns rows of (name, value, lower limit, upper limit) of central confidence intervals (cl in %) of mean & standard
+# deviation of values (from bootstrap means & sds) and of mean & standard deviation of Gaussian fit (from params)
+def bootstrap_rows(mean, sd, means, sds, popt, params, cl=68.27):
+    values = [('mean', mean, means), ('sd', sd, sds), ('fit_mean', popt[1], params[:, 1]),
+              ('fit_sd', np.abs(popt[2]), np.abs(params[:, 2]))]
+    rows = []
+    for name, value, resampled in values:
+        if len(resampled) > 0:
+            low, high = confidence_interval(resampled, cl)
+        else:
+            low, high = np.nan, np.nan
+        rows.append((name, float(value), float(low), float(high)))
+    return rows
+
+
+# Saves bootstrap confidence intervals of a histogram
+def save_bootstrap(rows, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('name,value,low,high\n')
+    for name, value, low, high in rows:
+        myfile.write('%s,%s,%s,%s\n' % (name, str(value), str(low), str(high)))
+    myfile.close()
+
+
+# Writes table with number of values (in, below & above bins) and bootstrap confidence intervals of each histogram
+def write_hist_summary(summary, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('histogram,n,under,over')
+    for name in ['mean', 'sd', 'fit_mean', 'fit_sd']:
+        myfile.write(',%s,%s_low,%s_high' % (name, name, name))
+    myfile.write('\n')
+    for filename, accumulator, rows in summary:
+        myfile.write('%s,%d,%d,%d' % (filename, accumulator['n'], accumulator['under'], accumulator['over']))
+        for name, value, low, high in rows:
+            myfile.write(',%s,%s,%s' % (str(value), str(low), str(high)))
+        myfile.write('\n')
+    myfile.close()
+
+
+# PLOTTING
+
+
+plot_queue = []         # Plots waiting to be rendered by render_plots
+
+
+# Adds a plot to plot queue (kind is 'histogram' or 'waveform', and data holds what is needed to draw it)
+def queue_plot(kind, file_name, data):
+    plot_queue.append((kind, str(file_name), data))
+
+
+# Draws a queued plot with the non-interactive Agg backend and saves it
+def draw_plot(kind, file_name, data, dpi):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    if kind == 'histogram':
+        for array in data['arrays']:
+            plt.hist(array, data['nbins'])                                  # Plots histogram
+        for edges, counts in data.get('counts', []):
+            plt.hist(edges[:-1], edges, weights=counts)                     # Plots histogram from accumulator
+        for bins_range, popt, color in data['fits']:
+            plt.plot(bins_range, func(bins_range, *popt), color=color)      # Plots Gaussian fit (mean +/- 2sigma)
+        plt.xlabel(data['xlabel'])
+        plt.title(data['title'], fontsize=data['fontsize'])
+    if kind == 'waveform':
+        plt.plot(data['t'], data['v'])
+        plt.fill_between(data['t'], data['v_low'], data['v_high'], alpha=0.3)     # Plots band with 68% of waveforms
+        plt.xlabel('Time (s)')
+        plt.ylabel('Normalized Voltage')
+        plt.title(data['title'])
+    plt.savefig(file_name, dpi=dpi)
+    plt.close()
+
+
+# Renders queued plots in nworkers processes and empties plot queue
+def render_plots(dpi=360, nworkers=1):
+    plots = [(kind, file_name, data, dpi) for kind, file_name, data in plot_queue]
+    del plot_queue[:]
+    print('Rendering %d plots' % len(plots))
+    if nworkers > 1 and len(plots) > 1:
+        pool = Pool(min(nworkers, len(plots)))
+        pool.starmap(draw_plot, plots)
+        pool.close()
+        pool.join()
+    else:
+        for plot in plots:
+            draw_plot(*plot)
+
+
+# Empties plot queue without rendering (for runs with no plots)
+def clear_plots():
+    del plot_queue[:]
+
+
+# WAVEFORM ACCUMULATOR
+
+
+# Creates accumulator for mean & variance of waveforms (Welford's method) that also keeps a random sample of up to keep
+# waveforms for percentile bands
+def init_accumulator(keep=500):
+    accumulator = {'n': 0, 'mean': None, 'm2': None, 'keep': keep, 'reservoir': None, 'n_res': 0}
+    return accumulator
+
+
+# Adds a waveform (1-D array) or block of waveforms (2-D array, one waveform per row) to accumulator, sampling its
+# reservoir with random generator rng (a new one if rng is None)
+def update_accumulator(accumulator, v, rng=None):
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    n_b = len(v)
+    if n_b == 0:
+        return accumulator
+    if accumulator['mean'] is None:
+        accumulator['mean'] = np.zeros(v.shape[1])
+        accumulator['m2'] = np.zeros(v.shape[1])
+        accumulator['reservoir'] = np.zeros((accumulator['keep'], v.shape[1]))
+
+    # Combines mean & sum of squared differences of block with those of accumulator (Chan et al.)
+    mean_b = np.mean(v, axis=0)
+    m2_b = np.sum((v - mean_b) ** 2, axis=0)
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    # Keeps each waveform in reservoir with probability keep / n
+    rng = np.random.default_rng(rng)
+    for j in range(n_b):
+        if accumulator['n_res'] < accumulator['keep']:
+            accumulator['reservoir'][accumulator['n_res']] = v[j]
+            accumulator['n_res'] += 1
+        else:
+            k = rng.integers(0, n_a + j + 1)
+            if k < accumulator['keep']:
+                accumulator['reservoir'][k] = v[j]
+
+    return accumulator
+
+
+# Adds each waveform from an iterable of waveforms (list of arrays, generator, or 2-D array) to accumulator
+def accumulate_waveforms(accumulator, waveforms, rng=None):
+    rng = np.random.default_rng(rng)
+    for v in waveforms:
+        update_accumulator(accumulator, v, rng)
+    return accumulator
+
+
+# Combines two accumulators (e.g. from different workers) into a new accumulator, sampling its reservoir with random
+# generator rng (a new one if rng is None)
+def merge_accumulators(acc_a, acc_b, rng=None):
+    if acc_a['n'] == 0:
+        return acc_b
+    if acc_b['n'] == 0:
+        return acc_a
+    accumulator = init_accumulator(max(acc_a['keep'], acc_b['keep']))
+    n = acc_a['n'] + acc_b['n']
+    delta = acc_b['mean'] - acc_a['mean']
+    accumulator['n'] = n
+    accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+    accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+
+    # Combines reservoirs, choosing waveforms from each in proportion to number of waveforms each reservoir stands for
+    res = np.concatenate((acc_a['reservoir'][:acc_a['n_res']], acc_b['reservoir'][:acc_b['n_res']]))
+    weights = np.concatenate((np.full(acc_a['n_res'], acc_a['n'] / acc_a['n_res']),
+                              np.full(acc_b['n_res'], acc_b['n'] / acc_b['n_res'])))
+    n_res = min(accumulator['keep'], len(res))
+    idx = np.random.default_rng(rng).choice(len(res), n_res, replace=False, p=weights / np.sum(weights))
+    accumulator['reservoir'] = np.zeros((accumulator['keep'], res.shape[1]))
+    accumulator['reservoir'][:n_res] = res[idx]
+    accumulator['n_res'] = n_res
+
+    return accumulator
+
+
+# Returns mean, standard deviation, and lower & upper percentile bands of waveforms in accumulator
+def accumulator_stats(accumulator, low=15.87, high=84.13):
+    n = accumulator['n']
+    if n == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    mean = accumulator['mean']
+    if n > 1:
+        sd = np.sqrt(accumulator['m2'] / (n - 1))
+    else:
+        sd = np.zeros(len(mean))
+    res = accumulator['reservoir'][:accumulator['n_res']]
+    band_low = np.percentile(res, low, axis=0)
+    band_high = np.percentile(res, high, axis=0)
+
+    return mean, sd, band_low, band_high
+
+
 # AVERAGE/PLOT WAVEFORM
 
 
-# Calculates average waveform of spe
-def average_waveform(array, dest_path, shaping, shaping_name, delay_path, delay_name, delay_folder, nhdr):
+# Returns index where averaging window of a waveform starts given its first time point t0, time step dt, and number of
+# points, or -1 if waveform does not have n_before points before t = 0 and length points in total
+def window_index(t0, dt, n_before, length, array_length):
+    idx0 = int(round(-t0 / dt))                     # Finds index of t = 0 point
+    idx_start = idx0 - n_before
+    if idx_start < 0 or idx_start + length > array_length - 1:
+        return -1
+    return idx_start
+
+
+# Chooses averaging window from a waveform file
+# Returns number of points before t = 0, number of points in window, and time step
+def average_window(file_name, nhdr):
+    t, v, hdr = rw(file_name, nhdr)
+    array_length = len(t)
+    dt = (t[-1] - t[0]) / (array_length - 1)
+    # Window from t = -25 ns that is 150 ns long
+    n_before = int(round(2.5e-8 / dt))
+    length = int(round(1.5e-7 / dt))
+    return n_before, length, dt
+
+
+# Reads a shard of waveform files and adds each aligned, normalized waveform to the accumulator of its group
+# jobs is a list of (group, file name) and windows holds number of points before t = 0 & window length of each group
+# Returns dictionary of accumulator for each group (reservoirs are sampled with a random generator seeded from seed)
+def average_shard(jobs, nhdr, windows, seed=None):
+    rng = np.random.default_rng(seed)
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of aligned waveforms
+    ks = {}
+
+    for group, file_name in jobs:
+        n_before, length = windows[group]
+        if group not in accs:
+            accs[group] = init_accumulator()
+            blocks[group] = np.empty((500, length))
+            ks[group] = 0
+        print('Reading file', Path(file_name).name)
+        t, v, hdr = rw(file_name, nhdr)             # Reads a waveform file
+        array_length = len(t)
+        dt = (t[-1] - t[0]) / (array_length - 1)
+        idx_start = window_index(t[0], dt, n_before, length, array_length)
+        # Only averages waveform files that have enough points before t = 0 & after the spe
+        if idx_start >= 0:
+            k = ks[group]
+            blocks[group][k] = v[idx_start:idx_start + length]
+            blocks[group][k] /= min(v)              # Normalizes voltages
+            ks[group] = k + 1
+            if ks[group] == len(blocks[group]):     # Adds full block of waveforms to accumulator
+                update_accumulator(accs[group], blocks[group], rng)
+                ks[group] = 0
+    for group in accs:
+        update_accumulator(accs[group], blocks[group][:ks[group]], rng)
+
+    return accs
+
+
+# Averages waveform files of every group in one pass, splitting them into one shard per worker process and merging the
+# accumulators at the end (jobs is a list of (group, file name))
+# Returns dictionaries of accumulator and time array of average waveform for each group
+def average_files(jobs, nhdr, nworkers=1):
+    windows = {}
+    times = {}
+    for group, file_name in jobs:                   # Chooses window of each group from its first file
+        if group not in windows:
+            n_before, length, dt = average_window(file_name, nhdr)
+            windows[group] = (n_before, length)
+            times[group] = (np.arange(length) - n_before) * dt
+
+    if nworkers > 1 and len(jobs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(jobs[j * len(jobs) // nworkers:(j + 1) * len(jobs) // nworkers], nhdr, windows, seeds[j])
+                  for j in range(nworkers)]
+        pool = Pool(nworkers)
+        shard_accs = pool.starmap(average_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        shard_accs = [average_shard(jobs, nhdr, windows)]
+
+    accs = {}
+    for group in windows:
+        accs[group] = init_accumulator()
+        for shard_acc in shard_accs:
+            if group in shard_acc:
+                accs[group] = merge_accumulators(accs[group], shard_acc[group])
+
+    return accs, times
+
+
+# Calculates average waveforms of double spe for a list of (file array, shaping, shaping name, delay path, delay name,
+# delay folder) groups, reading the waveform files of every group in one pass
+def average_waveforms(groups, dest_path, nhdr, nworkers=1):
+    folder_files = {}
+    for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+        folder_files[(delay_folder, shaping)] = set(os.listdir(delay_path))
+
+    jobs = []
+    for j in range(max([len(group[0]) for group in groups])):
+        for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+            if j < len(array):
+                file_name = 'D2--waveforms--%s.txt' % array[j]
+                if file_name in folder_files[(delay_folder, shaping)]:
+                    jobs.append(((delay_folder, shaping), str(delay_path / file_name)))
+
+    # Reads and averages waveforms in nworkers processes
+    accs, times = average_files(jobs, nhdr, nworkers)
+
+    for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+        group = (delay_folder, shaping)
+        if group in accs and accs[group]['n'] > 0:
+            save_average(accs[group], times[group], dest_path, shaping, shaping_name, delay_name, delay_folder)
+        else:
+            print('No ' + delay_folder + ' ' + shaping + ' waveforms to average')
+
+
+# Calculates average waveform of double spe for one shaping & delay
+def average_waveform(array, dest_path, shaping, shaping_name, delay_path, delay_name, delay_folder, nhdr,
+                     nworkers=1):
+    average_waveforms([(array, shaping, shaping_name, delay_path, delay_name, delay_folder)], dest_path, nhdr,
+                      nworkers)
+
+
+# Plots and saves average waveform & standard deviation of waveforms for a shaping & delay
+def save_average(acc, t_avg, dest_path, shaping, shaping_name, delay_name, delay_folder):
     save_file = Path(dest_path / 'plots')
-    tsum = 0
-    vsum = 0
-    n = 0
 
-    for item in array:
-        file_name = 'D2--waveforms--%s.txt' % item
-        if os.path.isfile(delay_path / file_name):
-            print('Reading file #', item)
-            t, v, hdr = rw(delay_path / file_name, nhdr)    # Reads a waveform file
-            v = v / min(v)                                  # Normalizes voltages
-            try:
-                idx = np.where(t == 0)                      # Finds index of t = 0 point
-                idx = int(idx[0])
-                t = np.roll(t, -idx)                        # Rolls time array so that t = 0 point is at index 0
-                v = np.roll(v, -idx)                        # Rolls voltage array so that 50% max point is at index 0
-                idx2 = int(np.where(t == min(t))[0])        # Finds index of point of minimum t
-                idx3 = int(np.where(t == max(t))[0])        # Finds index of point of maximum t
-                idx_low = int(np.where(t == -2.5e-8)[0])
-                idx_high = int(np.where(t == 1.5e-7)[0])
-                # Only averages waveform files that have enough points before t = 0 & after the spe
-                if idx2 <= idx_low:
-                    # Removes points between point of maximum t & chosen minimum t in time & voltage arrays
-                    t = np.concatenate((t[:idx3], t[idx_low:]))
-                    v = np.concatenate((v[:idx3], v[idx_low:]))
-                    # Rolls time & voltage arrays so that point of chosen minimum t is at index 0
-                    t = np.roll(t, -idx3)
-                    v = np.roll(v, -idx3)
-                    if len(t) >= idx_high:
-                        # Removes points after chosen point of maximum t in time & voltage arrays
-                        t = t[:idx_high]
-                        v = v[:idx_high]
-                        # Sums time & voltage arrays
-                        tsum += t
-                        vsum += v
-                        n += 1
-            except Exception:
-                pass
-    # Finds average time & voltage arrays
-    t_avg = tsum / n
-    v_avg = vsum / n
-    v_avg = v_avg / max(v_avg)
-
-    # Plots average waveform & saves image
-    plt.plot(t_avg, v_avg)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveform (' + delay_name + ', ' + shaping_name + ')')
-    plt.savefig(save_file / str('avg_waveform_double_' + delay_folder + "_" + shaping + '.png'), dpi=360)
+    # Finds average voltage array and standard deviation & 68% band of voltage arrays
+    v_avg, v_sd, v_low, v_high = accumulator_stats(acc)
+    v_max = max(v_avg)
+    v_avg, v_sd, v_low, v_high = v_avg / v_max, v_sd / v_max, v_low / v_max, v_high / v_max
 
     # Saves average waveform data
     file_name = dest_path / 'hist_data_double' / str('avg_waveform_' + delay_folder + "_" + shaping + '.txt')
     hdr = 'Average Waveform\n\n\n\nTime,Ampl'
     ww(t_avg, v_avg, file_name, hdr)
+    ww(t_avg, v_sd, str(file_name)[:-4] + '_sd.txt', 'Waveform Standard Deviation\n\n\n\nTime,Ampl')
 
-    plt.close()
+    # Queues average waveform & 68% band to be plotted
+    queue_plot('waveform', save_file / str('avg_waveform_double_' + delay_folder + "_" + shaping + '.png'),
+               {'t': t_avg, 'v': v_avg, 'v_low': v_low, 'v_high': v_high,
+                'title': 'Average Waveform (' + delay_name + ', ' + shaping_name + ')'})
 
 
 # Shows a waveform plot to user
 def show_waveform(file_name, version):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(file_name, 5)
     print("\nHeader:\n\n" + str(hdr))
     plt.plot(t, v)
@@ -225,9 +743,10 @@ def calculate_t1_t2(t, v):
     idx1 = np.inf
     idx2 = np.inf
     idx3 = np.inf
+    v_min = min(v)                  # Minimum voltage (found once instead of at every point)
 
     for i in range(len(v) - 1):
-        if v[i] <= 0.1 * min(v):
+        if v[i] <= 0.1 * v_min:
             idx1 = i
             break
         else:
@@ -237,7 +756,7 @@ def calculate_t1_t2(t, v):
         return 0, -1
     else:
         for i in range(idx1, len(v) - 1):
-            if v[i] == min(v):
+            if v[i] == v_min:
                 idx2 = i
                 break
             else:
@@ -246,7 +765,7 @@ def calculate_t1_t2(t, v):
             return 0, -1
         else:
             for i in range(len(v) - 1, idx2, -1):
-                if v[i] <= 0.1 * min(v):
+                if v[i] <= 0.1 * v_min:
                     idx3 = i
                     break
                 else:
@@ -263,9 +782,10 @@ def calculate_t1_t2_add(t, v):
     idx1 = np.inf
     idx2 = np.inf
     idx3 = np.inf
+    v_min = min(v)                  # Minimum voltage (found once instead of at every point)
 
     for i in range(len(v) - 1):
-        if v[i] <= 0.05 * min(v):
+        if v[i] <= 0.05 * v_min:
             idx1 = i
             break
         else:
@@ -275,7 +795,7 @@ def calculate_t1_t2_add(t, v):
         return 0, -1
     else:
         for i in range(idx1, len(v) - 1):
-            if v[i] == min(v):
+            if v[i] == v_min:
                 idx2 = i
                 break
             else:
@@ -284,7 +804,7 @@ def calculate_t1_t2_add(t, v):
             return 0, -1
         else:
             for i in range(idx2, len(v) - 1):
-                if v[i] >= 0.05 * min(v):
+                if v[i] >= 0.05 * v_min:
                     idx3 = i
                     break
                 else:
@@ -302,14 +822,14 @@ def calculate_average(t, v):
     t1, t2 = calculate_t1_t2(t, v)
 
     try:
-        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0] - (.1 * len(t)))):
+        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0][0] - (.1 * len(t)))):
             v_sum += v[i]
 
-        for i in range(int(np.where(t == t2)[0] + (.1 * len(t))), int(.95 * len(t))):
+        for i in range(int(np.where(t == t2)[0][0] + (.1 * len(t))), int(.95 * len(t))):
             v_sum += v[i]
 
-        average = v_sum / ((int(np.where(t == t1)[0] - (.1 * len(t))) - int(.05 * len(t))) +
-                           (int(.95 * len(t)) - int(np.where(t == t2)[0] + (.1 * len(t)))))
+        average = v_sum / ((int(np.where(t == t1)[0][0] - (.1 * len(t))) - int(.05 * len(t))) +
+                           (int(.95 * len(t)) - int(np.where(t == t2)[0][0] + (.1 * len(t)))))
 
         return average
 
@@ -342,15 +862,116 @@ def rise_time(t, v, low, high):
 
 
 # Puts voltage array through a lowpass filter given a tau and sample rate
-def lowpass_filter(v, tau, fsps):
-    v_filtered = np.array([])
+# Filter is the single pole recursion v_filtered[i] = alpha * v[i] + (1 - alpha) * v_filtered[i - 1], starting from
+# v_filtered[0] = v[0], applied along axis of v so a matrix of waveforms can be filtered at once
+# If out is v, filters in place
+def lowpass_filter(v, tau, fsps, axis=-1, out=None):
+    from scipy.signal import lfilter
+    v = np.asarray(v, dtype=float)
+    if out is None:
+        out = np.empty_like(v)
+    if v.shape[axis] == 0:
+        return out
     alpha = 1 - np.exp(-1. / (fsps * tau))
-    for i in range(len(v)):
-        if i == 0:
-            v_filtered = np.append(v_filtered, v[i])
+    v_moved = np.moveaxis(v, axis, 0)
+    out_moved = np.moveaxis(out, axis, 0)
+    first = v_moved[:1].copy()                  # First sample passes through unchanged
+    rest, zf = lfilter([alpha], [1., alpha - 1], v_moved[1:], axis=0, zi=(1 - alpha) * first)
+    out_moved[0] = first[0]
+    out_moved[1:] = rest
+    return out
+
+
+# Shapes voltage array with n RC lowpass stages (rc), or with a CR highpass stage followed by n RC lowpass stages
+# (crrc), all with the same tau
+def shape_filter(v, tau, fsps, kind='rc', order=1, axis=-1):
+    v = np.asarray(v, dtype=float)
+    if kind == 'crrc':
+        v = v - lowpass_filter(v, tau, fsps, axis)
+    for j in range(order):
+        v = lowpass_filter(v, tau, fsps, axis)
+    return v
+
+
+# Shapes voltage array with each tau in turn, each shaping starting from the last one (before gain), and returns list
+# of shaped voltage arrays
+# Filters are single RC stages unless ladder (levels after the unshaped one) is given
+# method is 'recursive' (filters in time domain), 'fft' (filters in frequency domain), or 'auto' (whichever is faster)
+def shaping_cascade(v, tau_list, fsps, axis=-1, ladder=None, method='auto'):
+    if method == 'auto':
+        method = shaping_engine(v, tau_list, fsps, axis, ladder)
+    if method == 'fft':
+        return shaping_cascade_fft(v, tau_list, fsps, axis, ladder)
+
+    v_list = []
+    for j in range(len(tau_list)):
+        if ladder is None:
+            v = lowpass_filter(v, tau_list[j], fsps, axis)
         else:
-            v_filtered = np.append(v_filtered, v[i] * alpha + (1 - alpha) * v_filtered[i - 1])
-    return v_filtered
+            v = shape_filter(v, tau_list[j], fsps, ladder[j][2], ladder[j][3], axis)
+        v_list.append(v)
+    return v_list
+
+
+# Returns transfer function of single pole lowpass filter (starting from 0) given z^-1 at each frequency
+def lowpass_response(tau, fsps, z_inv):
+    alpha = 1 - np.exp(-1. / (fsps * tau))
+    return alpha / (1 - (1 - alpha) * z_inv)
+
+
+# Shapes voltage array the same way as shaping_cascade, but transforms it once with FFT, multiplies by transfer function
+# of each shaping in turn, and transforms each shaping back
+# Filters start from first voltage (as lowpass_filter does), so first voltage is taken off before transforming and put
+# back after (except after a CR stage, which starts from 0)
+# Waveform is zero padded until impulse response of every stage has died away (to 1e-13) so it does not wrap around
+def shaping_cascade_fft(v, tau_list, fsps, axis=-1, ladder=None):
+    from scipy import fft
+    if ladder is None:
+        ladder = [('', 0., 'rc', 1)] * len(tau_list)
+    v = np.moveaxis(np.asarray(v, dtype=float), axis, -1)
+    length = v.shape[-1]
+    if length == 0:
+        return [np.moveaxis(v.copy(), -1, axis) for tau in tau_list]
+
+    pad = 0
+    for tau, level in zip(tau_list, ladder):
+        decay = max(np.exp(-1. / (fsps * tau)), 1e-300)         # Impulse response falls by decay each sample
+        pad += (level[3] + (level[2] == 'crrc')) * int(np.ceil(np.log(1e-13) / np.log(decay)))
+    nfft = fft.next_fast_len(length + pad, real=True)
+
+    offset = v[..., :1]
+    spectrum = fft.rfft(v - offset, nfft)
+    z_inv = np.exp(-2j * np.pi * np.arange(nfft // 2 + 1) / nfft)     # z^-1 at each frequency of rfft
+    v_list = []
+    for tau, level in zip(tau_list, ladder):
+        response = lowpass_response(tau, fsps, z_inv)
+        if level[2] == 'crrc':
+            spectrum = spectrum * (1 - response)
+            offset = np.zeros_like(offset)
+        spectrum = spectrum * response ** level[3]
+        v_list.append(np.moveaxis(fft.irfft(spectrum, nfft)[..., :length] + offset, -1, axis))
+    return v_list
+
+
+# Shaping engine found for each trace length, number of waveforms & shapings (used by shaping_cascade with 'auto')
+shaping_engines = {}
+
+
+# Returns faster shaping engine ('recursive' or 'fft') for waveforms like v, timing both the first time they are used
+# for its trace length, number of waveforms & shapings
+def shaping_engine(v, tau_list, fsps, axis=-1, ladder=None):
+    shape = np.shape(v)
+    key = (shape[axis], int(np.prod(shape)) // max(shape[axis], 1), tuple(tau_list), str(ladder))
+    if key not in shaping_engines:
+        times = {}
+        for method in ['recursive', 'fft']:
+            shaping_cascade(v, tau_list, fsps, axis, ladder, method)        # Runs once first so imports are not timed
+            start_time = time.time()
+            for j in range(3):
+                shaping_cascade(v, tau_list, fsps, axis, ladder, method)
+            times[method] = time.time() - start_time
+        shaping_engines[key] = min(times, key=times.get)
+    return shaping_engines[key]
 
 
 # Calculates 10-90 rise time for each shaping and returns arrays of 10-90 rise times
@@ -407,63 +1028,119 @@ def func(x, a, b, c):
     return gauss
 
 
-# Finds Gaussian fit of array
+# Finds Gaussian fit of histogram (bin centers & counts) of array, starting from mean & standard deviation of array
 def gauss_fit(array, bins, n):
-    b_est, c_est = norm.fit(array)      # Calculates mean & standard deviation based on entire array
-    range_min1 = b_est - c_est          # Calculates lower limit of Gaussian fit (1sigma estimation)
-    range_max1 = b_est + c_est          # Calculates upper limit of Gaussian fit (1sigma estimation)
-
-    bins_range1 = np.linspace(range_min1, range_max1, 10000)    # Creates array of bins between upper & lower limits
-    n_range1 = np.interp(bins_range1, bins, n)              # Interpolates & creates array of y axis values
-    guess1 = [1, float(b_est), float(c_est)]                # Defines guess for values of a, b & c in Gaussian fit
-    popt1, pcov1 = curve_fit(func, bins_range1, n_range1, p0=guess1, maxfev=10000)      # Finds Gaussian fit
-    mu1 = float(format(popt1[1], '.2e'))                        # Calculates mean based on 1sigma guess
-    sigma1 = np.abs(float(format(popt1[2], '.2e')))     # Calculates standard deviation based on 1sigma estimation
-    range_min2 = mu1 - 2 * sigma1                       # Calculates lower limit of Gaussian fit (2sigma)
-    range_max2 = mu1 + 2 * sigma1                       # Calculates upper limit of Gaussian fit (2sigma)
-    bins_range2 = np.linspace(range_min2, range_max2, 10000)    # Creates array of bins between upper & lower limits
-    n_range2 = np.interp(bins_range2, bins, n)          # Interpolates & creates array of y axis values
-    guess2 = [1, mu1, sigma1]                           # Defines guess for values of a, b & c in Gaussian fit
-    popt2, pcov2 = curve_fit(func, bins_range2, n_range2, p0=guess2, maxfev=10000)      # Finds Gaussian fit
-
-    return bins_range2, popt2, pcov2
+    return gauss_fit_bins(bins, n, float(np.mean(array)), float(np.std(array)))
+
+
+# Finds Gaussian fit of histogram (bin centers & counts) by least squares on the bins, weighting each bin by its Poisson
+# error, first within 1 sigma of mean mu and then within 2 sigma of the last fit until fit stops changing
+# Uncertainties of fit parameters are square roots of diagonal of pcov
+# Raises RuntimeError if there are not enough bins to fit or the first fit does not converge
+def gauss_fit_bins(bins, n, mu, sigma):
+    from scipy.optimize import curve_fit
+    bins = np.asarray(bins, dtype=float)
+    n = np.asarray(n, dtype=float)
+    width = 1                                   # Fits within 1 sigma first (estimation), then 2 sigma
+    fitted = False
+
+    for j in range(10):
+        in_range = (bins >= mu - width * sigma) & (bins <= mu + width * sigma)
+        if np.count_nonzero(in_range) < 4:      # Not enough bins to fit
+            break
+        guess = [np.max(n[in_range]), mu, sigma]                # Defines guess for values of a, b & c
+        try:
+            popt, pcov = curve_fit(func, bins[in_range], n[in_range], p0=guess,
+                                   sigma=np.sqrt(np.maximum(n[in_range], 1)), absolute_sigma=True, maxfev=1000)
+        except RuntimeError:
+            break
+        fitted = True
+        popt[2] = np.abs(popt[2])
+        done = width == 2 and np.abs(popt[1] - mu) < 1e-3 * sigma and np.abs(popt[2] - sigma) < 1e-3 * sigma
+        mu = float(popt[1])
+        sigma = float(popt[2])
+        width = 2
+        if done:
+            break
+    if not fitted:
+        raise RuntimeError('Could not fit Gaussian to histogram (mean %.2e, SD %.2e)' % (mu, sigma))
 
+    bins_range = np.linspace(mu - 2 * sigma, mu + 2 * sigma, 1000)      # Creates array of x values within 2 sigma
 
-# Creates histogram given an array
-def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename):
+    return bins_range, popt, pcov
 
-    path = Path(Path(dest_path) / 'plots')
-    n, bins, patches = plt.hist(array, nbins)           # Plots histogram
-    bins = np.delete(bins, len(bins) - 1)
-    bins_diff = bins[1] - bins[0]
-    bins = np.linspace(bins[0] + bins_diff / 2, bins[len(bins) - 1] + bins_diff / 2, len(bins))
 
-    bins_range, popt, pcov = gauss_fit(array, bins, n)                  # Finds Gaussian fit
-    plt.plot(bins_range, func(bins_range, *popt), color='red')          # Plots Gaussian fit (mean +/- 2sigma)
+# Shapings histograms are made for: (file name suffix, name in titles)
+hist_shapings = [('1', 'No Shaping'), ('2', '2x Shaping'), ('4', '4x Shaping'), ('8', '8x Shaping')]
 
-    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
-    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
 
-    plt.xlabel(xaxis + ' (' + units + ')')
-    plt.title(title + ' of SPE\n mean: ' + str(mu2) + ' ' + units + ', SD: ' + str(sigma2) + ' ' + units)
-    plt.savefig(path / str(filename + '.png'), dpi=360)         # Plots histogram with Gaussian fit
+# Histogram specifications for p2 double calculations: (column of results table, file name, x axis label, title, units,
+# number of bins) for 10-90 rise time of each shaping
+def p2_hist_specs(nbins, delay_name, delay_folder):
+    specs = []
+    for n, shaping_name in hist_shapings:
+        specs.append(('rt_' + n, delay_folder + '_rt_' + n + '_double', 'Time',
+                      '10-90 Rise Time (' + delay_name + ', ' + shaping_name + ')', 's', nbins))
+    return specs
+
+
+# Bins array into histogram accumulator, finds Gaussian fit, and bootstraps mean, SD & fit (can run in worker process,
+# with resamples drawn from a random generator seeded from seed)
+def fit_histogram(array, nbins, nboot=1000, nfit=100, seed=None):
+    rng = np.random.default_rng(seed)
+    accumulator = init_hist_accumulator(hist_edges(array, nbins))
+    update_hist_accumulator(accumulator, array)
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit, rng)
+    means, sds = bootstrap_stats(array, nboot, rng=rng)
+    rows = bootstrap_rows(np.mean(array), np.std(array), means, sds, popt, params)
+
+    return accumulator, bins_range, popt, rows
+
 
+# Saves histogram data, histogram accumulator & bootstrap intervals of fitted histogram and queues its plot
+def save_histogram(array, result, dest_path, xaxis, title, units, filename):
+    accumulator, bins_range, popt, rows = result
     write_hist_data(array, dest_path, filename + '.txt')
+    save_hist_accumulator(accumulator, Path(dest_path) / 'hist_data_double' / str(filename + '.npz'))
+    save_bootstrap(rows, Path(dest_path) / 'hist_data_double' / str(filename + '_bootstrap.txt'))
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
 
-    plt.close()
+
+# Creates histogram given an array
+def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename):
+    save_histogram(array, fit_histogram(array, nbins), dest_path, xaxis, title, units, filename)
+
+
+# Makes histograms of columns of results table (dict of arrays) given by specs ((column, file name, x axis label, title,
+# units, number of bins)), fitting them in nworkers processes, then saves them and writes one summary table
+def hist_batch(table, specs, dest_path, summary_name, nworkers=1):
+    seeds = np.random.SeedSequence().spawn(len(specs))      # Independent random streams of histograms
+    jobs = [(table[spec[0]], spec[5], 1000, 100, seed) for spec, seed in zip(specs, seeds)]
+    if nworkers > 1 and len(jobs) > 1:
+        pool = Pool(min(nworkers, len(jobs)))
+        results = pool.starmap(fit_histogram, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [fit_histogram(*job) for job in jobs]
+
+    summary = []
+    for (column, filename, xaxis, title, units, nbins), result in zip(specs, results):
+        save_histogram(table[column], result, dest_path, xaxis, title, units, filename)
+        summary.append((filename, result[0], result[3]))
+    write_hist_summary(summary, Path(dest_path) / 'hist_data_double' / summary_name)
+
+    return dict(zip([spec[1] for spec in specs], results))
 
 
 # Plots histograms for each calculation array
-def p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, dest_path, bins, delay_name, delay_folder):
+def p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, dest_path, bins, delay_name, delay_folder, nworkers=1):
     print('Creating histograms...')
-    plot_histogram(rt_1_array, dest_path, bins, 'Time', '10-90 Rise Time (' + delay_name + ', No Shaping)', 's',
-                   delay_folder + '_rt_1_double')
-    plot_histogram(rt_2_array, dest_path, bins, 'Time', '10-90 Rise Time (' + delay_name + ', 2x Shaping)', 's',
-                   delay_folder + '_rt_2_double')
-    plot_histogram(rt_4_array, dest_path, bins, 'Time', '10-90 Rise Time (' + delay_name + ', 4x Shaping)', 's',
-                   delay_folder + '_rt_4_double')
-    plot_histogram(rt_8_array, dest_path, bins, 'Time', '10-90 Rise Time (' + delay_name + ', 8x Shaping)', 's',
-                   delay_folder + '_rt_8_double')
+    table = {'rt_1': rt_1_array, 'rt_2': rt_2_array, 'rt_4': rt_4_array, 'rt_8': rt_8_array}
+    hist_batch(table, p2_hist_specs(bins, delay_name, delay_folder), dest_path,
+               'hist_summary_' + delay_folder + '.txt', nworkers)
 
 
 # P2_CREATE_DOUBLE
@@ -552,7 +1229,7 @@ def make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8, dela
 
 
 # Makes arrays of existing single and double spe files
-def initial_arrays(single_path, filt_path1_s, delay_path1):
+def initial_arrays(single_path, filt_path1_s, delay_path1, ledger):
     single_file_array = np.array([])
     single_file_array2 = np.array([])
     double_file_array = np.array([])
@@ -560,7 +1237,7 @@ def initial_arrays(single_path, filt_path1_s, delay_path1):
     print('Checking single spe files...')
     for i in range(99999):                                  # Makes array of all spe file names
         file_name = 'D2--waveforms--%05d.txt' % i
-        if os.path.isfile(single_path / file_name):
+        if os.path.isfile(single_path / file_name) and check_rejected(ledger, '%05d' % i) == 'no':
             single_file_array = np.append(single_file_array, i)
 
     print('Checking existing single spe files...')
@@ -578,6 +1255,86 @@ def initial_arrays(single_path, filt_path1_s, delay_path1):
     return single_file_array, single_file_array2, double_file_array
 
 
+# Rounds times to 4 digits after the decimal point in scientific notation (the same as float(format(t, '.4e')))
+def round_times(t):
+    t = np.asarray(t, dtype=float)
+    exponent = np.floor(np.log10(np.abs(np.where(t == 0, 1., t))))
+    scale = 10. ** (4 - exponent)
+    return np.round(t * scale) / scale
+
+
+# Zeroes voltages of each row of v_matrix (spe waveforms on rounded time array t) before spe begins and from where spe
+# ends (found as in calculate_t1_t2_add) up to the last point
+# Returns matrix of zeroed waveforms & whether end of spe was found for each row
+def zero_tails(t, v_matrix):
+    v = np.array(v_matrix, dtype=float, ndmin=2)
+    n = v.shape[1]
+    v_min = np.min(v, axis=1)[:, np.newaxis]
+    cols = np.arange(n - 1)[np.newaxis, :]
+    inner = v[:, :n - 1]
+
+    below = inner <= 0.05 * v_min                               # Points past 5% of max
+    idx1 = np.argmax(below, axis=1)                             # Beginning of spe
+    at_min = (inner == v_min) & (cols >= idx1[:, np.newaxis])
+    found = np.any(below, axis=1) & np.any(at_min, axis=1)
+    idx2 = np.argmax(at_min, axis=1)                            # Minimum of spe
+    above = (inner >= 0.05 * v_min) & (cols >= idx2[:, np.newaxis])
+    idx3 = np.argmax(above, axis=1)                             # End of spe
+    valid = ~found | np.any(above, axis=1)
+
+    # Spes without a beginning & minimum are zeroed from t = 0 and from first point, as calculate_t1_t2_add gives 0, -1
+    start = np.where(found, np.searchsorted(t, t[idx1]), np.argmin(np.abs(t)))
+    end = np.where(found, np.searchsorted(t, t[idx3]), np.argmin(np.abs(t + 1)))
+    cols = np.arange(n)[np.newaxis, :]
+    v[(cols < start[:, np.newaxis]) | ((cols >= end[:, np.newaxis]) & (cols < n - 1))] = 0
+
+    return v, valid
+
+
+# Adds rows of v1_matrix & v2_matrix (waveforms on time arrays t1 & t2) with D = int(delay / dt) samples between them
+# The waveform whose time array starts first is delayed (the second one if they start at the same time), and the sum
+# is padded with zeros so both waveforms fit
+# Returns time array & matrix of summed waveforms
+def add_spe_kernel(t1, t2, v1_matrix, v2_matrix, delay):
+    t1 = round_times(t1)
+    t2 = round_times(t2)
+    v1 = np.array(v1_matrix, dtype=float, ndmin=2)
+    v2 = np.array(v2_matrix, dtype=float, ndmin=2)
+    if v1.shape != v2.shape:
+        raise ValueError('Waveforms to add must have the same number of points')
+
+    time_int = float(format(t1[1] - t1[0], '.4e'))
+    delay_amt = int(delay / time_int) * time_int
+    if t1[0] < t2[0]:
+        t1 = t1 + delay_amt
+    else:
+        t2 = t2 + delay_amt
+    k = int(round(abs(t2[0] - t1[0]) / time_int))              # Number of points between starts of waveforms
+
+    n = v1.shape[1]
+    v = np.zeros((v1.shape[0], n + k))
+    if t1[0] <= t2[0]:
+        v[:, :n] += v1
+        v[:, k:] += v2
+        t = np.concatenate((t1, round_times(t1[-1] + time_int * np.arange(1, k + 1))))
+    else:
+        v[:, k:] += v1
+        v[:, :n] += v2
+        t = np.concatenate((round_times(t1[0] - time_int * np.arange(k, 0, -1)), t1))
+
+    return t, v
+
+
+# Adds block of pairs of single spe waveforms (rows of v1_matrix on time array t1 & rows of v2_matrix on time array t2),
+# with second waveform of each pair zeroed outside its spe and both delayed as in add_spe_kernel
+# Returns time array, matrix of double spe waveforms & whether each pair could be added
+def add_spe_pairs(t1, t2, v1_matrix, v2_matrix, delay):
+    v2, valid = zero_tails(round_times(t2), v2_matrix)
+    t_sum, v_sum = add_spe_kernel(t1, t2, v1_matrix, v2, delay)
+
+    return t_sum, v_sum, valid
+
+
 # Adds two random spe files with a given delay
 def add_spe(single_file_array, double_file_array, delay, delay_path1, nloops, single_path, nhdr):
     if len(double_file_array) < nloops:
@@ -589,51 +1346,14 @@ def add_spe(single_file_array, double_file_array, delay, delay_path1, nloops, si
 
         t1, v1, hdr1 = rw(file_name_1, nhdr)
         t2, v2, hdr2 = rw(file_name_2, nhdr)
-        for j in range(len(t1)):
-            t1[j] = float(format(t1[j], '.4e'))
-        for j in range(len(t2)):
-            t2[j] = float(format(t2[j], '.4e'))
-
-        time_int = float(format(t1[1] - t1[0], '.4e'))
-        delay_amt = int(delay / time_int) * time_int
 
         try:
-            time_1, time_2 = calculate_t1_t2_add(t2, v2)
-
-            for i in range(int(np.argmin(np.abs(t2 - time_1)))):
-                v2[i] = 0
-
-            for i in range(int(np.argmin(np.abs(t2 - time_2))), len(v2) - 1):
-                v2[i] = 0
-
-            if min(t1) < min(t2):
-                t1 += delay_amt
-            else:
-                t2 += delay_amt
-
-            if min(t1) < min(t2):
-                idx1 = np.where(t1 == min(t2))[0][0]
-                for j in range(idx1):
-                    t1 = np.append(t1, float(format(max(t1) + time_int, '.4e')))
-                    t2 = np.insert(t2, 0, float(format(min(t2) - time_int, '.4e')))
-                    v1 = np.append(v1, 0)
-                    v2 = np.insert(v2, 0, 0)
-            elif min(t1) > min(t2):
-                idx2 = np.where(t2 == min(t1))[0][0]
-                for j in range(idx2):
-                    t1 = np.insert(t1, 0, float(format(min(t1) - time_int, '.4e')))
-                    t2 = np.append(t2, float(format(max(t2) + time_int, '.4e')))
-                    v1 = np.insert(v1, 0, 0)
-                    v2 = np.append(v2, 0)
-            else:
-                pass
-
-            t = t1
-            v = np.add(v1, v2)
-            file_name = 'D2--waveforms--%s.txt' % files_added
-            ww(t, v, delay_path1 / file_name, hdr1)
-            double_file_array = np.append(double_file_array, files_added)
-            print('Added files #%05d & #%05d' % (file_1, file_2))
+            t, v, valid = add_spe_pairs(t1, t2, v1, v2, delay)
+            if valid[0]:
+                file_name = 'D2--waveforms--%s.txt' % files_added
+                ww(t, v[0], delay_path1 / file_name, hdr1)
+                double_file_array = np.append(double_file_array, files_added)
+                print('Added files #%05d & #%05d' % (file_1, file_2))
 
         except Exception:
             pass
@@ -656,55 +1376,90 @@ def single_set(single_file_array, single_file_array2, nloops, single_path, filt_
     return single_file_array2
 
 
-# Calculates and saves waveforms with 1x, 2x, 4x, and 8x the rise time
-def shaping(save_name1, save_name2, save_name4, save_name8, item, fsps, nhdr):
-    tau_2 = 1.271e-08
-    tau_4 = 1.0479999999999999e-08
-    tau_8 = 2.7539999999999997e-08
-    factor2 = 2.6769456128607705
-    factor4 = 3.720902601689933
-    factor8 = 6.301083740858239
-
-    if os.path.isfile(save_name2):
-        print('File #%s in rt_2 folder' % item)
-    else:
-        if os.path.isfile(save_name1):
-            t1, v1, hdr = rw(save_name1, nhdr)
-            v2 = lowpass_filter(v1, tau_2, fsps)
-            v2_gain = v2 * factor2
-            t2 = t1
-            ww(t2, v2_gain, save_name2, hdr)
-            print('File #%s in rt_2 folder' % item)
-        else:
-            pass
-
-    if os.path.isfile(save_name4):
-        print('File #%s in rt_4 folder' % item)
-    else:
-        if os.path.isfile(save_name2):
-            t2, v2, hdr = rw(save_name2, nhdr)
-            v2 = v2 / factor2
-            v4 = lowpass_filter(v2, tau_4, fsps)
-            v4_gain = v4 * factor4
-            t4 = t2
-            ww(t4, v4_gain, save_name4, hdr)
-            print('File #%s in rt_4 folder' % item)
-        else:
-            pass
-
-    if os.path.isfile(save_name8):
-        print('File #%s in rt_8 folder' % item)
-    else:
-        if os.path.isfile(save_name4):
-            t4, v4, hdr = rw(save_name4, nhdr)
-            v4 = v4 / factor4
-            v8 = lowpass_filter(v4, tau_8, fsps)
-            v8_gain = v8 * factor8
-            t8 = t4
-            ww(t8, v8_gain, save_name8, hdr)
-            print('File #%s in rt_8 folder' % item)
-        else:
-            pass
+# Shaping levels after the unshaped one, as 10-90 rise time ratios to the unshaped waveform
+default_ladder = '2,4,8'
+
+
+# Makes list of shaping levels (name, rise time ratio, filter, number of RC stages) from comma separated levels, each
+# ratio[:rc|crrc[:stages]] (e.g. '1.5,3,6:crrc:2'), starting with the unshaped level
+# Each level is shaped from the level before it, so ratios must increase
+def parse_ladder(text):
+    ladder = [('1', 1., 'none', 0)]
+    for entry in text.split(','):
+        parts = entry.strip().split(':')
+        ratio = float(parts[0])
+        kind = 'rc'
+        order = 1
+        if len(parts) > 1:
+            kind = parts[1]
+        if len(parts) > 2:
+            order = int(parts[2])
+        if len(parts) > 3 or kind not in ['rc', 'crrc'] or order < 1 or ratio <= ladder[-1][1]:
+            raise ValueError('Invalid shaping level ' + entry + ' (must be ratio[:rc|crrc[:stages]] with increasing '
+                             'ratios)')
+        name = format(ratio, 'g')
+        if kind != 'rc' or order != 1:
+            name += '_' + kind + str(order)
+        ladder.append((name, ratio, kind, order))
+    return ladder
+
+
+# Checks that shaping ladder of calibration starts with the 2x, 4x, and 8x single RC shapings of the default ladder,
+# so taus of 2x, 4x, and 8x shapings shape unshaped waveforms through each other as they did in p2
+def default_levels(calibration):
+    try:
+        ladder = parse_ladder(calibration.get('ladder', ''))
+    except ValueError:
+        return False
+    return ladder[1:4] == parse_ladder(default_ladder)[1:]
+
+
+# Reads taus & gain factors of 2x, 4x, and 8x shapings from calibration file written by p2, checking that it was made
+# from the current average waveform & sample rate with the default shaping ladder
+# Returns lists of taus & gain factors, or None if there is no usable calibration file
+def load_calibration(save_path, dest_path, fsps):
+    calibration = read_calibration(Path(dest_path / 'calibration.txt'))
+    if calibration is None:
+        print('Error: No calibration file in d2 (run p2 first)')
+        return None
+    names = ['2', '4', '8']
+    if not default_levels(calibration) or \
+            not all('tau_' + name in calibration and 'factor_' + name in calibration for name in names):
+        print('Error: Calibration file does not start with 2x, 4x, and 8x shapings (run p2 with default shaping '
+              'ladder)')
+        return None
+    average_file = Path(save_path / 'd1' / 'hist_data' / 'avg_waveform_d1b.txt')
+    if os.path.isfile(average_file) and file_md5(average_file) != calibration.get('template_md5'):
+        print('Warning: Average waveform has changed since calibration (rerun p2 to update taus & gain factors)')
+    if calibration.get('fsps') != str(float(fsps)):
+        print('Warning: Calibration was made at ' + str(calibration.get('fsps')) + ' samples per second')
+
+    tau_list = [float(calibration['tau_' + name]) for name in names]
+    factor_list = [float(calibration['factor_' + name]) for name in names]
+    return tau_list, factor_list
+
+
+# Calculates and saves waveforms with 1x, 2x, 4x, and 8x the rise time using taus & gain factors of 2x, 4x, and 8x
+# shapings from calibration
+def shaping(save_name1, save_name2, save_name4, save_name8, item, tau_list, factor_list, fsps, nhdr):
+    tau_2, tau_4, tau_8 = tau_list
+    factor2, factor4, factor8 = factor_list
+
+    save_names = [save_name2, save_name4, save_name8]
+    shapings = ['rt_2', 'rt_4', 'rt_8']
+
+    # Reads rt_1 once and shapes it in memory (without rounding from files in between), then writes missing shapings
+    missing = [not os.path.isfile(save_name) for save_name in save_names]
+    if any(missing) and os.path.isfile(save_name1):
+        t, v1, hdr = rw(save_name1, nhdr)
+        v_list = shaping_cascade(v1, [tau_2, tau_4, tau_8], fsps)
+        for save_name, v, factor, write in zip(save_names, v_list, [factor2, factor4, factor8], missing):
+            if write:
+                ww(t, v * factor, save_name, hdr)
+
+    for shaping_name, save_name in zip(shapings, save_names):
+        if os.path.isfile(save_name):
+            print('File #%s in %s folder' % (item, shaping_name))
 
 
 def delay_names(delay_folder):
@@ -742,3 +1497,185 @@ def delay_names(delay_folder):
         delay_name = ''
 
     return delay_name
+
+
+# VIRTUAL DATASET
+
+
+# Shapings of double spe waveforms (unshaped, then 2x, 4x, and 8x the rise time)
+double_shapings = ['rt_1', 'rt_2', 'rt_4', 'rt_8']
+
+
+# Returns name of pair manifest file of a delay folder
+def manifest_name(dest_path, delay_folder):
+    return Path(dest_path / str('pairs_' + delay_folder + '.txt'))
+
+
+# Writes pair manifest of a virtual double spe data set (rows of seed, delay, delay folder & sample rate, then one row
+# of single spe file numbers for each pair)
+def write_manifest(file_name, manifest):
+    myfile = open(file_name, 'w', newline='')
+    csv_writer = csv.writer(myfile)
+    for name in ['seed', 'delay', 'delay_folder', 'fsps']:
+        csv_writer.writerow([name, manifest[name]])
+    csv_writer.writerow(['pairs', len(manifest['pairs'])])
+    for file_1, file_2 in manifest['pairs']:
+        csv_writer.writerow(['%05d' % file_1, '%05d' % file_2])
+    myfile.close()
+
+
+# Reads pair manifest into dict (pairs is an array of single spe file numbers), or returns None if there is no manifest
+def read_manifest(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    manifest = {}
+    pairs = []
+    for row in csv.reader(myfile):
+        if 'pairs' in manifest:
+            pairs.append([int(row[0]), int(row[1])])
+        else:
+            manifest[row[0]] = row[1]
+    myfile.close()
+    manifest['seed'] = int(manifest['seed'])
+    manifest['delay'] = float(manifest['delay'])
+    manifest['fsps'] = float(manifest['fsps'])
+    manifest['pairs'] = np.array(pairs, dtype=int).reshape(-1, 2)
+    return manifest
+
+
+# Reads pair manifest of a delay folder, or draws nloops random pairs of single spe files (from seed, or from a random
+# seed if seed is None) and saves them as the manifest if there is no manifest with this delay, sample rate & seed
+# Returns manifest dict with first nloops pairs
+def make_manifest(dest_path, delay_folder, single_file_array, nloops, delay, fsps, seed=None):
+    file_name = manifest_name(dest_path, delay_folder)
+    manifest = read_manifest(file_name)
+    if manifest is not None and manifest['delay'] == delay and manifest['fsps'] == fsps and \
+            len(manifest['pairs']) >= nloops and (seed is None or manifest['seed'] == seed):
+        print('Reading %d pairs from %s' % (nloops, file_name.name))
+    else:
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        random_state = np.random.RandomState(seed)
+        pairs = np.asarray(single_file_array, dtype=int)[random_state.randint(len(single_file_array), size=(nloops, 2))]
+        manifest = {'seed': seed, 'delay': delay, 'delay_folder': delay_folder, 'fsps': float(fsps), 'pairs': pairs}
+        write_manifest(file_name, manifest)
+        print('Saved %d pairs to %s (seed %d)' % (nloops, file_name.name, seed))
+    manifest['pairs'] = manifest['pairs'][:nloops]
+    return manifest
+
+
+# Generates double spe waveforms of the pairs in manifest on demand without writing them, reading each single spe file
+# once; pairs whose single spe waveforms have the same time arrays are added & shaped (with calibration taus & gain
+# factors of 2x, 4x, and 8x shapings) together in blocks of up to block pairs
+# Yields id, time array, and dict of waveform of each shaping in shapings for each pair that can be added
+def virtual_doubles(manifest, single_path, shapings, tau_list, factor_list, nhdr, block=500):
+    levels = [double_shapings.index(shaping) for shaping in shapings]
+    factors = [1.] + list(factor_list)
+    singles = {}
+    time_keys = {}
+    groups = {}
+    for file_1, file_2 in manifest['pairs']:
+        for item in [file_1, file_2]:
+            if item not in singles:
+                t, v, hdr = rw(str(single_path / 'D2--waveforms--%05d.txt') % item, nhdr)
+                singles[item] = (t, v)
+                time_keys[item] = round_times(t).tobytes()
+        # Pairs of missing files or files of different lengths are skipped as in add_spe
+        if len(singles[file_1][1]) == 0 or len(singles[file_1][1]) != len(singles[file_2][1]):
+            print('Could not add pair #%05d--%05d' % (file_1, file_2))
+            continue
+        key = (time_keys[file_1], time_keys[file_2])
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((file_1, file_2))
+
+    for key in groups:
+        pairs = groups[key]
+        t1 = singles[pairs[0][0]][0]
+        t2 = singles[pairs[0][1]][0]
+        for j in range(0, len(pairs), block):
+            block_pairs = pairs[j:j + block]
+            v1_matrix = np.array([singles[file_1][1] for file_1, file_2 in block_pairs])
+            v2_matrix = np.array([singles[file_2][1] for file_1, file_2 in block_pairs])
+            t, v, valid = add_spe_pairs(t1, t2, v1_matrix, v2_matrix, manifest['delay'])
+            v_list = [v] + shaping_cascade(v, tau_list[:max(levels)], manifest['fsps'])
+            for k in range(len(block_pairs)):
+                item = '%05d--%05d' % block_pairs[k]
+                # Spes with no end are skipped as in add_spe
+                if not valid[k]:
+                    print('Could not add pair #%s' % item)
+                    continue
+                yield item, t, dict((shaping, v_list[level][k] * factors[level]) for shaping, level in
+                                    zip(shapings, levels))
+
+
+# Calculates 10-90 rise times and adds aligned, normalized waveforms to accumulators for each shaping of the double spes
+# generated from manifest
+# Returns dicts of rise time array & accumulator for each shaping (reservoirs are sampled with a random generator seeded
+# from seed)
+def virtual_shard(manifest, single_path, tau_list, factor_list, nhdr, seed=None):
+    rng = np.random.default_rng(seed)
+    # Window from t = -25 ns that is 150 ns long
+    n_before = int(round(2.5e-8 * manifest['fsps']))
+    length = int(round(1.5e-7 * manifest['fsps']))
+    rts = {}
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of aligned waveforms
+    for shaping in double_shapings:
+        rts[shaping] = []
+        accs[shaping] = init_accumulator()
+        blocks[shaping] = np.empty((500, length))
+    k = 0
+
+    for item, t, v_dict in virtual_doubles(manifest, single_path, double_shapings, tau_list, factor_list, nhdr):
+        print('Calculating pair #%s' % item)
+        dt = (t[-1] - t[0]) / (len(t) - 1)
+        idx_start = window_index(t[0], dt, n_before, length, len(t))
+        for shaping in double_shapings:
+            v = v_dict[shaping]
+            rts[shaping].append(rise_time(t, v, 10, 90))
+            # Only averages waveforms that have enough points before t = 0 & after the spe
+            if idx_start >= 0:
+                blocks[shaping][k] = v[idx_start:idx_start + length] / min(v)
+        if idx_start >= 0:
+            k += 1
+            if k == len(blocks['rt_1']):            # Adds full blocks of waveforms to accumulators
+                for shaping in double_shapings:
+                    update_accumulator(accs[shaping], blocks[shaping], rng)
+                k = 0
+    for shaping in double_shapings:
+        update_accumulator(accs[shaping], blocks[shaping][:k], rng)
+
+    return dict((shaping, np.array(rts[shaping])) for shaping in double_shapings), accs
+
+
+# Calculates 10-90 rise times & average waveforms of each shaping of a virtual double spe data set in one pass over its
+# pairs, splitting them into one shard per worker process and merging the accumulators at the end
+# Returns dicts of rise time array, accumulator, and time array of average waveform for each shaping
+def virtual_arrays(manifest, single_path, tau_list, factor_list, nhdr, nworkers=1):
+    pairs = manifest['pairs']
+    if nworkers > 1 and len(pairs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(dict(manifest, pairs=pairs[j * len(pairs) // nworkers:(j + 1) * len(pairs) // nworkers]),
+                   single_path, tau_list, factor_list, nhdr, seeds[j]) for j in range(nworkers)]
+        pool = Pool(nworkers)
+        results = pool.starmap(virtual_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        results = [virtual_shard(manifest, single_path, tau_list, factor_list, nhdr)]
+
+    rt_arrays = {}
+    accs = {}
+    times = {}
+    n_before = int(round(2.5e-8 * manifest['fsps']))
+    length = int(round(1.5e-7 * manifest['fsps']))
+    for shaping in double_shapings:
+        rt_arrays[shaping] = np.concatenate([result[0][shaping] for result in results])
+        accs[shaping] = init_accumulator()
+        for result in results:
+            accs[shaping] = merge_accumulators(accs[shaping], result[1][shaping])
+        times[shaping] = (np.arange(length) - n_before) / manifest['fsps']
+
+    return rt_arrays, accs, times
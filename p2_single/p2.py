@@ -1,70 +1,68 @@
 from p2_functions import *
 
 
-# Creates data sets of spe waveforms with 2x, 4x, and 8x the initial rise times
-def p2(start, end, date, date_time, filter_band, nhdr, fsps, r, pmt_hv, gain, offset, trig_delay, amp, band, nfilter):
-    gen_path, save_path, data_path, initial_data, dest_path, filt_path1, filt_path2, filt_path4, filt_path8 =\
-        initialize_folders(date, filter_band)
-    make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8)
+# Creates data sets of spe waveforms shaped to each level of the shaping ladder (default 2x, 4x, and 8x the initial
+# rise times)
+def p2(start, end, date, date_time, filter_band, nhdr, fsps, r, pmt_hv, gain, offset, trig_delay, amp, band, nfilter,
+       nworkers=1, dpi=360, no_plots=False, ladder_text=default_ladder):
+    ladder = parse_ladder(ladder_text)
+    gen_path, save_path, data_path, initial_data, dest_path = initialize_folders(date, filter_band)
+    paths = level_paths(dest_path, ladder)
+    make_folders(dest_path, paths)
 
     print('Transferring files to rt_1 folder...')
     for i in range(start, end + 1):
         if os.path.isfile(Path(str((initial_data / 'D1--waveforms--%05d.txt')) % i)):
-            if os.path.isfile(str(filt_path1 / 'D2--waveforms--%05d.txt') % i):
+            if os.path.isfile(str(paths[0] / 'D2--waveforms--%05d.txt') % i):
                 pass
             else:
                 t, v, hdr = rw(Path(str((initial_data / 'D1--waveforms--%05d.txt')) % i), nhdr)
-                ww(t, v, str(filt_path1 / 'D2--waveforms--%05d.txt') % i, hdr)
+                ww(t, v, str(paths[0] / 'D2--waveforms--%05d.txt') % i, hdr)
 
     print('Calculating taus...')
-    # Uses average spe waveform to calculate tau to use in lowpass filter for 2x rise time
+    # Uses average spe waveform to calculate tau to use in shaping filter of each level (or reads them from calibration
+    # file of an earlier run with the same average waveform)
     average_file = str(data_path / 'hist_data' / 'avg_waveform_d1b.txt')
-    tau_2, tau_4, tau_8, v1, v2, v4, v8 = taus(average_file, fsps, nhdr)
+    calibration = calibrate(average_file, dest_path, fsps, nhdr, ladder_text, ladder)
+    if calibration is None:
+        print('Error: Could not calibrate shapings from average waveform')
+        return
+    tau_list, factor_list, v_gain_list = calibration
 
-    v_gain, v2_gain, v4_gain, v8_gain, factor2, factor4, factor8 = calc_gain(v1, v2, v4, v8)
+    print(*factor_list[1:])
 
-    print(factor2, factor4, factor8)
+    avg_shapings(average_file, dest_path, v_gain_list, ladder, tau_list, nhdr)
 
-    avg_shapings(average_file, dest_path, v_gain, v2_gain, v4_gain, v8_gain, tau_2, tau_4, tau_8, nhdr)
-
-    # For each spe waveform file, calculates and saves waveforms with 1x, 2x, 4x, and 8x the rise time
+    # For each spe waveform file, calculates and saves waveform of each shaping level
+    ledger = read_ledger(dest_path)
     for i in range(start, end + 1):
-        save_name1 = str(filt_path1 / 'D2--waveforms--%05d.txt') % i
-        save_name2 = str(filt_path2 / 'D2--waveforms--%05d.txt') % i
-        save_name4 = str(filt_path4 / 'D2--waveforms--%05d.txt') % i
-        save_name8 = str(filt_path8 / 'D2--waveforms--%05d.txt') % i
-
-        do_shaping(save_name1, save_name2, save_name4, save_name8, i, tau_2, tau_4, tau_8, factor2, factor4, factor8,
-                   fsps, nhdr)
-
-    # Plots average waveform for 1x rise time
-    print('Calculating rt_1 average waveform...')
-    average_waveform(start, end, dest_path, 'rt_1', 'No Shaping', nhdr)
+        if check_rejected(ledger, '%05d' % i) == 'yes':    # Waveforms rejected in an earlier run are not shaped
+            continue
+        save_names = [str(path / 'D2--waveforms--%05d.txt') % i for path in paths]
 
-    # Plots average waveform for 2x rise time
-    print('Calculating rt_2 average waveform...')
-    average_waveform(start, end, dest_path, 'rt_2', '2x Shaping', nhdr)
+        do_shaping(save_names, i, ladder, tau_list, factor_list, fsps, nhdr)
 
-    # Plots average waveform for 4x rise time
-    print('Calculating rt_4 average waveform...')
-    average_waveform(start, end, dest_path, 'rt_4', '4x Shaping', nhdr)
+    # Plots average waveforms for each shaping level, reading each waveform id once
+    print('Calculating average waveforms...')
+    average_waveforms(start, end, dest_path, ['rt_' + level[0] for level in ladder],
+                      [level_title(level) for level in ladder], nhdr, nworkers)
 
-    # Plots average waveform for 8x rise time
-    print('Calculating rt_8 average waveform...')
-    average_waveform(start, end, dest_path, 'rt_8', '8x Shaping', nhdr)
-
-    # Calculates 10-90 rise times for each waveform and puts them into arrays
+    # Calculates 10-90 rise times & amplitudes for each waveform and puts them into table
     print('Doing calculations...')
-    rt_1_array, rt_2_array, rt_4_array, rt_8_array, amp_1_array, amp_2_array, amp_4_array, amp_8_array = \
-        make_arrays(filt_path1, filt_path2, filt_path4, filt_path8, dest_path, start, end, nhdr)
+    table = make_arrays(paths, dest_path, start, end, nhdr, ladder)
 
-    # Creates histograms of 10-90 rise times for 1x, 2x, 4x, and 8x the initial rise time
-    p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, amp_1_array, amp_2_array, amp_4_array, amp_8_array,
-            dest_path, 100)
+    # Creates histograms of 10-90 rise times & amplitudes for each shaping level
+    p2_hist(table, ladder, dest_path, 100, nworkers)
 
     # Writes info file
     info_file(date_time, data_path, dest_path, pmt_hv, gain, offset, trig_delay, amp, fsps, band, nfilter, r)
 
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
+
 
 if __name__ == '__main__':
     import argparse
@@ -85,6 +83,12 @@ if __name__ == '__main__':
     parser.add_argument("--band", type=str, help='bandwidth of oscilloscope (Hz)')
     parser.add_argument("--nfilter", type=float, help='noise filter on oscilloscope (bits)')
     parser.add_argument("--info_file", type=str, help='path to d1 info file')
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for fitting histograms & averaging waveforms '
+                                                  '(default=1)', default=1)
+    parser.add_argument("--ladder", type=str, help='shaping levels as rise time ratios, each ratio[:rc|crrc[:stages]] '
+                                                   '(default=' + default_ladder + ')', default=default_ladder)
     args = parser.parse_args()
 
     if not args.info_file:
@@ -93,7 +97,8 @@ if __name__ == '__main__':
             print('Error: Must provide an info file or all other arguments')
         else:
             p2(args.start, args.end, args.date, args.date_time, args.fil_band, args.nhdr, args.fsps, args.r,
-               args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp, args.band, args.nfilter)
+               args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp, args.band, args.nfilter, args.cores,
+               args.dpi, args.no_plots, args.ladder)
     else:
         myfile = open(args.info_file, 'r')
         csv_reader = csv.reader(myfile)
@@ -117,6 +122,6 @@ if __name__ == '__main__':
         i_date = int(i_date)
 
         p2(args.start, args.end, i_date, i_date_time, i_fil_band, args.nhdr, i_fsps, i_r, i_pmt_hv, i_gain, i_offset,
-           i_trig_delay, i_amp, i_band, i_nfilter)
+           i_trig_delay, i_amp, i_band, i_nfilter, args.cores, args.dpi, args.no_plots, args.ladder)
 
         myfile.close()
\ No newline at end of file
@@ -1,11 +1,11 @@
 import os
 import csv
+import time
+import hashlib
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
-from scipy.optimize import curve_fit
-from scipy.stats import norm
+from multiprocessing import Pool
 
 # FILE READING/WRITING
 
@@ -46,39 +46,24 @@ def ww(x, y, file_name, hdr):
     myfile.close()                          # Closes waveform file
 
 
-# Creates text file with rise times at each shaping
-def save_calculations(dest_path, i, risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4, amp_8):
+# Creates text file with rise time & amplitude at each shaping level (values is list of (name, value))
+def save_calculations(dest_path, i, values):
     file_name = str(dest_path / 'calculations_single' / 'D2--waveforms--%05d.txt') % i
     myfile = open(file_name, 'w')
-    myfile.write('risetime_1,' + str(risetime_1))
-    myfile.write('\nrisetime_2,' + str(risetime_2))
-    myfile.write('\nrisetime_4,' + str(risetime_4))
-    myfile.write('\nrisetime_8,' + str(risetime_8))
-    myfile.write('\namp_1,' + str(amp_1))
-    myfile.write('\namp_2,' + str(amp_2))
-    myfile.write('\namp_4,' + str(amp_4))
-    myfile.write('\namp_8,' + str(amp_8))
+    myfile.write('\n'.join([name + ',' + str(value) for name, value in values]))
     myfile.close()
 
 
-# Reads calculation file
+# Reads calculation file into dict of values
 def read_calc(filename):
     myfile = open(filename, 'r')  # Opens file with calculations
     csv_reader = csv.reader(myfile)
-    file_array = np.array([])
-    for row in csv_reader:  # Creates array with calculation data
-        file_array = np.append(file_array, float(row[1]))
+    values = {}
+    for row in csv_reader:  # Creates dict with calculation data
+        values[row[0]] = float(row[1])
     myfile.close()
-    risetime_1 = file_array[0]
-    risetime_2 = file_array[1]
-    risetime_4 = file_array[2]
-    risetime_8 = file_array[3]
-    amp_1 = file_array[4]
-    amp_2 = file_array[5]
-    amp_4 = file_array[6]
-    amp_8 = file_array[7]
 
-    return risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4, amp_8
+    return values
 
 
 # Creates text file with data from an array
@@ -100,18 +85,9 @@ def check_if_file(path, file_name):
         return 'no'
 
 
-# Removes single spe waveform from all spe folders
-def remove_spe(dest_path, number, nhdr):
-    t, v, hdr = rw(str(Path(dest_path / 'rt_1_single') / 'D2--waveforms--%05d.txt') % number, nhdr)
-    ww(t, v, str(dest_path / 'unusable_data' / 'D2--waveforms--%05d.txt') % number, hdr)
-    if os.path.isfile(str(Path(dest_path / 'rt_2_single') / 'D2--waveforms--%05d.txt') % number):
-        os.remove(str(Path(dest_path / 'rt_2_single') / 'D2--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(dest_path / 'rt_4_single') / 'D2--waveforms--%05d.txt') % number):
-        os.remove(str(Path(dest_path / 'rt_4_single') / 'D2--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(dest_path / 'rt_8_single') / 'D2--waveforms--%05d.txt') % number):
-        os.remove(str(Path(dest_path / 'rt_8_single') / 'D2--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(dest_path / 'calculations_single') / 'D2--waveforms--%05d.txt') % number):
-        os.remove(str(Path(dest_path / 'calculations_single') / 'D2--waveforms--%05d.txt') % number)
+# Removes single spe waveform from data set by labeling it as rejected in ledger
+def remove_spe(dest_path, ledger, number):
+    label_waveform(dest_path, ledger, '%05d' % number, 'rejected', 'impossible values', 'p2')
 
 
 # Creates info file
@@ -164,69 +140,592 @@ def read_info(myfile):
         i_amp, i_band, i_nfilter
 
 
+# Returns md5 checksum of a file
+def file_md5(file_name):
+    myfile = open(file_name, 'rb')
+    checksum = hashlib.md5(myfile.read()).hexdigest()
+    myfile.close()
+    return checksum
+
+
+# Writes calibration file (dict of name & value rows, e.g. md5 checksum of average waveform template, taus & gain
+# factors of shapings)
+def write_calibration(file_name, calibration):
+    myfile = open(file_name, 'w', newline='')
+    csv_writer = csv.writer(myfile)
+    for name in calibration:
+        csv_writer.writerow([name, calibration[name]])
+    myfile.close()
+
+
+# Reads calibration file into dict (values are strings), or returns None if there is no calibration file
+def read_calibration(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    calibration = {}
+    for row in csv.reader(myfile):
+        calibration[row[0]] = row[1]
+    myfile.close()
+    return calibration
+
+
+# LEDGER
+
+
+# Reads ledger of waveform labels
+# Returns dictionary of waveform id: (status, reason, stage)
+def read_ledger(dest_path):
+    ledger = {}
+    file_name = Path(dest_path) / 'ledger.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):          # Later labels of a waveform replace earlier ones
+            ledger[row[0]] = (row[1], row[2], row[3])
+        myfile.close()
+
+    return ledger
+
+
+# Labels a waveform in ledger and adds label to ledger file
+def label_waveform(dest_path, ledger, waveform_id, status, reason, stage):
+    ledger[str(waveform_id)] = (status, reason, stage)
+    myfile = open(Path(dest_path) / 'ledger.txt', 'a')
+    myfile.write('%s,%s,%s,%s\n' % (waveform_id, status, reason, stage))
+    myfile.close()
+
+
+# Checks if a waveform has been rejected
+def check_rejected(ledger, waveform_id):
+    if str(waveform_id) in ledger and ledger[str(waveform_id)][0] == 'rejected':
+        return 'yes'
+    else:
+        return 'no'
+
+
+# HISTOGRAM ACCUMULATOR
+
+
+# Finds fixed bin edges for histogram accumulator from calibration array: nbins bins between minimum & maximum of array
+# (same as np.histogram) plus bins of the same width covering margin (fraction of range) on each side for later values
+def hist_edges(array, nbins, margin=0.):
+    low = float(np.min(array))
+    high = float(np.max(array))
+    if low == high:
+        low = low - 0.5
+        high = high + 0.5
+    n_pad = int(np.ceil(margin * nbins))
+    width = (high - low) / nbins
+    edges = np.linspace(low - n_pad * width, high + n_pad * width, nbins + 2 * n_pad + 1)
+    return edges
+
+
+# Creates histogram accumulator with fixed bin edges that also keeps mean & variance of values (Welford's method)
+def init_hist_accumulator(edges):
+    accumulator = {'edges': np.asarray(edges, dtype=float), 'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+                   'under': 0, 'over': 0, 'n': 0, 'mean': 0., 'm2': 0.}
+    return accumulator
+
+
+# Adds a value or array of values to histogram accumulator (values outside bin edges are only counted as under/over)
+def update_hist_accumulator(accumulator, values):
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    n_b = len(values)
+    if n_b == 0:
+        return accumulator
+    edges = accumulator['edges']
+    accumulator['counts'] += np.histogram(values, edges)[0]
+    accumulator['under'] += int(np.count_nonzero(values < edges[0]))
+    accumulator['over'] += int(np.count_nonzero(values > edges[-1]))
+
+    # Combines mean & sum of squared differences of values with those of accumulator (Chan et al.)
+    mean_b = float(np.mean(values))
+    m2_b = float(np.sum((values - mean_b) ** 2))
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    return accumulator
+
+
+# Combines two histogram accumulators with the same bin edges (e.g. from different workers or runs) into a new one
+def merge_hist_accumulators(acc_a, acc_b):
+    if not np.array_equal(acc_a['edges'], acc_b['edges']):
+        raise ValueError('Histogram accumulators have different bin edges')
+    accumulator = init_hist_accumulator(acc_a['edges'])
+    accumulator['counts'] = acc_a['counts'] + acc_b['counts']
+    accumulator['under'] = acc_a['under'] + acc_b['under']
+    accumulator['over'] = acc_a['over'] + acc_b['over']
+    n = acc_a['n'] + acc_b['n']
+    if n > 0:
+        delta = acc_b['mean'] - acc_a['mean']
+        accumulator['n'] = n
+        accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+        accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+    return accumulator
+
+
+# Saves histogram accumulator to .npz file
+def save_hist_accumulator(accumulator, file_name):
+    np.savez(file_name, **accumulator)
+
+
+# Reads histogram accumulator from .npz file
+def load_hist_accumulator(file_name):
+    myfile = np.load(file_name)
+    accumulator = {'edges': myfile['edges'], 'counts': myfile['counts'], 'under': int(myfile['under']),
+                   'over': int(myfile['over']), 'n': int(myfile['n']), 'mean': float(myfile['mean']),
+                   'm2': float(myfile['m2'])}
+    myfile.close()
+    return accumulator
+
+
+# Returns mean & standard deviation of all values added to histogram accumulator
+def hist_accumulator_stats(accumulator):
+    if accumulator['n'] == 0:
+        return np.nan, np.nan
+    return accumulator['mean'], np.sqrt(accumulator['m2'] / accumulator['n'])
+
+
+# Finds Gaussian fit of histogram in accumulator (starting from mean & standard deviation of all values)
+def fit_hist_accumulator(accumulator):
+    edges = accumulator['edges']
+    bins = (edges[:-1] + edges[1:]) / 2                 # Bin centers
+    mu, sigma = hist_accumulator_stats(accumulator)
+    return gauss_fit_bins(bins, accumulator['counts'], mu, sigma)
+
+
+# Fits histogram in accumulator, bootstraps fit from nfit resampled histograms, and queues plot of histogram with
+# Gaussian fit, returns fit parameters & bootstrap rows
+def plot_hist_accumulator(accumulator, dest_path, xaxis, title, units, filename, nfit=100):
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit)
+    mean, sd = hist_accumulator_stats(accumulator)
+    rows = bootstrap_rows(mean, sd, np.array([]), np.array([]), popt, params)
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
+
+    return popt, rows
+
+
+# Returns ' +/- ' and half width of bootstrap confidence interval in row, or '' if there is no interval
+def error_text(row):
+    name, value, low, high = row
+    if np.isnan(low) or np.isnan(high):
+        return ''
+    return ' +/- ' + str(float(format((high - low) / 2, '.1e')))
+
+
+# Queues plot of histogram in accumulator with Gaussian fit (uncertainties are half widths of bootstrap intervals)
+def queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename):
+    path = Path(Path(dest_path) / 'plots')
+    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
+    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
+
+    # Queues histogram with Gaussian fit (mean +/- 2sigma) to be plotted
+    queue_plot('histogram', path / str(filename + '.png'),
+               {'arrays': [], 'counts': [(accumulator['edges'], accumulator['counts'])],
+                'fits': [(bins_range, popt, 'red')], 'xlabel': xaxis + ' (' + units + ')', 'fontsize': 'large',
+                'title': title + ' of SPE\n mean: ' + str(mu2) + error_text(rows[2]) + ' ' + units + ', SD: ' +
+                         str(sigma2) + error_text(rows[3]) + ' ' + units})
+
+
+# BOOTSTRAP
+
+
+# Resamples array with replacement nboot times, using matrices of random indices (at most max_size values at a time),
+# and returns mean & standard deviation of each resample (drawn with random generator rng, or a new one if rng is None)
+def bootstrap_stats(array, nboot=1000, max_size=10000000, rng=None):
+    rng = np.random.default_rng(rng)
+    array = np.asarray(array, dtype=float)
+    n = len(array)
+    center = np.mean(array)
+    array = array - center                      # Centered so that standard deviation does not lose precision
+    means = np.zeros(nboot)
+    sds = np.zeros(nboot)
+    chunk = max(1, min(nboot, max_size // max(n, 1)))
+
+    for j in range(0, nboot, chunk):
+        idx = rng.integers(0, n, (min(chunk, nboot - j), n))            # Each row is one resample
+        samples = array[idx]
+        means_j = np.mean(samples, axis=1)
+        means[j:j + len(idx)] = means_j + center
+        sds[j:j + len(idx)] = np.sqrt(np.maximum(np.mean(samples ** 2, axis=1) - means_j ** 2, 0))
+
+    return means, sds
+
+
+# Resamples histogram counts nboot times (multinomial, same as resampling the values in the histogram) and returns fit
+# parameters of Gaussian fit of each resampled histogram that could be fitted (one row per resample), starting each fit
+# from popt (resamples are drawn with random generator rng, or a new one if rng is None)
+def bootstrap_fit(bins, n, popt, nboot=100, rng=None):
+    n = np.asarray(n, dtype=float)
+    total = int(np.sum(n))
+    params = np.zeros((nboot, 3))
+    if total == 0 or nboot == 0:
+        return params[:0]
+    resamples = np.random.default_rng(rng).multinomial(total, n / total, size=nboot)
+
+    for j in range(nboot):
+        try:
+            bins_range, params[j], pcov = gauss_fit_bins(bins, resamples[j], popt[1], popt[2])
+            if not np.all(np.isfinite(pcov)):
+                params[j] = np.nan
+        except RuntimeError:
+            params[j] = np.nan
+
+    # Resamples that could not be fitted are dropped so they do not narrow confidence intervals
+    fitted = np.all(np.isfinite(params), axis=1)
+    if not np.all(fitted):
+        print('Dropped %d of %d bootstrap fits that could not be fitted' % (nboot - np.count_nonzero(fitted), nboot))
+
+    return params[fitted]
+
+
+# Returns lower & upper limits of central confidence interval (cl in %) of bootstrap values
+def confidence_interval(values, cl=68.27):
+    return np.percentile(values, 50 - cl / 2, axis=0), np.percentile(values, 50 + cl / 2, axis=0)
+
+
+# Returns rows of (name, value, lower limit, upper limit) of central confidence intervals (cl in %) of mean & standard
+# deviation of values (from bootstrap means & sds) and of mean & standard deviation of Gaussian fit (from params)
+def bootstrap_rows(mean, sd, means, sds, popt, params, cl=68.27):
+    values = [('mean', mean, means), ('sd', sd, sds), ('fit_mean', popt[1], params[:, 1]),
+              ('fit_sd', np.abs(popt[2]), np.abs(params[:, 2]))]
+    rows = []
+    for name, value, resampled in values:
+        if len(resampled) > 0:
+            low, high = confidence_interval(resampled, cl)
+        else:
+            low, high = np.nan, np.nan
+        rows.append((name, float(value), float(low), float(high)))
+    return rows
+
+
+# Saves bootstrap confidence intervals of a histogram
+def save_bootstrap(rows, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('name,value,low,high\n')
+    for name, value, low, high in rows:
+        myfile.write('%s,%s,%s,%s\n' % (name, str(value), str(low), str(high)))
+    myfile.close()
+
+
+# Writes table with number of values (in, below & above bins) and bootstrap confidence intervals of each histogram
+def write_hist_summary(summary, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('histogram,n,under,over')
+    for name in ['mean', 'sd', 'fit_mean', 'fit_sd']:
+        myfile.write(',%s,%s_low,%s_high' % (name, name, name))
+    myfile.write('\n')
+    for filename, accumulator, rows in summary:
+        myfile.write('%s,%d,%d,%d' % (filename, accumulator['n'], accumulator['under'], accumulator['over']))
+        for name, value, low, high in rows:
+            myfile.write(',%s,%s,%s' % (str(value), str(low), str(high)))
+        myfile.write('\n')
+    myfile.close()
+
+
+# PLOTTING
+
+
+plot_queue = []         # Plots waiting to be rendered by render_plots
+
+
+# Adds a plot to plot queue (kind is 'histogram' or 'waveform', and data holds what is needed to draw it)
+def queue_plot(kind, file_name, data):
+    plot_queue.append((kind, str(file_name), data))
+
+
+# Draws a queued plot with the non-interactive Agg backend and saves it
+def draw_plot(kind, file_name, data, dpi):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    if kind == 'histogram':
+        for array in data['arrays']:
+            plt.hist(array, data['nbins'])                                  # Plots histogram
+        for edges, counts in data.get('counts', []):
+            plt.hist(edges[:-1], edges, weights=counts)                     # Plots histogram from accumulator
+        for bins_range, popt, color in data['fits']:
+            plt.plot(bins_range, func(bins_range, *popt), color=color)      # Plots Gaussian fit (mean +/- 2sigma)
+        plt.xlabel(data['xlabel'])
+        plt.title(data['title'], fontsize=data['fontsize'])
+    if kind == 'waveform':
+        plt.plot(data['t'], data['v'])
+        plt.fill_between(data['t'], data['v_low'], data['v_high'], alpha=0.3)     # Plots band with 68% of waveforms
+        plt.xlabel('Time (s)')
+        plt.ylabel('Normalized Voltage')
+        plt.title(data['title'])
+    plt.savefig(file_name, dpi=dpi)
+    plt.close()
+
+
+# Renders queued plots in nworkers processes and empties plot queue
+def render_plots(dpi=360, nworkers=1):
+    plots = [(kind, file_name, data, dpi) for kind, file_name, data in plot_queue]
+    del plot_queue[:]
+    print('Rendering %d plots' % len(plots))
+    if nworkers > 1 and len(plots) > 1:
+        pool = Pool(min(nworkers, len(plots)))
+        pool.starmap(draw_plot, plots)
+        pool.close()
+        pool.join()
+    else:
+        for plot in plots:
+            draw_plot(*plot)
+
+
+# Empties plot queue without rendering (for runs with no plots)
+def clear_plots():
+    del plot_queue[:]
+
+
+# WAVEFORM ACCUMULATOR
+
+
+# Creates accumulator for mean & variance of waveforms (Welford's method) that also keeps a random sample of up to keep
+# waveforms for percentile bands
+def init_accumulator(keep=500):
+    accumulator = {'n': 0, 'mean': None, 'm2': None, 'keep': keep, 'reservoir': None, 'n_res': 0}
+    return accumulator
+
+
+# Adds a waveform (1-D array) or block of waveforms (2-D array, one waveform per row) to accumulator, sampling its
+# reservoir with random generator rng (a new one if rng is None)
+def update_accumulator(accumulator, v, rng=None):
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    n_b = len(v)
+    if n_b == 0:
+        return accumulator
+    if accumulator['mean'] is None:
+        accumulator['mean'] = np.zeros(v.shape[1])
+        accumulator['m2'] = np.zeros(v.shape[1])
+        accumulator['reservoir'] = np.zeros((accumulator['keep'], v.shape[1]))
+
+    # Combines mean & sum of squared differences of block with those of accumulator (Chan et al.)
+    mean_b = np.mean(v, axis=0)
+    m2_b = np.sum((v - mean_b) ** 2, axis=0)
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    # Keeps each waveform in reservoir with probability keep / n
+    rng = np.random.default_rng(rng)
+    for j in range(n_b):
+        if accumulator['n_res'] < accumulator['keep']:
+            accumulator['reservoir'][accumulator['n_res']] = v[j]
+            accumulator['n_res'] += 1
+        else:
+            k = rng.integers(0, n_a + j + 1)
+            if k < accumulator['keep']:
+                accumulator['reservoir'][k] = v[j]
+
+    return accumulator
+
+
+# Adds each waveform from an iterable of waveforms (list of arrays, generator, or 2-D array) to accumulator
+def accumulate_waveforms(accumulator, waveforms, rng=None):
+    rng = np.random.default_rng(rng)
+    for v in waveforms:
+        update_accumulator(accumulator, v, rng)
+    return accumulator
+
+
+# Combines two accumulators (e.g. from different workers) into a new accumulator, sampling its reservoir with random
+# generator rng (a new one if rng is None)
+def merge_accumulators(acc_a, acc_b, rng=None):
+    if acc_a['n'] == 0:
+        return acc_b
+    if acc_b['n'] == 0:
+        return acc_a
+    accumulator = init_accumulator(max(acc_a['keep'], acc_b['keep']))
+    n = acc_a['n'] + acc_b['n']
+    delta = acc_b['mean'] - acc_a['mean']
+    accumulator['n'] = n
+    accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+    accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+
+    # Combines reservoirs, choosing waveforms from each in proportion to number of waveforms each reservoir stands for
+    res = np.concatenate((acc_a['reservoir'][:acc_a['n_res']], acc_b['reservoir'][:acc_b['n_res']]))
+    weights = np.concatenate((np.full(acc_a['n_res'], acc_a['n'] / acc_a['n_res']),
+                              np.full(acc_b['n_res'], acc_b['n'] / acc_b['n_res'])))
+    n_res = min(accumulator['keep'], len(res))
+    idx = np.random.default_rng(rng).choice(len(res), n_res, replace=False, p=weights / np.sum(weights))
+    accumulator['reservoir'] = np.zeros((accumulator['keep'], res.shape[1]))
+    accumulator['reservoir'][:n_res] = res[idx]
+    accumulator['n_res'] = n_res
+
+    return accumulator
+
+
+# Returns mean, standard deviation, and lower & upper percentile bands of waveforms in accumulator
+def accumulator_stats(accumulator, low=15.87, high=84.13):
+    n = accumulator['n']
+    if n == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    mean = accumulator['mean']
+    if n > 1:
+        sd = np.sqrt(accumulator['m2'] / (n - 1))
+    else:
+        sd = np.zeros(len(mean))
+    res = accumulator['reservoir'][:accumulator['n_res']]
+    band_low = np.percentile(res, low, axis=0)
+    band_high = np.percentile(res, high, axis=0)
+
+    return mean, sd, band_low, band_high
+
+
 # AVERAGE/PLOT WAVEFORM
 
 
-# Calculates average waveform of spe
-def average_waveform(start, end, dest_path, shaping, shaping_name, nhdr):
-    data_file = Path(dest_path / str(shaping + '_single'))
-    save_file = Path(dest_path / 'plots')
-    tsum = 0
-    vsum = 0
-    n = 0
+# Returns index where averaging window of a waveform starts given its first time point t0, time step dt, and number of
+# points, or -1 if waveform does not have n_before points before t = 0 and length points in total
+def window_index(t0, dt, n_before, length, array_length):
+    idx0 = int(round(-t0 / dt))                     # Finds index of t = 0 point
+    idx_start = idx0 - n_before
+    if idx_start < 0 or idx_start + length > array_length - 1:
+        return -1
+    return idx_start
+
+
+# Chooses averaging window from a waveform file
+# Returns number of points before t = 0, number of points in window, and time step
+def average_window(file_name, nhdr):
+    t, v, hdr = rw(file_name, nhdr)
+    array_length = len(t)
+    dt = (t[-1] - t[0]) / (array_length - 1)
+    # Window of points before t = 0 & after the spe
+    n_before = array_length - int(0.87 * array_length)
+    length = int(0.99 * array_length)
+    return n_before, length, dt
+
+
+# Reads a shard of waveform files and adds each aligned, normalized waveform to the accumulator of its group
+# jobs is a list of (group, file name) and windows holds number of points before t = 0 & window length of each group
+# Returns dictionary of accumulator for each group (reservoirs are sampled with a random generator seeded from seed)
+def average_shard(jobs, nhdr, windows, seed=None):
+    rng = np.random.default_rng(seed)
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of aligned waveforms
+    ks = {}
+
+    for group, file_name in jobs:
+        n_before, length = windows[group]
+        if group not in accs:
+            accs[group] = init_accumulator()
+            blocks[group] = np.empty((500, length))
+            ks[group] = 0
+        print('Reading file', Path(file_name).name)
+        t, v, hdr = rw(file_name, nhdr)             # Reads a waveform file
+        array_length = len(t)
+        dt = (t[-1] - t[0]) / (array_length - 1)
+        idx_start = window_index(t[0], dt, n_before, length, array_length)
+        # Only averages waveform files that have enough points before t = 0 & after the spe
+        if idx_start >= 0:
+            k = ks[group]
+            blocks[group][k] = v[idx_start:idx_start + length]
+            blocks[group][k] /= min(v)              # Normalizes voltages
+            ks[group] = k + 1
+            if ks[group] == len(blocks[group]):     # Adds full block of waveforms to accumulator
+                update_accumulator(accs[group], blocks[group], rng)
+                ks[group] = 0
+    for group in accs:
+        update_accumulator(accs[group], blocks[group][:ks[group]], rng)
+
+    return accs
+
+
+# Averages waveform files of every group in one pass, splitting them into one shard per worker process and merging the
+# accumulators at the end (jobs is a list of (group, file name))
+# Returns dictionaries of accumulator and time array of average waveform for each group
+def average_files(jobs, nhdr, nworkers=1):
+    windows = {}
+    times = {}
+    for group, file_name in jobs:                   # Chooses window of each group from its first file
+        if group not in windows:
+            n_before, length, dt = average_window(file_name, nhdr)
+            windows[group] = (n_before, length)
+            times[group] = (np.arange(length) - n_before) * dt
+
+    if nworkers > 1 and len(jobs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(jobs[j * len(jobs) // nworkers:(j + 1) * len(jobs) // nworkers], nhdr, windows, seeds[j])
+                  for j in range(nworkers)]
+        pool = Pool(nworkers)
+        shard_accs = pool.starmap(average_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        shard_accs = [average_shard(jobs, nhdr, windows)]
+
+    accs = {}
+    for group in windows:
+        accs[group] = init_accumulator()
+        for shard_acc in shard_accs:
+            if group in shard_acc:
+                accs[group] = merge_accumulators(accs[group], shard_acc[group])
+
+    return accs, times
+
 
+# Calculates average waveform of spe for each shaping, reading the waveform files of every shaping in one pass
+def average_waveforms(start, end, dest_path, shapings, shaping_names, nhdr, nworkers=1):
+    ledger = read_ledger(dest_path)
+    folder_files = {}
+    for shaping in shapings:
+        folder_files[shaping] = set(os.listdir(dest_path / str(shaping + '_single')))
+
+    jobs = []
     for i in range(start, end + 1):
         file_name = 'D2--waveforms--%05d.txt' % i
-        if os.path.isfile(data_file / file_name):
-            print('Reading file #', i)
-            t, v, hdr = rw(data_file / file_name, nhdr)     # Reads a waveform file
-            array_length = len(t)
-            v = v / min(v)                                  # Normalizes voltages
-            idx = np.where(t == 0)                          # Finds index of t = 0 point
-            idx = int(idx[0])
-            t = np.roll(t, -idx)                            # Rolls time array so that t = 0 point is at index 0
-            v = np.roll(v, -idx)                            # Rolls voltage array so that 50% max point is at index 0
-            idx2 = np.where(t == min(t))                    # Finds index of point of minimum t
-            idx2 = int(idx2[0])
-            idx3 = np.where(t == max(t))                    # Finds index of point of maximum t
-            idx3 = int(idx3[0])
-            # Only averages waveform files that have enough points before t = 0 & after the spe
-            if idx2 <= int(0.87 * array_length):
-                # Removes points between point of maximum t & chosen minimum t in time & voltage arrays
-                t = np.concatenate((t[:idx3], t[int(0.87 * array_length):]))
-                v = np.concatenate((v[:idx3], v[int(0.87 * array_length):]))
-                # Rolls time & voltage arrays so that point of chosen minimum t is at index 0
-                t = np.roll(t, -idx3)
-                v = np.roll(v, -idx3)
-                if len(t) >= int(0.99 * array_length):
-                    # Removes points after chosen point of maximum t in time & voltage arrays
-                    t = t[:int(0.99 * array_length)]
-                    v = v[:int(0.99 * array_length)]
-                    # Sums time & voltage arrays
-                    tsum += t
-                    vsum += v
-                    n += 1
-    # Finds average time & voltage arrays
-    t_avg = tsum / n
-    v_avg = vsum / n
-
-    # Plots average waveform & saves image
-    plt.plot(t_avg, v_avg)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveform (' + shaping_name + ')')
-    plt.savefig(save_file / str('avg_waveform_single_' + shaping + '.png'), dpi=360)
+        if check_rejected(ledger, '%05d' % i) == 'no':
+            for shaping in shapings:
+                if file_name in folder_files[shaping]:
+                    jobs.append((shaping, str(dest_path / str(shaping + '_single') / file_name)))
+
+    # Reads and averages waveforms in nworkers processes
+    accs, times = average_files(jobs, nhdr, nworkers)
+
+    for shaping, shaping_name in zip(shapings, shaping_names):
+        if shaping in accs and accs[shaping]['n'] > 0:
+            save_average(accs[shaping], times[shaping], dest_path, shaping, shaping_name)
+        else:
+            print('No ' + shaping + ' waveforms to average')
+
+
+# Calculates average waveform of spe for one shaping
+def average_waveform(start, end, dest_path, shaping, shaping_name, nhdr, nworkers=1):
+    average_waveforms(start, end, dest_path, [shaping], [shaping_name], nhdr, nworkers)
+
+
+# Plots and saves average waveform & standard deviation of waveforms for a shaping
+def save_average(acc, t_avg, dest_path, shaping, shaping_name):
+    save_file = Path(dest_path / 'plots')
+
+    # Finds average voltage array and standard deviation & 68% band of voltage arrays
+    v_avg, v_sd, v_low, v_high = accumulator_stats(acc)
 
     # Saves average waveform data
     file_name = dest_path / 'hist_data_single' / str('avg_waveform_' + shaping + '.txt')
     hdr = 'Average Waveform\n\n\n\nTime,Ampl'
     ww(t_avg, v_avg, file_name, hdr)
+    ww(t_avg, v_sd, str(file_name)[:-4] + '_sd.txt', 'Waveform Standard Deviation\n\n\n\nTime,Ampl')
 
-    plt.close()
+    # Queues average waveform & 68% band to be plotted
+    queue_plot('waveform', save_file / str('avg_waveform_single_' + shaping + '.png'),
+               {'t': t_avg, 'v': v_avg, 'v_low': v_low, 'v_high': v_high,
+                'title': 'Average Waveform (' + shaping_name + ')'})
 
 
 # Shows a waveform plot to user
 def show_waveform(file_name, version):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(file_name, 5)
     print("\nHeader:\n\n" + str(hdr))
     plt.plot(t, v)
@@ -239,54 +738,168 @@ def show_waveform(file_name, version):
 # CALCULATIONS
 
 # Puts voltage array through a lowpass filter given a tau and sample rate
-def lowpass_filter(v, tau, fsps):
-    v_filtered = np.array([])
+# Filter is the single pole recursion v_filtered[i] = alpha * v[i] + (1 - alpha) * v_filtered[i - 1], starting from
+# v_filtered[0] = v[0], applied along axis of v so a matrix of waveforms can be filtered at once
+# If out is v, filters in place
+def lowpass_filter(v, tau, fsps, axis=-1, out=None):
+    from scipy.signal import lfilter
+    v = np.asarray(v, dtype=float)
+    if out is None:
+        out = np.empty_like(v)
+    if v.shape[axis] == 0:
+        return out
     alpha = 1 - np.exp(-1. / (fsps * tau))
-    for i in range(len(v)):
-        if i == 0:
-            v_filtered = np.append(v_filtered, v[i])
+    v_moved = np.moveaxis(v, axis, 0)
+    out_moved = np.moveaxis(out, axis, 0)
+    first = v_moved[:1].copy()                  # First sample passes through unchanged
+    rest, zf = lfilter([alpha], [1., alpha - 1], v_moved[1:], axis=0, zi=(1 - alpha) * first)
+    out_moved[0] = first[0]
+    out_moved[1:] = rest
+    return out
+
+
+# Shapes voltage array with n RC lowpass stages (rc), or with a CR highpass stage followed by n RC lowpass stages
+# (crrc), all with the same tau
+def shape_filter(v, tau, fsps, kind='rc', order=1, axis=-1):
+    v = np.asarray(v, dtype=float)
+    if kind == 'crrc':
+        v = v - lowpass_filter(v, tau, fsps, axis)
+    for j in range(order):
+        v = lowpass_filter(v, tau, fsps, axis)
+    return v
+
+
+# Shapes voltage array with each tau in turn, each shaping starting from the last one (before gain), and returns list
+# of shaped voltage arrays
+# Filters are single RC stages unless ladder (levels after the unshaped one) is given
+# method is 'recursive' (filters in time domain), 'fft' (filters in frequency domain), or 'auto' (whichever is faster)
+def shaping_cascade(v, tau_list, fsps, axis=-1, ladder=None, method='auto'):
+    if method == 'auto':
+        method = shaping_engine(v, tau_list, fsps, axis, ladder)
+    if method == 'fft':
+        return shaping_cascade_fft(v, tau_list, fsps, axis, ladder)
+
+    v_list = []
+    for j in range(len(tau_list)):
+        if ladder is None:
+            v = lowpass_filter(v, tau_list[j], fsps, axis)
         else:
-            v_filtered = np.append(v_filtered, v[i] * alpha + (1 - alpha) * v_filtered[i - 1])
-    return v_filtered
-
-
-# Calculates tau value for lowpass filter
-def calculate_tau(t, v, fsps):
-    rt_array = np.array([])
-    j_array = np.array([])
-
-    rt1090 = rise_time(t, v, 10, 90)
-    for i in range(5, 50000):
-        j = i * 1e-11
-        j_array = np.append(j_array, j)
-        v_new = lowpass_filter(v, j, fsps)
-        rt = rise_time(t, v_new, 10, 90)
-        rt_array = np.append(rt_array, rt)
-        diff_val = rt - 2 * rt1090
-        if diff_val >= 0:
+            v = shape_filter(v, tau_list[j], fsps, ladder[j][2], ladder[j][3], axis)
+        v_list.append(v)
+    return v_list
+
+
+# Returns transfer function of single pole lowpass filter (starting from 0) given z^-1 at each frequency
+def lowpass_response(tau, fsps, z_inv):
+    alpha = 1 - np.exp(-1. / (fsps * tau))
+    return alpha / (1 - (1 - alpha) * z_inv)
+
+
+# Shapes voltage array the same way as shaping_cascade, but transforms it once with FFT, multiplies by transfer function
+# of each shaping in turn, and transforms each shaping back
+# Filters start from first voltage (as lowpass_filter does), so first voltage is taken off before transforming and put
+# back after (except after a CR stage, which starts from 0)
+# Waveform is zero padded until impulse response of every stage has died away (to 1e-13) so it does not wrap around
+def shaping_cascade_fft(v, tau_list, fsps, axis=-1, ladder=None):
+    from scipy import fft
+    if ladder is None:
+        ladder = [('', 0., 'rc', 1)] * len(tau_list)
+    v = np.moveaxis(np.asarray(v, dtype=float), axis, -1)
+    length = v.shape[-1]
+    if length == 0:
+        return [np.moveaxis(v.copy(), -1, axis) for tau in tau_list]
+
+    pad = 0
+    for tau, level in zip(tau_list, ladder):
+        decay = max(np.exp(-1. / (fsps * tau)), 1e-300)         # Impulse response falls by decay each sample
+        pad += (level[3] + (level[2] == 'crrc')) * int(np.ceil(np.log(1e-13) / np.log(decay)))
+    nfft = fft.next_fast_len(length + pad, real=True)
+
+    offset = v[..., :1]
+    spectrum = fft.rfft(v - offset, nfft)
+    z_inv = np.exp(-2j * np.pi * np.arange(nfft // 2 + 1) / nfft)     # z^-1 at each frequency of rfft
+    v_list = []
+    for tau, level in zip(tau_list, ladder):
+        response = lowpass_response(tau, fsps, z_inv)
+        if level[2] == 'crrc':
+            spectrum = spectrum * (1 - response)
+            offset = np.zeros_like(offset)
+        spectrum = spectrum * response ** level[3]
+        v_list.append(np.moveaxis(fft.irfft(spectrum, nfft)[..., :length] + offset, -1, axis))
+    return v_list
+
+
+# Shaping engine found for each trace length, number of waveforms & shapings (used by shaping_cascade with 'auto')
+shaping_engines = {}
+
+
+# Returns faster shaping engine ('recursive' or 'fft') for waveforms like v, timing both the first time they are used
+# for its trace length, number of waveforms & shapings
+def shaping_engine(v, tau_list, fsps, axis=-1, ladder=None):
+    shape = np.shape(v)
+    key = (shape[axis], int(np.prod(shape)) // max(shape[axis], 1), tuple(tau_list), str(ladder))
+    if key not in shaping_engines:
+        times = {}
+        for method in ['recursive', 'fft']:
+            shaping_cascade(v, tau_list, fsps, axis, ladder, method)        # Runs once first so imports are not timed
+            start_time = time.time()
+            for j in range(3):
+                shaping_cascade(v, tau_list, fsps, axis, ladder, method)
+            times[method] = time.time() - start_time
+        shaping_engines[key] = min(times, key=times.get)
+    return shaping_engines[key]
+
+
+# Returns difference between rise time of voltage array after shaping filter with given tau and goal rise time
+def tau_diff(tau, t, v, fsps, rt_goal, kind='rc', order=1):
+    return rise_time_full(t, shape_filter(v, tau, fsps, kind, order), 10, 90) - rt_goal
+
+
+# Calculates tau value for shaping filter that makes 10-90 rise time ratio times longer
+# Starts from single pole relation (10-90 rise time of each RC stage is 2.197 tau, rise times add in quadrature), widens
+# bracket around it until rise time goal is inside, then finds tau with Brent's method
+# Returns None if waveform has no usable rise time or rise time goal cannot be bracketed
+def calculate_tau(t, v, fsps, ratio=2., kind='rc', order=1):
+    from scipy.optimize import brentq
+    rt1090 = rise_time_full(t, v, 10, 90)
+    if not np.isfinite(rt1090) or rt1090 <= 0:
+        print('Error: Could not find 10-90 rise time of average waveform (rise time = ' + str(rt1090) + ' s)')
+        return None
+    rt_goal = ratio * rt1090
+    tau0 = np.sqrt((ratio ** 2 - 1) / order) * rt1090 / 2.197
+
+    tau_low = tau0 / 2
+    tau_high = tau0 * 2
+    diff_low = tau_diff(tau_low, t, v, fsps, rt_goal, kind, order)
+    for i in range(20):
+        if diff_low <= 0:
             break
+        tau_low = tau_low / 2
+        diff_low = tau_diff(tau_low, t, v, fsps, rt_goal, kind, order)
+    diff_high = tau_diff(tau_high, t, v, fsps, rt_goal, kind, order)
+    for i in range(20):
+        if diff_high >= 0:
+            break
+        tau_high = tau_high * 2
+        diff_high = tau_diff(tau_high, t, v, fsps, rt_goal, kind, order)
 
-    tau = j_array[np.argmin(np.abs(rt_array - 2 * rt1090))]
+    # Brent's method needs rise time goal between rise times at ends of bracket
+    if not (diff_low <= 0 <= diff_high):
+        print('Error: Could not find tau for %gx rise time between %.2e s and %.2e s' % (ratio, tau_low, tau_high))
+        return None
 
-    return tau
+    tau = brentq(tau_diff, tau_low, tau_high, args=(t, v, fsps, rt_goal, kind, order), xtol=1e-13)
 
+    return tau
 
-# Calculates factors for gain and adds gain to voltage arrays
-def calc_gain(v1, v2, v4, v8):
-    amp1 = min(v1)
-    amp2 = min(v2)
-    amp4 = min(v4)
-    amp8 = min(v8)
-    factor2 = amp1 / amp2
-    factor4 = amp1 / amp4
-    factor8 = amp1 / amp8
 
-    v_gain = v1 * -1
-    v2_gain = v2 * factor2 * -1
-    v4_gain = v4 * factor4 * -1
-    v8_gain = v8 * factor8 * -1
+# Calculates factors for gain of each shaping level (so amplitude of average waveform is unchanged by shaping) and adds
+# gain to voltage arrays
+def calc_gain(v_list):
+    factor_list = [min(v_list[0]) / min(v) for v in v_list]
+    v_gain_list = [v * factor * -1 for v, factor in zip(v_list, factor_list)]
 
-    return v_gain, v2_gain, v4_gain, v8_gain, factor2, factor4, factor8
+    return v_gain_list, factor_list
 
 
 # Returns time when spe waveform begins and time when spe waveform ends
@@ -294,9 +907,10 @@ def calculate_t1_t2(t, v):
     idx1 = np.inf
     idx2 = np.inf
     idx3 = np.inf
+    v_min = min(v)                  # Minimum voltage (found once instead of at every point)
 
     for i in range(len(v) - 1):
-        if v[i] <= 0.1 * min(v):
+        if v[i] <= 0.1 * v_min:
             idx1 = i
             break
         else:
@@ -306,7 +920,7 @@ def calculate_t1_t2(t, v):
         return 0, -1
     else:
         for i in range(idx1, len(v) - 1):
-            if v[i] == min(v):
+            if v[i] == v_min:
                 idx2 = i
                 break
             else:
@@ -315,7 +929,7 @@ def calculate_t1_t2(t, v):
             return 0, -1
         else:
             for i in range(len(v) - 1, idx2, -1):
-                if v[i] <= 0.1 * min(v):
+                if v[i] <= 0.1 * v_min:
                     idx3 = i
                     break
                 else:
@@ -333,14 +947,14 @@ def calculate_average(t, v):
     t1, t2 = calculate_t1_t2(t, v)
 
     try:
-        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0] - (.1 * len(t)))):
+        for i in range(int(.05 * len(t)), int(np.where(t == t1)[0][0] - (.1 * len(t)))):
             v_sum += v[i]
 
-        for i in range(int(np.where(t == t2)[0] + (.1 * len(t))), int(.95 * len(t))):
+        for i in range(int(np.where(t == t2)[0][0] + (.1 * len(t))), int(.95 * len(t))):
             v_sum += v[i]
 
-        average = v_sum / ((int(np.where(t == t1)[0] - (.1 * len(t))) - int(.05 * len(t))) +
-                           (int(.95 * len(t)) - int(np.where(t == t2)[0] + (.1 * len(t)))))
+        average = v_sum / ((int(np.where(t == t1)[0][0] - (.1 * len(t))) - int(.05 * len(t))) +
+                           (int(.95 * len(t)) - int(np.where(t == t2)[0][0] + (.1 * len(t)))))
 
         return average
 
@@ -348,8 +962,8 @@ def calculate_average(t, v):
         return np.inf
 
 
-# Returns rise times of given percentages of amplitude
-def rise_time(t, v, low, high):
+# Returns rise times of given percentages of amplitude without rounding
+def rise_time_full(t, v, low, high):
     percent_low = low / 100
     percent_high = high / 100
 
@@ -367,7 +981,13 @@ def rise_time(t, v, low, high):
     time_high = tvals[np.argmin(np.abs(vvals - val_2))]         # Finds time of point of second percent of max
 
     risetime = time_high - time_low                             # Calculates rise time
-    risetime = float(format(risetime, '.2e'))
+
+    return risetime
+
+
+# Returns rise times of given percentages of amplitude
+def rise_time(t, v, low, high):
+    risetime = float(format(rise_time_full(t, v, low, high), '.2e'))
 
     return risetime
 
@@ -381,78 +1001,59 @@ def calculate_amp(t, v):
 
 
 # Checks if calculated values are possible or not
-def check_if_impossible(risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4, amp_8):
-    if (risetime_1 == np.inf or risetime_2 == np.inf or risetime_4 == np.inf or risetime_8 == np.inf or amp_1 == np.inf
-            or amp_2 == np.inf or amp_4 == np.inf or amp_8 == np.inf or risetime_1 <= 0 or risetime_2 <= 0 or risetime_4
-            <= 0 or risetime_8 <= 0 or amp_1 <= 0 or amp_2 <= 0 or amp_4 <= 0 or amp_8 <= 0):
-        return 'impossible'
-    else:
-        return 'ok'
-
-
-# Calculates 10-90 rise time and amplitude for each shaping and returns arrays of 10-90 rise times and amplitudes
-def make_arrays(filt_path1, filt_path2, filt_path4, filt_path8, dest_path, start, end, nhdr):
-    rt_1_array = np.array([])
-    rt_2_array = np.array([])
-    rt_4_array = np.array([])
-    rt_8_array = np.array([])
-    amp_1_array = np.array([])
-    amp_2_array = np.array([])
-    amp_4_array = np.array([])
-    amp_8_array = np.array([])
+def check_if_impossible(values):
+    for value in values:
+        if value == np.inf or value <= 0:
+            return 'impossible'
+    return 'ok'
+
+
+# Calculates 10-90 rise time and amplitude for each shaping level and returns table (dict of arrays) of 10-90 rise times
+# (rt_<level>) and amplitudes (amp_<level>)
+def make_arrays(paths, dest_path, start, end, nhdr, ladder):
+    names = [level[0] for level in ladder]
+    keys = ['risetime_' + name for name in names] + ['amp_' + name for name in names]
+    columns = ['rt_' + name for name in names] + ['amp_' + name for name in names]
+    table = dict((column, []) for column in columns)
+    ledger = read_ledger(dest_path)
 
     for i in range(start, end + 1):
-        file_name1 = str(filt_path1 / 'D2--waveforms--%05d.txt') % i
-        file_name2 = str(filt_path2 / 'D2--waveforms--%05d.txt') % i
-        file_name3 = str(filt_path4 / 'D2--waveforms--%05d.txt') % i
-        file_name4 = str(filt_path8 / 'D2--waveforms--%05d.txt') % i
-        file_name5 = str(dest_path / 'calculations_single' / 'D2--waveforms--%05d.txt') % i
-
-        if os.path.isfile(file_name1):
-            # If the calculations were done previously, they are read from a file
-            if os.path.isfile(file_name5):
+        file_names = [str(path / 'D2--waveforms--%05d.txt') % i for path in paths]
+        calc_name = str(dest_path / 'calculations_single' / 'D2--waveforms--%05d.txt') % i
+
+        if os.path.isfile(file_names[0]) and check_rejected(ledger, '%05d' % i) == 'no':
+            # If the calculations were done previously for every shaping level, they are read from a file
+            values = {}
+            if os.path.isfile(calc_name):
+                values = read_calc(calc_name)
+            missing = not all(key in values for key in keys)
+            if not missing:
                 print("Reading calculations from file #%05d" % i)
-                risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4, amp_8 = read_calc(file_name5)
 
             # If the calculations were not done yet, they are calculated
             else:
                 print("Calculating file #%05d" % i)
-                t1, v1, hdr = rw(file_name1, nhdr)  # Unshaped waveform file is read
-                t2, v2, hdr = rw(file_name2, nhdr)  # 2x rise time waveform file is read
-                t4, v4, hdr = rw(file_name3, nhdr)  # 4x rise time waveform file is read
-                t8, v8, hdr = rw(file_name4, nhdr)  # 8x rise time waveform file is read
-                risetime_1 = rise_time(t1, v1, 10, 90)  # Rise time calculation is done
-                risetime_2 = rise_time(t2, v2, 10, 90)  # Rise time calculation is done
-                risetime_4 = rise_time(t4, v4, 10, 90)  # Rise time calculation is done
-                risetime_8 = rise_time(t8, v8, 10, 90)  # Rise time calculation is done
-                amp_1 = calculate_amp(t1, v1)
-                amp_2 = calculate_amp(t2, v2)
-                amp_4 = calculate_amp(t4, v4)
-                amp_8 = calculate_amp(t8, v8)
-
-            possibility = check_if_impossible(risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4,
-                                              amp_8)
-
-            # Any spe waveform that returns impossible values is put into the not_spe folder
-            if possibility == 'impossible':
+                for name, file_name in zip(names, file_names):
+                    t, v, hdr = rw(file_name, nhdr)                     # Waveform file of shaping level is read
+                    values['risetime_' + name] = rise_time(t, v, 10, 90)    # Rise time calculation is done
+                    values['amp_' + name] = calculate_amp(t, v)
+
+            # Any spe waveform that returns impossible values is rejected
+            if check_if_impossible([values[key] for key in keys]) == 'impossible':
                 print('Removing file #%05d' % i)
-                remove_spe(dest_path, i, nhdr)
+                remove_spe(dest_path, ledger, i)
 
             # All other spe waveforms' calculations are placed into arrays
             else:
-                rt_1_array = np.append(rt_1_array, risetime_1)
-                rt_2_array = np.append(rt_2_array, risetime_2)
-                rt_4_array = np.append(rt_4_array, risetime_4)
-                rt_8_array = np.append(rt_8_array, risetime_8)
-                amp_1_array = np.append(amp_1_array, amp_1)
-                amp_2_array = np.append(amp_2_array, amp_2)
-                amp_4_array = np.append(amp_4_array, amp_4)
-                amp_8_array = np.append(amp_8_array, amp_8)
-                if not os.path.isfile(file_name5):
-                    save_calculations(dest_path, i, risetime_1, risetime_2, risetime_4, risetime_8, amp_1, amp_2, amp_4,
-                                      amp_8)
+                for key, column in zip(keys, columns):
+                    table[column].append(values[key])
+                if missing:
+                    save_calculations(dest_path, i, [(key, values[key]) for key in keys])
 
-    return rt_1_array, rt_2_array, rt_4_array, rt_8_array, amp_1_array, amp_2_array, amp_4_array, amp_8_array
+    for column in columns:
+        table[column] = np.array(table[column])
+
+    return table
 
 
 # HISTOGRAMS
@@ -464,64 +1065,165 @@ def func(x, a, b, c):
     return gauss
 
 
-# Finds Gaussian fit of array
+# Finds Gaussian fit of histogram (bin centers & counts) of array, starting from mean & standard deviation of array
 def gauss_fit(array, bins, n):
-    b_est, c_est = norm.fit(array)      # Calculates mean & standard deviation based on entire array
-    range_min1 = b_est - c_est          # Calculates lower limit of Gaussian fit (1sigma estimation)
-    range_max1 = b_est + c_est          # Calculates upper limit of Gaussian fit (1sigma estimation)
-
-    bins_range1 = np.linspace(range_min1, range_max1, 10000)    # Creates array of bins between upper & lower limits
-    n_range1 = np.interp(bins_range1, bins, n)              # Interpolates & creates array of y axis values
-    guess1 = [1, float(b_est), float(c_est)]                # Defines guess for values of a, b & c in Gaussian fit
-    popt1, pcov1 = curve_fit(func, bins_range1, n_range1, p0=guess1, maxfev=10000)      # Finds Gaussian fit
-    mu1 = float(format(popt1[1], '.2e'))                        # Calculates mean based on 1sigma guess
-    sigma1 = np.abs(float(format(popt1[2], '.2e')))     # Calculates standard deviation based on 1sigma estimation
-    range_min2 = mu1 - 2 * sigma1                       # Calculates lower limit of Gaussian fit (2sigma)
-    range_max2 = mu1 + 2 * sigma1                       # Calculates upper limit of Gaussian fit (2sigma)
-    bins_range2 = np.linspace(range_min2, range_max2, 10000)    # Creates array of bins between upper & lower limits
-    n_range2 = np.interp(bins_range2, bins, n)          # Interpolates & creates array of y axis values
-    guess2 = [1, mu1, sigma1]                           # Defines guess for values of a, b & c in Gaussian fit
-    popt2, pcov2 = curve_fit(func, bins_range2, n_range2, p0=guess2, maxfev=10000)      # Finds Gaussian fit
-
-    return bins_range2, popt2, pcov2
+    return gauss_fit_bins(bins, n, float(np.mean(array)), float(np.std(array)))
+
+
+# Finds Gaussian fit of histogram (bin centers & counts) by least squares on the bins, weighting each bin by its Poisson
+# error, first within 1 sigma of mean mu and then within 2 sigma of the last fit until fit stops changing
+# Uncertainties of fit parameters are square roots of diagonal of pcov
+# Raises RuntimeError if there are not enough bins to fit or the first fit does not converge
+def gauss_fit_bins(bins, n, mu, sigma):
+    from scipy.optimize import curve_fit
+    bins = np.asarray(bins, dtype=float)
+    n = np.asarray(n, dtype=float)
+    width = 1                                   # Fits within 1 sigma first (estimation), then 2 sigma
+    fitted = False
+
+    for j in range(10):
+        in_range = (bins >= mu - width * sigma) & (bins <= mu + width * sigma)
+        if np.count_nonzero(in_range) < 4:      # Not enough bins to fit
+            break
+        guess = [np.max(n[in_range]), mu, sigma]                # Defines guess for values of a, b & c
+        try:
+            popt, pcov = curve_fit(func, bins[in_range], n[in_range], p0=guess,
+                                   sigma=np.sqrt(np.maximum(n[in_range], 1)), absolute_sigma=True, maxfev=1000)
+        except RuntimeError:
+            break
+        fitted = True
+        popt[2] = np.abs(popt[2])
+        done = width == 2 and np.abs(popt[1] - mu) < 1e-3 * sigma and np.abs(popt[2] - sigma) < 1e-3 * sigma
+        mu = float(popt[1])
+        sigma = float(popt[2])
+        width = 2
+        if done:
+            break
+    if not fitted:
+        raise RuntimeError('Could not fit Gaussian to histogram (mean %.2e, SD %.2e)' % (mu, sigma))
 
+    bins_range = np.linspace(mu - 2 * sigma, mu + 2 * sigma, 1000)      # Creates array of x values within 2 sigma
 
-# Creates histogram given an array
-def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename):
+    return bins_range, popt, pcov
 
-    path = Path(Path(dest_path) / 'plots')
-    n, bins, patches = plt.hist(array, nbins)           # Plots histogram
-    bins = np.delete(bins, len(bins) - 1)
-    bins_diff = bins[1] - bins[0]
-    bins = np.linspace(bins[0] + bins_diff / 2, bins[len(bins) - 1] + bins_diff / 2, len(bins))
 
-    bins_range, popt, pcov = gauss_fit(array, bins, n)                  # Finds Gaussian fit
-    plt.plot(bins_range, func(bins_range, *popt), color='red')          # Plots Gaussian fit (mean +/- 2sigma)
+# Histogram specifications for p2 calculations: (column of results table, file name, x axis label, title, units, number
+# of bins) for 10-90 rise time and amplitude of each shaping level
+def p2_hist_specs(nbins, ladder):
+    specs = []
+    for level in ladder:
+        specs.append(('rt_' + level[0], 'rt_' + level[0] + '_single', 'Time',
+                      '10-90 Rise Time (' + level_title(level) + ')', 's', nbins))
+    for level in ladder:
+        specs.append(('amp_' + level[0], 'amp_' + level[0] + '_single', 'Voltage',
+                      'Amplitude (' + level_title(level) + ')', 'V', nbins))
+    return specs
 
-    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
-    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
 
-    plt.xlabel(xaxis + ' (' + units + ')')
-    plt.title(title + ' of SPE\n mean: ' + str(mu2) + ' ' + units + ', SD: ' + str(sigma2) + ' ' + units)
-    plt.savefig(path / str(filename + '.png'), dpi=360)         # Plots histogram with Gaussian fit
+# Bins array into histogram accumulator, finds Gaussian fit, and bootstraps mean, SD & fit (can run in worker process,
+# with resamples drawn from a random generator seeded from seed)
+def fit_histogram(array, nbins, nboot=1000, nfit=100, seed=None):
+    rng = np.random.default_rng(seed)
+    accumulator = init_hist_accumulator(hist_edges(array, nbins))
+    update_hist_accumulator(accumulator, array)
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit, rng)
+    means, sds = bootstrap_stats(array, nboot, rng=rng)
+    rows = bootstrap_rows(np.mean(array), np.std(array), means, sds, popt, params)
 
+    return accumulator, bins_range, popt, rows
+
+
+# Saves histogram data, histogram accumulator & bootstrap intervals of fitted histogram and queues its plot
+def save_histogram(array, result, dest_path, xaxis, title, units, filename):
+    accumulator, bins_range, popt, rows = result
     write_hist_data(array, dest_path, filename + '.txt')
+    save_hist_accumulator(accumulator, Path(dest_path) / 'hist_data_single' / str(filename + '.npz'))
+    save_bootstrap(rows, Path(dest_path) / 'hist_data_single' / str(filename + '_bootstrap.txt'))
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
 
-    plt.close()
 
+# Creates histogram given an array
+def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename):
+    save_histogram(array, fit_histogram(array, nbins), dest_path, xaxis, title, units, filename)
+
+
+# Makes histograms of columns of results table (dict of arrays) given by specs ((column, file name, x axis label, title,
+# units, number of bins)), fitting them in nworkers processes, then saves them and writes one summary table
+def hist_batch(table, specs, dest_path, summary_name, nworkers=1):
+    seeds = np.random.SeedSequence().spawn(len(specs))      # Independent random streams of histograms
+    jobs = [(table[spec[0]], spec[5], 1000, 100, seed) for spec, seed in zip(specs, seeds)]
+    if nworkers > 1 and len(jobs) > 1:
+        pool = Pool(min(nworkers, len(jobs)))
+        results = pool.starmap(fit_histogram, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [fit_histogram(*job) for job in jobs]
+
+    summary = []
+    for (column, filename, xaxis, title, units, nbins), result in zip(specs, results):
+        save_histogram(table[column], result, dest_path, xaxis, title, units, filename)
+        summary.append((filename, result[0], result[3]))
+    write_hist_summary(summary, Path(dest_path) / 'hist_data_single' / summary_name)
+
+    return dict(zip([spec[1] for spec in specs], results))
 
-# Plots histograms for each calculation array
-def p2_hist(rt_1_array, rt_2_array, rt_4_array, rt_8_array, amp_1_array, amp_2_array, amp_4_array, amp_8_array,
-            dest_path, bins):
+
+# Plots histograms for each column of calculation table
+def p2_hist(table, ladder, dest_path, bins, nworkers=1):
     print('Creating histograms...')
-    plot_histogram(rt_1_array, dest_path, bins, 'Time', '10-90 Rise Time (No Shaping)', 's', 'rt_1_single')
-    plot_histogram(rt_2_array, dest_path, bins, 'Time', '10-90 Rise Time (2x Shaping)', 's', 'rt_2_single')
-    plot_histogram(rt_4_array, dest_path, bins, 'Time', '10-90 Rise Time (4x Shaping)', 's', 'rt_4_single')
-    plot_histogram(rt_8_array, dest_path, bins, 'Time', '10-90 Rise Time (8x Shaping)', 's', 'rt_8_single')
-    plot_histogram(amp_1_array, dest_path, bins, 'Voltage', 'Amplitude (No Shaping)', 'V', 'amp_1_single')
-    plot_histogram(amp_2_array, dest_path, bins, 'Voltage', 'Amplitude (2x Shaping)', 'V', 'amp_2_single')
-    plot_histogram(amp_4_array, dest_path, bins, 'Voltage', 'Amplitude (4x Shaping)', 'V', 'amp_4_single')
-    plot_histogram(amp_8_array, dest_path, bins, 'Voltage', 'Amplitude (8x Shaping)', 'V', 'amp_8_single')
+    hist_batch(table, p2_hist_specs(bins, ladder), dest_path, 'hist_summary_single.txt', nworkers)
+
+
+# SHAPING LADDER
+
+
+# Shaping levels after the unshaped one, as 10-90 rise time ratios to the unshaped waveform
+default_ladder = '2,4,8'
+
+
+# Makes list of shaping levels (name, rise time ratio, filter, number of RC stages) from comma separated levels, each
+# ratio[:rc|crrc[:stages]] (e.g. '1.5,3,6:crrc:2'), starting with the unshaped level
+# Each level is shaped from the level before it, so ratios must increase
+def parse_ladder(text):
+    ladder = [('1', 1., 'none', 0)]
+    for entry in text.split(','):
+        parts = entry.strip().split(':')
+        ratio = float(parts[0])
+        kind = 'rc'
+        order = 1
+        if len(parts) > 1:
+            kind = parts[1]
+        if len(parts) > 2:
+            order = int(parts[2])
+        if len(parts) > 3 or kind not in ['rc', 'crrc'] or order < 1 or ratio <= ladder[-1][1]:
+            raise ValueError('Invalid shaping level ' + entry + ' (must be ratio[:rc|crrc[:stages]] with increasing '
+                             'ratios)')
+        name = format(ratio, 'g')
+        if kind != 'rc' or order != 1:
+            name += '_' + kind + str(order)
+        ladder.append((name, ratio, kind, order))
+    return ladder
+
+
+# Returns name of shaping level used in titles
+def level_title(level):
+    name, ratio, kind, order = level
+    if ratio == 1:
+        return 'No Shaping'
+    elif kind == 'crrc':
+        return format(ratio, 'g') + 'x CR-RC^' + str(order) + ' Shaping'
+    elif order > 1:
+        return format(ratio, 'g') + 'x RC^' + str(order) + ' Shaping'
+    else:
+        return format(ratio, 'g') + 'x Shaping'
+
+
+# Returns folder of each shaping level
+def level_paths(dest_path, ladder):
+    return [Path(dest_path / str('rt_' + level[0] + '_single')) for level in ladder]
 
 
 # P2
@@ -534,32 +1236,19 @@ def initialize_folders(date, filter_band):
     data_path = Path(save_path / 'd1')
     initial_data = Path(data_path / 'd1b_shifted')
     dest_path = Path(save_path / 'd2')
-    filt_path1 = Path(dest_path / 'rt_1_single')
-    filt_path2 = Path(dest_path / 'rt_2_single')
-    filt_path4 = Path(dest_path / 'rt_4_single')
-    filt_path8 = Path(dest_path / 'rt_8_single')
 
-    return gen_path, save_path, data_path, initial_data, dest_path, filt_path1, filt_path2, filt_path4, \
-           filt_path8
+    return gen_path, save_path, data_path, initial_data, dest_path
 
 
 # Creates p2 folders
-def make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8):
+def make_folders(dest_path, paths):
     if not os.path.exists(dest_path):
         print('Creating d2 folder')
         os.mkdir(dest_path)
-    if not os.path.exists(filt_path1):
-        print('Creating rt 1 folder')
-        os.mkdir(filt_path1)
-    if not os.path.exists(filt_path2):
-        print('Creating rt 2 folder')
-        os.mkdir(filt_path2)
-    if not os.path.exists(filt_path4):
-        print('Creating rt 4 folder')
-        os.mkdir(filt_path4)
-    if not os.path.exists(filt_path8):
-        print('Creating rt 8 folder')
-        os.mkdir(filt_path8)
+    for path in paths:
+        if not os.path.exists(path):
+            print('Creating ' + path.name + ' folder')
+            os.mkdir(path)
     if not os.path.exists(Path(dest_path / 'hist_data_single')):
         print('Creating histogram data folder')
         os.mkdir(Path(dest_path / 'hist_data_single'))
@@ -569,87 +1258,140 @@ def make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8):
     if not os.path.exists(Path(dest_path / 'calculations_single')):
         print('Creating calculations folder')
         os.mkdir(Path(dest_path / 'calculations_single'))
-    if not os.path.exists(Path(dest_path / 'unusable_data')):
-        print('Creating unusable data folder')
-        os.mkdir(Path(dest_path / 'unusable_data'))
 
 
-# Calculates tau values for 2x, 4x, and 8x the rise time of the average waveform and shapes
-def taus(average_file, fsps, nhdr):
-    tau_2 = 1.271e-08
-    tau_4 = 1.0479999999999999e-08
-    tau_8 = 2.7539999999999997e-08
-
+# Calculates tau value of each shaping level from the average waveform, shaping it level by level, and returns list of
+# taus (0 for unshaped level) & list of shaped average waveforms, or None if a tau cannot be found
+def taus(average_file, fsps, nhdr, ladder):
     t, v1, hdr = rw(average_file, nhdr)
     v1 = -1 * v1
-    # tau_2 = calculate_tau(t, v1, fsps)
-
-    v2 = lowpass_filter(v1, tau_2, fsps)        # Creates new average waveform with 2x rise time shaping
-    # tau_4 = calculate_tau(t, v2, fsps)
-
-    v4 = lowpass_filter(v2, tau_4, fsps)        # Creates new average waveform with 4x rise time shaping
-    # tau_8 = calculate_tau(t, v4, fsps)
-
-    v8 = lowpass_filter(v4, tau_8, fsps)        # Creates new average waveform with 8x rise time shaping
-
-    return tau_2, tau_4, tau_8, v1, v2, v4, v8
 
-
-# Plots average spe waveforms with 1x, 2x, 4x, and 8x the rise time
-def avg_shapings(average_file, dest_path, v_gain, v2_gain, v4_gain, v8_gain, tau_2, tau_4, tau_8, nhdr):
+    tau_list = [0.]
+    v_list = [v1]
+    for j in range(1, len(ladder)):
+        name, ratio, kind, order = ladder[j]
+        tau = calculate_tau(t, v_list[-1], fsps, ratio / ladder[j - 1][1], kind, order)
+        if tau is None:
+            return None
+        tau_list.append(tau)
+        v_list.append(shape_filter(v_list[-1], tau, fsps, kind, order))    # Creates average waveform with shaping
+
+    return tau_list, v_list
+
+
+# Returns dict of level name: chain of shapings (sample rate, then name & tau of each level up to it) that waveforms of
+# the level were shaped through, for each shaped level of a calibration
+def level_chains(calibration):
+    chains = {}
+    if calibration is None or 'ladder' not in calibration:
+        return chains
+    try:
+        ladder = parse_ladder(calibration['ladder'])
+    except ValueError:
+        return chains
+    chain = [('fsps', calibration.get('fsps'))]
+    for level in ladder[1:]:
+        chain = chain + [(level[0], calibration.get('tau_' + level[0]))]
+        chains[level[0]] = chain
+    return chains
+
+
+# Removes shaped waveforms & calculations of every shaping level in d2 that was not shaped through the same chain of
+# shapings as in new calibration (so waveforms shaped with old taus are not mixed with new ones)
+def invalidate_levels(dest_path, old_calibration, calibration):
+    old_chains = level_chains(old_calibration)
+    new_chains = level_chains(calibration)
+    stale = []
+    for folder in sorted(os.listdir(dest_path)):
+        if folder.startswith('rt_') and folder.endswith('_single') and folder != 'rt_1_single':
+            name = folder[3:-7]
+            if name not in new_chains or old_chains.get(name) != new_chains[name]:
+                file_names = [file_name for file_name in os.listdir(dest_path / folder) if file_name.endswith('.txt')]
+                if len(file_names) > 0:
+                    stale.append(name)
+                    for file_name in file_names:
+                        os.remove(dest_path / folder / file_name)
+    if len(stale) == 0:
+        return
+
+    print('Warning: Calibration has changed, removed old waveforms & calculations of ' +
+          ', '.join(['rt_' + name for name in stale]))
+    keys = ['risetime_' + name for name in stale] + ['amp_' + name for name in stale]
+    calc_path = Path(dest_path / 'calculations_single')
+    if os.path.isdir(calc_path):
+        for file_name in os.listdir(calc_path):
+            values = read_calc(calc_path / file_name)
+            if any(key in values for key in keys):
+                myfile = open(calc_path / file_name, 'w')
+                myfile.write('\n'.join([name + ',' + str(values[name]) for name in values if name not in keys]))
+                myfile.close()
+
+
+# Finds tau & gain factor of each shaping level, reading taus from calibration file if it was made from the same
+# average waveform, sample rate & ladder, otherwise calculating them and writing calibration file for p2 double & p3
+# (after removing shaped waveforms & calculations made with other taus)
+# Returns lists of taus, gain factors & shaped average waveforms with gain, or None if taus cannot be found
+def calibrate(average_file, dest_path, fsps, nhdr, ladder_text, ladder):
+    file_name = Path(dest_path / 'calibration.txt')
+    template_md5 = file_md5(average_file)
+    calibration = read_calibration(file_name)
+
+    if calibration is not None and calibration.get('template_md5') == template_md5 and \
+            calibration.get('fsps') == str(float(fsps)) and calibration.get('ladder') == ladder_text and \
+            all('tau_' + level[0] in calibration for level in ladder):
+        print('Reading taus from calibration file')
+        t, v1, hdr = rw(average_file, nhdr)
+        v1 = -1 * v1
+        tau_list = [float(calibration['tau_' + level[0]]) for level in ladder]
+        v_list = [v1] + shaping_cascade(v1, tau_list[1:], fsps, ladder=ladder[1:])
+        v_gain_list, factor_list = calc_gain(v_list)
+    else:
+        old_calibration = calibration
+        result = taus(average_file, fsps, nhdr, ladder)
+        if result is None:
+            return None
+        tau_list, v_list = result
+        v_gain_list, factor_list = calc_gain(v_list)
+        calibration = {'template': str(average_file), 'template_md5': template_md5, 'fsps': str(float(fsps)),
+                       'ladder': ladder_text}
+        for level, tau, factor in zip(ladder, tau_list, factor_list):
+            calibration['tau_' + level[0]] = str(float(tau))
+            calibration['factor_' + level[0]] = str(float(factor))
+        invalidate_levels(Path(dest_path), old_calibration, calibration)
+        write_calibration(file_name, calibration)
+
+    return tau_list, factor_list, v_gain_list
+
+
+# Plots average spe waveforms of each shaping level
+def avg_shapings(average_file, dest_path, v_gain_list, ladder, tau_list, nhdr):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(average_file, nhdr)
-    plt.plot(t, v_gain)
-    plt.plot(t, v2_gain)
-    plt.plot(t, v4_gain)
-    plt.plot(t, v8_gain)
+    for level, v_gain, tau in zip(ladder, v_gain_list, tau_list):
+        if tau > 0:
+            plt.plot(t, v_gain, label=level_title(level) + ', tau = ' + str(format(tau, '.2e')) + ' s')
+        else:
+            plt.plot(t, v_gain, label=level_title(level))
     plt.xlabel('Time (s)')
     plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveforms\norange tau = ' + str(format(tau_2, '.2e')) + ' s, green tau = ' +
-              str(format(tau_4, '.2e')) + ' s, red tau = ' + str(format(tau_8, '.2e')) + ' s')
+    plt.title('Average Waveforms')
+    plt.legend()
     plt.savefig(dest_path / 'plots' / 'avg_waveforms_single.png', dpi=360)
     plt.close()
 
 
-# Calculates and saves waveforms with 1x, 2x, 4x, and 8x the rise time
-def do_shaping(save_name1, save_name2, save_name4, save_name8, i, tau_2, tau_4, tau_8, factor2, factor4,
-               factor8, fsps, nhdr):
-    if os.path.isfile(save_name2):
-        print('File #%05d in rt_2 folder' % i)
-    else:
-        if os.path.isfile(save_name1):
-            t1, v1, hdr = rw(save_name1, nhdr)
-            v2 = lowpass_filter(v1, tau_2, fsps)
-            v2_gain = v2 * factor2
-            t2 = t1
-            ww(t2, v2_gain, save_name2, hdr)
-            print('File #%05d in rt_2 folder' % i)
-        else:
-            pass
-
-    if os.path.isfile(save_name4):
-        print('File #%05d in rt_4 folder' % i)
-    else:
-        if os.path.isfile(save_name2):
-            t2, v2, hdr = rw(save_name2, nhdr)
-            v2 = v2 / factor2
-            v4 = lowpass_filter(v2, tau_4, fsps)
-            v4_gain = v4 * factor4
-            t4 = t2
-            ww(t4, v4_gain, save_name4, hdr)
-            print('File #%05d in rt_4 folder' % i)
-        else:
-            pass
-
-    if os.path.isfile(save_name8):
-        print('File #%05d in rt_8 folder' % i)
-    else:
-        if os.path.isfile(save_name4):
-            t4, v4, hdr = rw(save_name4, nhdr)
-            v4 = v4 / factor4
-            v8 = lowpass_filter(v4, tau_8, fsps)
-            v8_gain = v8 * factor8
-            t8 = t4
-            ww(t8, v8_gain, save_name8, hdr)
-            print('File #%05d in rt_8 folder' % i)
-        else:
-            pass
+# Calculates and saves waveform of each shaping level (save_names indexed by level, first is unshaped waveform)
+def do_shaping(save_names, i, ladder, tau_list, factor_list, fsps, nhdr):
+    # Reads unshaped waveform once and shapes it level by level in memory (without rounding from files in between),
+    # then writes missing levels
+    missing = [not os.path.isfile(save_name) for save_name in save_names[1:]]
+    if any(missing) and os.path.isfile(save_names[0]):
+        t, v1, hdr = rw(save_names[0], nhdr)
+        v_list = shaping_cascade(v1, tau_list[1:], fsps, ladder=ladder[1:])
+        for save_name, v, factor, write in zip(save_names[1:], v_list, factor_list[1:], missing):
+            if write:
+                ww(t, v * factor, save_name, hdr)
+
+    for level, save_name in zip(ladder[1:], save_names[1:]):
+        if os.path.isfile(save_name):
+            print('File #%05d in rt_%s folder' % (i, level[0]))
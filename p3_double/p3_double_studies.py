@@ -2,20 +2,39 @@ from p3_functions import *
 
 
 # Downsamples and digitizes double spe waveforms, then calculates charge, amplitude, and FWHM
-def double_spe_studies(date, filter_band, nhdr, delay_folder, fsps, fsps_new, noise, r):
+# If virtual, double spe waveforms are generated in memory from pair manifest made by p2 instead of copied from d2
+def double_spe_studies(date, filter_band, nhdr, delay_folder, fsps, fsps_new, noise, r, nworkers=1, dpi=360,
+                       no_plots=False, virtual=False):
     gen_path, save_path, data_path, dest_path, filt_path1, filt_path2, filt_path4, filt_path8 = \
         initialize_folders(date, filter_band)
     make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8, fsps_new, delay_folder)
 
+    # Keeps calibration of shapings from p2 with d3 waveforms
+    calibration = copy_calibration(data_path, dest_path)
+
+    if virtual:
+        manifest = read_manifest(manifest_name(data_path, delay_folder))
+        if manifest is None:
+            print('Error: No pair manifest for ' + delay_folder + ' in d2 (run p2_create_double with --virtual first)')
+            return
+        calibration = calibration_lists(save_path, calibration, fsps)
+        if calibration is None:
+            return
+        tau_list, factor_list = calibration
+
     single_file_array, double_file_array = initial_arrays(Path(Path(dest_path / 'rt_1_single_2') / 'raw'),
                                                           Path(filt_path1 / 'raw' / delay_folder))
 
     single_file_array_2, double_file_array_2 = initial_arrays_2(Path(data_path / 'rt_1_single_2'),
-                                                                Path(data_path / 'rt_1_double' / delay_folder))
+                                                                Path(data_path / 'rt_1_double' / delay_folder),
+                                                                read_ledger(data_path))
 
     single_file_array = copy_s_waveforms(single_file_array_2, single_file_array, data_path, dest_path, nhdr)
-    double_file_array = copy_d_waveforms(double_file_array_2, double_file_array, data_path, filt_path1, filt_path2,
-                                         filt_path4, filt_path8, delay_folder, nhdr)
+    if virtual:
+        double_file_array = np.array([])
+    else:
+        double_file_array = copy_d_waveforms(double_file_array_2, double_file_array, data_path, filt_path1, filt_path2,
+                                             filt_path4, filt_path8, delay_folder, nhdr)
 
     down_dig(single_file_array, double_file_array, filt_path1, filt_path2, filt_path4, filt_path8, dest_path,
              delay_folder, fsps, fsps_new, noise, nhdr)
@@ -35,25 +54,39 @@ def double_spe_studies(date, filter_band, nhdr, delay_folder, fsps, fsps_new, no
                       dest_path, single_file_array, nhdr, r, fsps_new, 'rt_8')
 
     # Creates double spe arrays for charge, amplitude, and FWHM
-    t1_array_d_1, t2_array_d_1, charge_array_d_1, amplitude_array_d_1, fwhm_array_d_1 = \
-        make_arrays_d(Path(dest_path / 'rt_1_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
-                           delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_1')
-    t1_array_d_2, t2_array_d_2, charge_array_d_2, amplitude_array_d_2, fwhm_array_d_2 = \
-        make_arrays_d(Path(dest_path / 'rt_2_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
-                           delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_2')
-    t1_array_d_4, t2_array_d_4, charge_array_d_4, amplitude_array_d_4, fwhm_array_d_4 = \
-        make_arrays_d(Path(dest_path / 'rt_4_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
-                           delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_4')
-    t1_array_d_8, t2_array_d_8, charge_array_d_8, amplitude_array_d_8, fwhm_array_d_8 = \
-        make_arrays_d(Path(dest_path / 'rt_8_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
-                           delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_8')
+    if virtual:
+        arrays_d = make_arrays_d_virtual(manifest, Path(data_path / 'rt_1_single'), dest_path, delay_folder, tau_list,
+                                         factor_list, nhdr, r, fsps, fsps_new, noise)
+        t1_array_d_1, t2_array_d_1, charge_array_d_1, amplitude_array_d_1, fwhm_array_d_1 = arrays_d['rt_1']
+        t1_array_d_2, t2_array_d_2, charge_array_d_2, amplitude_array_d_2, fwhm_array_d_2 = arrays_d['rt_2']
+        t1_array_d_4, t2_array_d_4, charge_array_d_4, amplitude_array_d_4, fwhm_array_d_4 = arrays_d['rt_4']
+        t1_array_d_8, t2_array_d_8, charge_array_d_8, amplitude_array_d_8, fwhm_array_d_8 = arrays_d['rt_8']
+    else:
+        t1_array_d_1, t2_array_d_1, charge_array_d_1, amplitude_array_d_1, fwhm_array_d_1 = \
+            make_arrays_d(Path(dest_path / 'rt_1_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
+                               delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_1')
+        t1_array_d_2, t2_array_d_2, charge_array_d_2, amplitude_array_d_2, fwhm_array_d_2 = \
+            make_arrays_d(Path(dest_path / 'rt_2_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
+                               delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_2')
+        t1_array_d_4, t2_array_d_4, charge_array_d_4, amplitude_array_d_4, fwhm_array_d_4 = \
+            make_arrays_d(Path(dest_path / 'rt_4_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
+                               delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_4')
+        t1_array_d_8, t2_array_d_8, charge_array_d_8, amplitude_array_d_8, fwhm_array_d_8 = \
+            make_arrays_d(Path(dest_path / 'rt_8_double' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
+                               delay_folder), dest_path, delay_folder, double_file_array, nhdr, r, fsps_new, 'rt_8')
 
     # Creates single and double spe histograms for charge, amplitude, and FWHM
     p3_hist(dest_path, delay_folder, charge_array_s_1, charge_array_s_2, charge_array_s_4, charge_array_s_8,
             amplitude_array_s_1, amplitude_array_s_2, amplitude_array_s_4, amplitude_array_s_8, fwhm_array_s_1,
             fwhm_array_s_2, fwhm_array_s_4, fwhm_array_s_8, charge_array_d_1, charge_array_d_2, charge_array_d_4,
             charge_array_d_8, amplitude_array_d_1, amplitude_array_d_2, amplitude_array_d_4, amplitude_array_d_8,
-            fwhm_array_d_1, fwhm_array_d_2, fwhm_array_d_4, fwhm_array_d_8, fsps_new)
+            fwhm_array_d_1, fwhm_array_d_2, fwhm_array_d_4, fwhm_array_d_8, fsps_new, nworkers)
+
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
 
 
 if __name__ == '__main__':
@@ -70,7 +103,13 @@ if __name__ == '__main__':
                         default=500000000.)
     parser.add_argument("--noise", type=float, help='noise to add (bits) (default=3.30)', default=3.30)
     parser.add_argument("--r", type=int, help='resistance in ohms (default=50)', default=50)
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for fitting histograms & rendering plots '
+                                                  '(default=1)', default=1)
+    parser.add_argument("--virtual", action='store_true', help='generate double spe waveforms from pair manifest in d2 '
+                                                               'instead of copying them')
     args = parser.parse_args()
 
     double_spe_studies(args.date, args.fil_band, args.nhdr, args.delay_folder, args.fsps, args.fsps_new, args.noise,
-                       args.r)
+                       args.r, args.cores, args.dpi, args.no_plots, args.virtual)
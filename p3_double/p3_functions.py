@@ -1,12 +1,12 @@
 import os
 import csv
+import time
+import hashlib
 import datetime
 import numpy as np
 import math
-import matplotlib.pyplot as plt
 from pathlib import Path
-from scipy.optimize import curve_fit
-from scipy.stats import norm
+from multiprocessing import Pool
 import random
 
 
@@ -142,40 +142,137 @@ def read_info(myfile):
         i_amp, i_band, i_nfilter
 
 
-# Creates text file with data from an array
-def write_hist_data_s(array, dest_path, name):
-    array = np.sort(array)
-    file_name = Path(Path(dest_path) / 'hist_data_single' / name)
+# Creates name of histogram data file from quantity, sample rate, shaping, and delay folder ('' for single spes)
+def hist_data_name(quantity, fsps_new, shaping, delay_folder):
+    name = quantity + '_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping
+    if delay_folder == '':
+        return name + '_single'
+    else:
+        return name + '_double_' + delay_folder
 
-    myfile = open(file_name, 'w')
-    for item in array:  # Writes an array item on each line of file
-        myfile.write(str(item) + '\n')
-    myfile.close()
 
+# Saves sorted array as binary histogram data file
+def write_hist_data(array, dest_path, quantity, fsps_new, shaping, delay_folder):
+    if delay_folder == '':
+        folder = Path(Path(dest_path) / 'hist_data_single')
+    else:
+        folder = Path(Path(dest_path) / 'hist_data_double')
+    np.save(folder / str(hist_data_name(quantity, fsps_new, shaping, delay_folder) + '.npy'), np.sort(array))
 
-# Creates text file with data from an array
-def write_hist_data_d(array, dest_path, name):
-    array = np.sort(array)
-    file_name = Path(Path(dest_path) / 'hist_data_double' / name)
 
-    myfile = open(file_name, 'w')
-    for item in array:  # Writes an array item on each line of file
-        myfile.write(str(item) + '\n')
-    myfile.close()
+# Reads binary histogram data file, or text histogram data file (one value per line) if binary file does not exist
+def read_hist_file(filename):
+    filename = Path(filename)
+    if os.path.isfile(filename.with_suffix('.npy')):
+        return np.load(filename.with_suffix('.npy'))
+    else:
+        return np.loadtxt(filename.with_suffix('.txt'), ndmin=1)
 
 
-def read_hist_file(filename):
-    array = np.array([])
+# Returns md5 checksum of a file
+def file_md5(file_name):
+    myfile = open(file_name, 'rb')
+    checksum = hashlib.md5(myfile.read()).hexdigest()
+    myfile.close()
+    return checksum
+
 
-    myfile = open(filename, 'r')                # Opens file
-    for line in myfile:                         # Reads values & saves in an array
-        line = line.strip()
-        line = float(line)
-        array = np.append(array, line)          # Closes histogram file
+# Writes calibration file (dict of name & value rows, e.g. md5 checksum of average waveform template, taus & gain
+# factors of shapings)
+def write_calibration(file_name, calibration):
+    myfile = open(file_name, 'w', newline='')
+    csv_writer = csv.writer(myfile)
+    for name in calibration:
+        csv_writer.writerow([name, calibration[name]])
     myfile.close()
 
-    return array
 
+# Reads calibration file into dict (values are strings), or returns None if there is no calibration file
+def read_calibration(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    calibration = {}
+    for row in csv.reader(myfile):
+        calibration[row[0]] = row[1]
+    myfile.close()
+    return calibration
+
+
+# Reads calibration file of d2 (taus & gain factors of shapings made by p2) and copies it to d3, warning if d3 already
+# has waveforms shaped with a calibration from a different average waveform
+# Returns calibration dict, or None if d2 has no calibration file
+def copy_calibration(data_path, dest_path):
+    calibration = read_calibration(Path(data_path / 'calibration.txt'))
+    if calibration is None:
+        print('No calibration file in d2')
+        return None
+    old_calibration = read_calibration(Path(dest_path / 'calibration.txt'))
+    if old_calibration is not None and old_calibration.get('template_md5') != calibration.get('template_md5'):
+        print('Warning: d3 has waveforms shaped with a different calibration (rerun p3 on all waveforms)')
+    write_calibration(Path(dest_path / 'calibration.txt'), calibration)
+    print('Shaping taus (s): ' + ', '.join(['rt_' + name[4:] + ' ' + calibration[name] for name in calibration
+                                             if name.startswith('tau_') and name != 'tau_1']))
+    return calibration
+
+
+# Shaping levels after the unshaped one, as 10-90 rise time ratios to the unshaped waveform
+default_ladder = '2,4,8'
+
+
+# Makes list of shaping levels (name, rise time ratio, filter, number of RC stages) from comma separated levels, each
+# ratio[:rc|crrc[:stages]] (e.g. '1.5,3,6:crrc:2'), starting with the unshaped level
+# Each level is shaped from the level before it, so ratios must increase
+def parse_ladder(text):
+    ladder = [('1', 1., 'none', 0)]
+    for entry in text.split(','):
+        parts = entry.strip().split(':')
+        ratio = float(parts[0])
+        kind = 'rc'
+        order = 1
+        if len(parts) > 1:
+            kind = parts[1]
+        if len(parts) > 2:
+            order = int(parts[2])
+        if len(parts) > 3 or kind not in ['rc', 'crrc'] or order < 1 or ratio <= ladder[-1][1]:
+            raise ValueError('Invalid shaping level ' + entry + ' (must be ratio[:rc|crrc[:stages]] with increasing '
+                             'ratios)')
+        name = format(ratio, 'g')
+        if kind != 'rc' or order != 1:
+            name += '_' + kind + str(order)
+        ladder.append((name, ratio, kind, order))
+    return ladder
+
+
+# Checks that shaping ladder of calibration starts with the 2x, 4x, and 8x single RC shapings of the default ladder,
+# so taus of 2x, 4x, and 8x shapings shape unshaped waveforms through each other as they did in p2
+def default_levels(calibration):
+    try:
+        ladder = parse_ladder(calibration.get('ladder', ''))
+    except ValueError:
+        return False
+    return ladder[1:4] == parse_ladder(default_ladder)[1:]
+
+
+# Reads taus & gain factors of 2x, 4x, and 8x shapings from calibration of p2, checking that it was made from the
+# current average waveform & sample rate with the default shaping ladder
+# Returns lists of taus & gain factors, or None if calibration is not usable
+def calibration_lists(save_path, calibration, fsps):
+    names = ['2', '4', '8']
+    if calibration is None or not default_levels(calibration) or \
+            not all('tau_' + name in calibration and 'factor_' + name in calibration for name in names):
+        print('Error: Calibration file does not start with 2x, 4x, and 8x shapings (run p2 with default shaping '
+              'ladder)')
+        return None
+    average_file = Path(save_path / 'd1' / 'hist_data' / 'avg_waveform_d1b.txt')
+    if os.path.isfile(average_file) and file_md5(average_file) != calibration.get('template_md5'):
+        print('Warning: Average waveform has changed since calibration (rerun p2 to update taus & gain factors)')
+    if calibration.get('fsps') != str(float(fsps)):
+        print('Warning: Calibration was made at ' + str(calibration.get('fsps')) + ' samples per second')
+
+    tau_list = [float(calibration['tau_' + name]) for name in names]
+    factor_list = [float(calibration['factor_' + name]) for name in names]
+    return tau_list, factor_list
 
 # HISTOGRAMS
 
@@ -186,102 +283,165 @@ def func(x, a, b, c):
     return gauss
 
 
-# Finds Gaussian fit of array
+# Finds Gaussian fit of histogram (bin centers & counts) of array, starting from mean & standard deviation of array
 def gauss_fit(array, bins, n):
-    b_est, c_est = norm.fit(array)      # Calculates mean & standard deviation based on entire array
-    range_min1 = b_est - c_est          # Calculates lower limit of Gaussian fit (1sigma estimation)
-    range_max1 = b_est + c_est          # Calculates upper limit of Gaussian fit (1sigma estimation)
-
-    bins_range1 = np.linspace(range_min1, range_max1, 10000)    # Creates array of bins between upper & lower limits
-    n_range1 = np.interp(bins_range1, bins, n)              # Interpolates & creates array of y axis values
-    guess1 = [1, float(b_est), float(c_est)]                # Defines guess for values of a, b & c in Gaussian fit
-    popt1, pcov1 = curve_fit(func, bins_range1, n_range1, p0=guess1, maxfev=100000)      # Finds Gaussian fit
-    mu1 = float(format(popt1[1], '.2e'))                        # Calculates mean based on 1sigma guess
-    sigma1 = np.abs(float(format(popt1[2], '.2e')))     # Calculates standard deviation based on 1sigma estimation
-    range_min2 = mu1 - 2 * sigma1                       # Calculates lower limit of Gaussian fit (2sigma)
-    range_max2 = mu1 + 2 * sigma1                       # Calculates upper limit of Gaussian fit (2sigma)
-    bins_range2 = np.linspace(range_min2, range_max2, 10000)    # Creates array of bins between upper & lower limits
-    n_range2 = np.interp(bins_range2, bins, n)          # Interpolates & creates array of y axis values
-    guess2 = [1, mu1, sigma1]                           # Defines guess for values of a, b & c in Gaussian fit
-    popt2, pcov2 = curve_fit(func, bins_range2, n_range2, p0=guess2, maxfev=100000)      # Finds Gaussian fit
-
-    return bins_range2, popt2, pcov2
+    return gauss_fit_bins(bins, n, float(np.mean(array)), float(np.std(array)))
+
+
+# Finds Gaussian fit of histogram (bin centers & counts) by least squares on the bins, weighting each bin by its Poisson
+# error, first within 1 sigma of mean mu and then within 2 sigma of the last fit until fit stops changing
+# Uncertainties of fit parameters are square roots of diagonal of pcov
+# Raises RuntimeError if there are not enough bins to fit or the first fit does not converge
+def gauss_fit_bins(bins, n, mu, sigma):
+    from scipy.optimize import curve_fit
+    bins = np.asarray(bins, dtype=float)
+    n = np.asarray(n, dtype=float)
+    width = 1                                   # Fits within 1 sigma first (estimation), then 2 sigma
+    fitted = False
+
+    for j in range(10):
+        in_range = (bins >= mu - width * sigma) & (bins <= mu + width * sigma)
+        if np.count_nonzero(in_range) < 4:      # Not enough bins to fit
+            break
+        guess = [np.max(n[in_range]), mu, sigma]                # Defines guess for values of a, b & c
+        try:
+            popt, pcov = curve_fit(func, bins[in_range], n[in_range], p0=guess,
+                                   sigma=np.sqrt(np.maximum(n[in_range], 1)), absolute_sigma=True, maxfev=1000)
+        except RuntimeError:
+            break
+        fitted = True
+        popt[2] = np.abs(popt[2])
+        done = width == 2 and np.abs(popt[1] - mu) < 1e-3 * sigma and np.abs(popt[2] - sigma) < 1e-3 * sigma
+        mu = float(popt[1])
+        sigma = float(popt[2])
+        width = 2
+        if done:
+            break
+    if not fitted:
+        raise RuntimeError('Could not fit Gaussian to histogram (mean %.2e, SD %.2e)' % (mu, sigma))
 
+    bins_range = np.linspace(mu - 2 * sigma, mu + 2 * sigma, 1000)      # Creates array of x values within 2 sigma
 
-# Creates histogram given an array
-def plot_histogram(array, dest_path, nbins, xaxis, title, units, filename, type):
+    return bins_range, popt, pcov
 
-    path = Path(Path(dest_path) / 'plots')
-    n, bins, patches = plt.hist(array, nbins)           # Plots histogram
-    bins = np.delete(bins, len(bins) - 1)
-    bins_diff = bins[1] - bins[0]
-    bins = np.linspace(bins[0] + bins_diff / 2, bins[len(bins) - 1] + bins_diff / 2, len(bins))
 
-    bins_range, popt, pcov = gauss_fit(array, bins, n)                  # Finds Gaussian fit
-    plt.plot(bins_range, func(bins_range, *popt), color='red')          # Plots Gaussian fit (mean +/- 2sigma)
+# Quantities histograms are made for: (quantity, x axis label, title, units)
+hist_quantities = [('charge', 'Charge', 'Charge', 's*bit/ohm'), ('amplitude', 'Voltage', 'Amplitude', 'bits'),
+                   ('fwhm', 'Time', 'FWHM', 's')]
 
-    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
-    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
 
-    plt.xlabel(xaxis + ' (' + units + ')')
-    plt.title(title + ' of SPE\n mean: ' + str(mu2) + ' ' + units + ', SD: ' + str(sigma2) + ' ' + units)
-    plt.savefig(path / str(filename + '.png'), dpi=360)         # Plots histogram with Gaussian fit
+# Histogram specifications for p3 double calculations: (column of results table (quantity, shaping, delay folder),
+# x axis label, title, units, number of bins) for each quantity & shaping of single spes ('' delay folder), then double
+# spes
+def p3_hist_specs(shapings, delay_folder, nbins):
+    specs = []
+    for delay in ['', delay_folder]:
+        for shaping in shapings:
+            for quantity, xaxis, title, units in hist_quantities:
+                specs.append(((quantity, shaping, delay), xaxis, title, units, nbins))
+    return specs
 
-    if type == 'single':
-        write_hist_data_s(array, dest_path, filename + '.txt')
-    else:
-        write_hist_data_d(array, dest_path, filename + '.txt')
 
-    plt.close()
+# Bins array into histogram accumulator, finds Gaussian fit, and bootstraps mean, SD & fit (can run in worker process,
+# with resamples drawn from a random generator seeded from seed)
+def fit_histogram(array, nbins, nboot=1000, nfit=100, seed=None):
+    rng = np.random.default_rng(seed)
+    accumulator = init_hist_accumulator(hist_edges(array, nbins))
+    update_hist_accumulator(accumulator, array)
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit, rng)
+    means, sds = bootstrap_stats(array, nboot, rng=rng)
+    rows = bootstrap_rows(np.mean(array), np.std(array), means, sds, popt, params)
 
-    mean = mu2
+    return accumulator, bins_range, popt, rows
 
-    return mean
 
+# Saves histogram data, histogram accumulator & bootstrap intervals of fitted histogram and queues its plot
+def save_histogram(array, result, dest_path, xaxis, title, units, quantity, fsps_new, shaping, delay_folder):
+    accumulator, bins_range, popt, rows = result
+    filename = hist_data_name(quantity, fsps_new, shaping, delay_folder)
+    if delay_folder == '':
+        hist_path = Path(Path(dest_path) / 'hist_data_single')
+    else:
+        hist_path = Path(Path(dest_path) / 'hist_data_double')
+    write_hist_data(array, dest_path, quantity, fsps_new, shaping, delay_folder)
+    save_hist_accumulator(accumulator, hist_path / str(filename + '.npz'))
+    save_bootstrap(rows, hist_path / str(filename + '_bootstrap.txt'))
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
 
-# Creates two histograms on top of each other given two arrays
-def plot_histograms(array1, array2, dest_path, nbins, xaxis, title, units, filename):
 
-    path = Path(Path(dest_path) / 'plots')
+# Creates histogram given an array
+def plot_histogram(array, dest_path, nbins, xaxis, title, units, quantity, fsps_new, shaping, delay_folder):
+    result = fit_histogram(array, nbins)
+    save_histogram(array, result, dest_path, xaxis, title, units, quantity, fsps_new, shaping, delay_folder)
+    mean = float(format(result[2][1], '.2e'))
+
+    return mean
 
-    n1, bins1, patches1 = plt.hist(array1, nbins)               # Plots histogram 1
-    bins1 = np.delete(bins1, len(bins1) - 1)
-    bins_diff1 = bins1[1] - bins1[0]
-    bins1 = np.linspace(bins1[0] + bins_diff1 / 2, bins1[len(bins1) - 1] + bins_diff1 / 2, len(bins1))
 
-    bins_range1, popt1, pcov1 = gauss_fit(array1, bins1, n1)            # Finds Gaussian fit of histogram 1
-    plt.plot(bins_range1, func(bins_range1, *popt1), color='red')       # Plots Gaussian fit (mean +/- 2sigma) of hist 1
+# Queues plot of two histograms fitted by fit_histogram (single & double spes) with their Gaussian fits on same plot
+def queue_hist_pair_plot(result1, result2, dest_path, xaxis, title, units, filename):
+    path = Path(Path(dest_path) / 'plots')
+    accumulator1, bins_range1, popt1, rows1 = result1
+    accumulator2, bins_range2, popt2, rows2 = result2
 
     mu2_1 = float(format(popt1[1], '.2e'))                  # Calculates mean of hist 1
     sigma2_1 = np.abs(float(format(popt1[2], '.2e')))       # Calculates standard deviation of hist 1
+    mu2_2 = float(format(popt2[1], '.2e'))                  # Calculates mean of hist 2
+    sigma2_2 = np.abs(float(format(popt2[2], '.2e')))       # Calculates standard deviation of hist 2
 
-    n2, bins2, patches2 = plt.hist(array2, nbins)               # Plots histogram 2
-    bins2 = np.delete(bins2, len(bins2) - 1)
-    bins_diff2 = bins2[1] - bins2[0]
-    bins2 = np.linspace(bins2[0] + bins_diff2 / 2, bins2[len(bins2) - 1] + bins_diff2 / 2, len(bins2))
+    # Queues histograms with Gaussian fits (mean +/- 2sigma) to be plotted
+    queue_plot('histogram', path / str(filename + '.png'),
+               {'arrays': [], 'counts': [(accumulator1['edges'], accumulator1['counts']),
+                                         (accumulator2['edges'], accumulator2['counts'])],
+                'fits': [(bins_range1, popt1, 'red'), (bins_range2, popt2, 'green')],
+                'xlabel': xaxis + ' (' + units + ')', 'fontsize': 'medium',
+                'title': title + ' of SPE\n mean (single): ' + str(mu2_1) + error_text(rows1[2]) + ' ' + units +
+                         ', SD (single): ' + str(sigma2_1) + error_text(rows1[3]) + ' ' + units +
+                         '\n mean (double): ' + str(mu2_2) + error_text(rows2[2]) + ' ' + units + ', SD (double): ' +
+                         str(sigma2_2) + error_text(rows2[3]) + ' ' + units})
 
-    bins_range2, popt2, pcov2 = gauss_fit(array2, bins2, n2)            # Finds Gaussian fit of histogram 2
-    plt.plot(bins_range2, func(bins_range2, *popt2), color='green')     # Plots Gaussian fit (mean +/- 2sigma) of hist 2
 
-    mu2_2 = float(format(popt2[1], '.2e'))                  # Calculates mean of hist 2
-    sigma2_2 = np.abs(float(format(popt2[2], '.2e')))       # Calculates standard deviation of hist 2
+# Creates two histograms on top of each other given two arrays
+def plot_histograms(array1, array2, dest_path, nbins, xaxis, title, units, filename):
+    queue_hist_pair_plot(fit_histogram(array1, nbins), fit_histogram(array2, nbins), dest_path, xaxis, title, units,
+                         filename)
+
+
+# Makes histograms of columns of results table (dict of arrays) given by specs ((column, x axis label, title, units,
+# number of bins), where column is (quantity, shaping, delay folder)), fitting them in nworkers processes, then saves
+# them and writes one summary table
+def hist_batch(table, specs, dest_path, fsps_new, summary_name, nworkers=1):
+    seeds = np.random.SeedSequence().spawn(len(specs))      # Independent random streams of histograms
+    jobs = [(table[spec[0]], spec[4], 1000, 100, seed) for spec, seed in zip(specs, seeds)]
+    if nworkers > 1 and len(jobs) > 1:
+        pool = Pool(min(nworkers, len(jobs)))
+        results = pool.starmap(fit_histogram, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [fit_histogram(*job) for job in jobs]
 
-    plt.xlabel(xaxis + ' (' + units + ')')
-    plt.title(title + ' of SPE\n mean (single): ' + str(mu2_1) + ' ' + units + ', SD (single): ' + str(sigma2_1) +
-              ' ' + units + '\n mean (double): ' + str(mu2_2) + ' ' + units + ', SD (double): ' + str(sigma2_2) +
-              ' ' + units, fontsize='medium')
-    plt.savefig(path / str(filename + '.png'), dpi=360)         # Plots histogram with Gaussian fit
+    summary = []
+    for ((quantity, shaping, delay), xaxis, title, units, nbins), result in zip(specs, results):
+        save_histogram(table[(quantity, shaping, delay)], result, dest_path, xaxis, title, units, quantity, fsps_new,
+                       shaping, delay)
+        summary.append((hist_data_name(quantity, fsps_new, shaping, delay), result[0], result[3]))
+    write_hist_summary(summary, Path(dest_path) / 'hist_data_double' / summary_name)
 
-    plt.close()
+    return dict(zip([spec[0] for spec in specs], results))
 
 
 # Plots histograms for each type of calculation array
-def make_hist(charge_array, amplitude_array, fwhm_array, dest_path, bins, version, type):
-    mean_charge = plot_histogram(charge_array, dest_path, bins, 'Charge', 'Charge', 's*bit/ohm', 'charge_' + version,
-                                 type)
-    mean_amp = plot_histogram(amplitude_array, dest_path, bins, 'Voltage', 'Amplitude', 'bits', 'amplitude_' + version,
-                              type)
-    mean_fwhm = plot_histogram(fwhm_array, dest_path, bins, 'Time', 'FWHM', 's', 'fwhm_' + version, type)
+def make_hist(charge_array, amplitude_array, fwhm_array, dest_path, bins, fsps_new, shaping, delay_folder):
+    table = {('charge', shaping, delay_folder): charge_array, ('amplitude', shaping, delay_folder): amplitude_array,
+             ('fwhm', shaping, delay_folder): fwhm_array}
+    specs = [((quantity, shaping, delay_folder), xaxis, title, units, bins) for quantity, xaxis, title, units in
+             hist_quantities]
+    results = hist_batch(table, specs, dest_path, fsps_new,
+                         hist_data_name('hist_summary', fsps_new, shaping, delay_folder) + '.txt')
+    mean_charge, mean_amp, mean_fwhm = [float(format(results[spec[0]][2][1], '.2e')) for spec in specs]
 
     return mean_charge, mean_amp, mean_fwhm
 
@@ -297,119 +457,631 @@ def make_double_hist(charge_array_s, amplitude_array_s, fwhm_array_s, charge_arr
                     'fwhm_' + version)
 
 
-# Plots histograms for each calculation array
+# Plots histograms for each calculation array, then single and double histograms on same plot (using same fits)
 def p3_hist(dest_path, delay_folder, charge_array_s_1, charge_array_s_2, charge_array_s_4, charge_array_s_8,
             amplitude_array_s_1, amplitude_array_s_2, amplitude_array_s_4, amplitude_array_s_8, fwhm_array_s_1,
             fwhm_array_s_2, fwhm_array_s_4, fwhm_array_s_8, charge_array_d_1, charge_array_d_2, charge_array_d_4,
             charge_array_d_8, amplitude_array_d_1, amplitude_array_d_2, amplitude_array_d_4, amplitude_array_d_8,
-            fwhm_array_d_1, fwhm_array_d_2, fwhm_array_d_4, fwhm_array_d_8, fsps_new):
+            fwhm_array_d_1, fwhm_array_d_2, fwhm_array_d_4, fwhm_array_d_8, fsps_new, nworkers=1):
     print('Creating histograms')
-    mean_charge_s_1, mean_amp_s_1, mean_fwhm_s_1 = \
-        make_hist(charge_array_s_1, amplitude_array_s_1, fwhm_array_s_1, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_1_single', 'single')
-    mean_charge_s_2, mean_amp_s_2, mean_fwhm_s_2 = \
-        make_hist(charge_array_s_2, amplitude_array_s_2, fwhm_array_s_2, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_2_single', 'single')
-    mean_charge_s_4, mean_amp_s_4, mean_fwhm_s_4 = \
-        make_hist(charge_array_s_4, amplitude_array_s_4, fwhm_array_s_4, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_4_single', 'single')
-    mean_charge_s_8, mean_amp_s_8, mean_fwhm_s_8 = \
-        make_hist(charge_array_s_8, amplitude_array_s_8, fwhm_array_s_8, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_8_single', 'single')
-    mean_charge_d_1, mean_amp_d_1, mean_fwhm_d_1 = \
-        make_hist(charge_array_d_1, amplitude_array_d_1, fwhm_array_d_1, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_1_double_' + delay_folder, 'double')
-    mean_charge_d_2, mean_amp_d_2, mean_fwhm_d_2 = \
-        make_hist(charge_array_d_2, amplitude_array_d_2, fwhm_array_d_2, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_2_double_' + delay_folder, 'double')
-    mean_charge_d_4, mean_amp_d_4, mean_fwhm_d_4 = \
-        make_hist(charge_array_d_4, amplitude_array_d_4, fwhm_array_d_4, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_4_double_' + delay_folder, 'double')
-    mean_charge_d_8, mean_amp_d_8, mean_fwhm_d_8 = \
-        make_hist(charge_array_d_8, amplitude_array_d_8, fwhm_array_d_8, dest_path, 75, str(int(fsps_new / 1e6)) +
-                  '_Msps_rt_8_double_' + delay_folder, 'double')
-    make_double_hist(charge_array_s_1, amplitude_array_s_1, fwhm_array_s_1, charge_array_d_1, amplitude_array_d_1,
-                     fwhm_array_d_1, dest_path, 75, str(int(fsps_new / 1e6)) + '_Msps_rt_1_' + delay_folder)
-    make_double_hist(charge_array_s_2, amplitude_array_s_2, fwhm_array_s_2, charge_array_d_2, amplitude_array_d_2,
-                     fwhm_array_d_2, dest_path, 75, str(int(fsps_new / 1e6)) + '_Msps_rt_2_' + delay_folder)
-    make_double_hist(charge_array_s_4, amplitude_array_s_4, fwhm_array_s_4, charge_array_d_4, amplitude_array_d_4,
-                     fwhm_array_d_4, dest_path, 75, str(int(fsps_new / 1e6)) + '_Msps_rt_4_' + delay_folder)
-    make_double_hist(charge_array_s_8, amplitude_array_s_8, fwhm_array_s_8, charge_array_d_8, amplitude_array_d_8,
-                     fwhm_array_d_8, dest_path, 75, str(int(fsps_new / 1e6)) + '_Msps_rt_8_' + delay_folder)
-
-    return mean_charge_s_1, mean_amp_s_1, mean_fwhm_s_1, mean_charge_s_2, mean_amp_s_2, mean_fwhm_s_2, mean_charge_s_4, \
-           mean_amp_s_4, mean_fwhm_s_4, mean_charge_s_8, mean_amp_s_8, mean_fwhm_s_8, mean_charge_d_1, mean_amp_d_1, \
-           mean_fwhm_d_1, mean_charge_d_2, mean_amp_d_2, mean_fwhm_d_2, mean_charge_d_4, mean_amp_d_4, mean_fwhm_d_4,\
-           mean_charge_d_8, mean_amp_d_8, mean_fwhm_d_8
+    shapings = ['rt_1', 'rt_2', 'rt_4', 'rt_8']
+    table = {}
+    for shaping, charge_s, amplitude_s, fwhm_s, charge_d, amplitude_d, fwhm_d in \
+            [('rt_1', charge_array_s_1, amplitude_array_s_1, fwhm_array_s_1, charge_array_d_1, amplitude_array_d_1,
+              fwhm_array_d_1),
+             ('rt_2', charge_array_s_2, amplitude_array_s_2, fwhm_array_s_2, charge_array_d_2, amplitude_array_d_2,
+              fwhm_array_d_2),
+             ('rt_4', charge_array_s_4, amplitude_array_s_4, fwhm_array_s_4, charge_array_d_4, amplitude_array_d_4,
+              fwhm_array_d_4),
+             ('rt_8', charge_array_s_8, amplitude_array_s_8, fwhm_array_s_8, charge_array_d_8, amplitude_array_d_8,
+              fwhm_array_d_8)]:
+        table[('charge', shaping, '')] = charge_s
+        table[('amplitude', shaping, '')] = amplitude_s
+        table[('fwhm', shaping, '')] = fwhm_s
+        table[('charge', shaping, delay_folder)] = charge_d
+        table[('amplitude', shaping, delay_folder)] = amplitude_d
+        table[('fwhm', shaping, delay_folder)] = fwhm_d
+
+    specs = p3_hist_specs(shapings, delay_folder, 75)
+    results = hist_batch(table, specs, dest_path, fsps_new, 'hist_summary_' + str(int(fsps_new / 1e6)) + '_Msps_' +
+                         delay_folder + '.txt', nworkers)
+
+    for shaping in shapings:
+        for quantity, xaxis, title, units in hist_quantities:
+            queue_hist_pair_plot(results[(quantity, shaping, '')], results[(quantity, shaping, delay_folder)],
+                                 dest_path, xaxis, title, units, quantity + '_' + str(int(fsps_new / 1e6)) + '_Msps_' +
+                                 shaping + '_' + delay_folder)
+
+    # Means of single spe charge, amplitude & FWHM for each shaping, then double spe
+    means = [float(format(results[spec[0]][2][1], '.2e')) for spec in specs]
+
+    return tuple(means)
+
+
+# LEDGER
+
+
+# Reads ledger of waveform labels
+# Returns dictionary of waveform id: (status, reason, stage)
+def read_ledger(dest_path):
+    ledger = {}
+    file_name = Path(dest_path) / 'ledger.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):          # Later labels of a waveform replace earlier ones
+            ledger[row[0]] = (row[1], row[2], row[3])
+        myfile.close()
+
+    return ledger
+
+
+# Labels a waveform in ledger and adds label to ledger file
+def label_waveform(dest_path, ledger, waveform_id, status, reason, stage):
+    ledger[str(waveform_id)] = (status, reason, stage)
+    myfile = open(Path(dest_path) / 'ledger.txt', 'a')
+    myfile.write('%s,%s,%s,%s\n' % (waveform_id, status, reason, stage))
+    myfile.close()
+
+
+# Checks if a waveform has been rejected
+def check_rejected(ledger, waveform_id):
+    if str(waveform_id) in ledger and ledger[str(waveform_id)][0] == 'rejected':
+        return 'yes'
+    else:
+        return 'no'
+
+
+# HISTOGRAM ACCUMULATOR
+
+
+# Finds fixed bin edges for histogram accumulator from calibration array: nbins bins between minimum & maximum of array
+# (same as np.histogram) plus bins of the same width covering margin (fraction of range) on each side for later values
+def hist_edges(array, nbins, margin=0.):
+    low = float(np.min(array))
+    high = float(np.max(array))
+    if low == high:
+        low = low - 0.5
+        high = high + 0.5
+    n_pad = int(np.ceil(margin * nbins))
+    width = (high - low) / nbins
+    edges = np.linspace(low - n_pad * width, high + n_pad * width, nbins + 2 * n_pad + 1)
+    return edges
+
+
+# Creates histogram accumulator with fixed bin edges that also keeps mean & variance of values (Welford's method)
+def init_hist_accumulator(edges):
+    accumulator = {'edges': np.asarray(edges, dtype=float), 'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+                   'under': 0, 'over': 0, 'n': 0, 'mean': 0., 'm2': 0.}
+    return accumulator
+
+
+# Adds a value or array of values to histogram accumulator (values outside bin edges are only counted as under/over)
+def update_hist_accumulator(accumulator, values):
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    n_b = len(values)
+    if n_b == 0:
+        return accumulator
+    edges = accumulator['edges']
+    accumulator['counts'] += np.histogram(values, edges)[0]
+    accumulator['under'] += int(np.count_nonzero(values < edges[0]))
+    accumulator['over'] += int(np.count_nonzero(values > edges[-1]))
+
+    # Combines mean & sum of squared differences of values with those of accumulator (Chan et al.)
+    mean_b = float(np.mean(values))
+    m2_b = float(np.sum((values - mean_b) ** 2))
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    return accumulator
+
+
+# Combines two histogram accumulators with the same bin edges (e.g. from different workers or runs) into a new one
+def merge_hist_accumulators(acc_a, acc_b):
+    if not np.array_equal(acc_a['edges'], acc_b['edges']):
+        raise ValueError('Histogram accumulators have different bin edges')
+    accumulator = init_hist_accumulator(acc_a['edges'])
+    accumulator['counts'] = acc_a['counts'] + acc_b['counts']
+    accumulator['under'] = acc_a['under'] + acc_b['under']
+    accumulator['over'] = acc_a['over'] + acc_b['over']
+    n = acc_a['n'] + acc_b['n']
+    if n > 0:
+        delta = acc_b['mean'] - acc_a['mean']
+        accumulator['n'] = n
+        accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+        accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+    return accumulator
+
+
+# Saves histogram accumulator to .npz file
+def save_hist_accumulator(accumulator, file_name):
+    np.savez(file_name, **accumulator)
+
+
+# Reads histogram accumulator from .npz file
+def load_hist_accumulator(file_name):
+    myfile = np.load(file_name)
+    accumulator = {'edges': myfile['edges'], 'counts': myfile['counts'], 'under': int(myfile['under']),
+                   'over': int(myfile['over']), 'n': int(myfile['n']), 'mean': float(myfile['mean']),
+                   'm2': float(myfile['m2'])}
+    myfile.close()
+    return accumulator
+
+
+# Returns mean & standard deviation of all values added to histogram accumulator
+def hist_accumulator_stats(accumulator):
+    if accumulator['n'] == 0:
+        return np.nan, np.nan
+    return accumulator['mean'], np.sqrt(accumulator['m2'] / accumulator['n'])
+
+
+# Finds Gaussian fit of histogram in accumulator (starting from mean & standard deviation of all values)
+def fit_hist_accumulator(accumulator):
+    edges = accumulator['edges']
+    bins = (edges[:-1] + edges[1:]) / 2                 # Bin centers
+    mu, sigma = hist_accumulator_stats(accumulator)
+    return gauss_fit_bins(bins, accumulator['counts'], mu, sigma)
+
+
+# Fits histogram in accumulator, bootstraps fit from nfit resampled histograms, and queues plot of histogram with
+# Gaussian fit, returns fit parameters & bootstrap rows
+def plot_hist_accumulator(accumulator, dest_path, xaxis, title, units, filename, nfit=100):
+    bins_range, popt, pcov = fit_hist_accumulator(accumulator)         # Finds Gaussian fit
+    edges = accumulator['edges']
+    params = bootstrap_fit((edges[:-1] + edges[1:]) / 2, accumulator['counts'], popt, nfit)
+    mean, sd = hist_accumulator_stats(accumulator)
+    rows = bootstrap_rows(mean, sd, np.array([]), np.array([]), popt, params)
+    queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename)
+
+    return popt, rows
+
+
+# Returns ' +/- ' and half width of bootstrap confidence interval in row, or '' if there is no interval
+def error_text(row):
+    name, value, low, high = row
+    if np.isnan(low) or np.isnan(high):
+        return ''
+    return ' +/- ' + str(float(format((high - low) / 2, '.1e')))
+
+
+# Queues plot of histogram in accumulator with Gaussian fit (uncertainties are half widths of bootstrap intervals)
+def queue_hist_plot(accumulator, bins_range, popt, rows, dest_path, xaxis, title, units, filename):
+    path = Path(Path(dest_path) / 'plots')
+    mu2 = float(format(popt[1], '.2e'))                 # Calculates mean
+    sigma2 = np.abs(float(format(popt[2], '.2e')))      # Calculates standard deviation
+
+    # Queues histogram with Gaussian fit (mean +/- 2sigma) to be plotted
+    queue_plot('histogram', path / str(filename + '.png'),
+               {'arrays': [], 'counts': [(accumulator['edges'], accumulator['counts'])],
+                'fits': [(bins_range, popt, 'red')], 'xlabel': xaxis + ' (' + units + ')', 'fontsize': 'large',
+                'title': title + ' of SPE\n mean: ' + str(mu2) + error_text(rows[2]) + ' ' + units + ', SD: ' +
+                         str(sigma2) + error_text(rows[3]) + ' ' + units})
+
+
+# BOOTSTRAP
+
+
+# Resamples array with replacement nboot times, using matrices of random indices (at most max_size values at a time),
+# and returns mean & standard deviation of each resample (drawn with random generator rng, or a new one if rng is None)
+def bootstrap_stats(array, nboot=1000, max_size=10000000, rng=None):
+    rng = np.random.default_rng(rng)
+    array = np.asarray(array, dtype=float)
+    n = len(array)
+    center = np.mean(array)
+    array = array - center                      # Centered so that standard deviation does not lose precision
+    means = np.zeros(nboot)
+    sds = np.zeros(nboot)
+    chunk = max(1, min(nboot, max_size // max(n, 1)))
+
+    for j in range(0, nboot, chunk):
+        idx = rng.integers(0, n, (min(chunk, nboot - j), n))            # Each row is one resample
+        samples = array[idx]
+        means_j = np.mean(samples, axis=1)
+        means[j:j + len(idx)] = means_j + center
+        sds[j:j + len(idx)] = np.sqrt(np.maximum(np.mean(samples ** 2, axis=1) - means_j ** 2, 0))
+
+    return means, sds
+
+
+# Resamples histogram counts nboot times (multinomial, same as resampling the values in the histogram) and returns fit
+# parameters of Gaussian fit of each resampled histogram that could be fitted (one row per resample), starting each fit
+# from popt (resamples are drawn with random generator rng, or a new one if rng is None)
+def bootstrap_fit(bins, n, popt, nboot=100, rng=None):
+    n = np.asarray(n, dtype=float)
+    total = int(np.sum(n))
+    params = np.zeros((nboot, 3))
+    if total == 0 or nboot == 0:
+        return params[:0]
+    resamples = np.random.default_rng(rng).multinomial(total, n / total, size=nboot)
+
+    for j in range(nboot):
+        try:
+            bins_range, params[j], pcov = gauss_fit_bins(bins, resamples[j], popt[1], popt[2])
+            if not np.all(np.isfinite(pcov)):
+                params[j] = np.nan
+        except RuntimeError:
+            params[j] = np.nan
+
+    # Resamples that could not be fitted are dropped so they do not narrow confidence intervals
+    fitted = np.all(np.isfinite(params), axis=1)
+    if not np.all(fitted):
+        print('Dropped %d of %d bootstrap fits that could not be fitted' % (nboot - np.count_nonzero(fitted), nboot))
+
+    return params[fitted]
+
+
+# Returns lower & upper limits of central confidence interval (cl in %) of bootstrap values
+def confidence_interval(values, cl=68.27):
+    return np.percentile(values, 50 - cl / 2, axis=0), np.percentile(values, 50 + cl / 2, axis=0)
+
+
+# Returns rows of (name, value, lower limit, upper limit) of central confidence intervals (cl in %) of mean & standard
+# deviation of values (from bootstrap means & sds) and of mean & standard deviation of Gaussian fit (from params)
+def bootstrap_rows(mean, sd, means, sds, popt, params, cl=68.27):
+    values = [('mean', mean, means), ('sd', sd, sds), ('fit_mean', popt[1], params[:, 1]),
+              ('fit_sd', np.abs(popt[2]), np.abs(params[:, 2]))]
+    rows = []
+    for name, value, resampled in values:
+        if len(resampled) > 0:
+            low, high = confidence_interval(resampled, cl)
+        else:
+            low, high = np.nan, np.nan
+        rows.append((name, float(value), float(low), float(high)))
+    return rows
+
+
+# Saves bootstrap confidence intervals of a histogram
+def save_bootstrap(rows, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('name,value,low,high\n')
+    for name, value, low, high in rows:
+        myfile.write('%s,%s,%s,%s\n' % (name, str(value), str(low), str(high)))
+    myfile.close()
+
+
+# Writes table with number of values (in, below & above bins) and bootstrap confidence intervals of each histogram
+def write_hist_summary(summary, file_name):
+    myfile = open(file_name, 'w')
+    myfile.write('histogram,n,under,over')
+    for name in ['mean', 'sd', 'fit_mean', 'fit_sd']:
+        myfile.write(',%s,%s_low,%s_high' % (name, name, name))
+    myfile.write('\n')
+    for filename, accumulator, rows in summary:
+        myfile.write('%s,%d,%d,%d' % (filename, accumulator['n'], accumulator['under'], accumulator['over']))
+        for name, value, low, high in rows:
+            myfile.write(',%s,%s,%s' % (str(value), str(low), str(high)))
+        myfile.write('\n')
+    myfile.close()
+
+
+# PLOTTING
+
+
+plot_queue = []         # Plots waiting to be rendered by render_plots
+
+
+# Adds a plot to plot queue (kind is 'histogram' or 'waveform', and data holds what is needed to draw it)
+def queue_plot(kind, file_name, data):
+    plot_queue.append((kind, str(file_name), data))
+
+
+# Draws a queued plot with the non-interactive Agg backend and saves it
+def draw_plot(kind, file_name, data, dpi):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    if kind == 'histogram':
+        for array in data['arrays']:
+            plt.hist(array, data['nbins'])                                  # Plots histogram
+        for edges, counts in data.get('counts', []):
+            plt.hist(edges[:-1], edges, weights=counts)                     # Plots histogram from accumulator
+        for bins_range, popt, color in data['fits']:
+            plt.plot(bins_range, func(bins_range, *popt), color=color)      # Plots Gaussian fit (mean +/- 2sigma)
+        plt.xlabel(data['xlabel'])
+        plt.title(data['title'], fontsize=data['fontsize'])
+    if kind == 'waveform':
+        plt.plot(data['t'], data['v'])
+        plt.fill_between(data['t'], data['v_low'], data['v_high'], alpha=0.3)     # Plots band with 68% of waveforms
+        plt.xlabel('Time (s)')
+        plt.ylabel('Normalized Voltage')
+        plt.title(data['title'])
+    plt.savefig(file_name, dpi=dpi)
+    plt.close()
+
+
+# Renders queued plots in nworkers processes and empties plot queue
+def render_plots(dpi=360, nworkers=1):
+    plots = [(kind, file_name, data, dpi) for kind, file_name, data in plot_queue]
+    del plot_queue[:]
+    print('Rendering %d plots' % len(plots))
+    if nworkers > 1 and len(plots) > 1:
+        pool = Pool(min(nworkers, len(plots)))
+        pool.starmap(draw_plot, plots)
+        pool.close()
+        pool.join()
+    else:
+        for plot in plots:
+            draw_plot(*plot)
+
+
+# Empties plot queue without rendering (for runs with no plots)
+def clear_plots():
+    del plot_queue[:]
+
+
+# WAVEFORM ACCUMULATOR
+
+
+# Creates accumulator for mean & variance of waveforms (Welford's method) that also keeps a random sample of up to keep
+# waveforms for percentile bands
+def init_accumulator(keep=500):
+    accumulator = {'n': 0, 'mean': None, 'm2': None, 'keep': keep, 'reservoir': None, 'n_res': 0}
+    return accumulator
+
+
+# Adds a waveform (1-D array) or block of waveforms (2-D array, one waveform per row) to accumulator, sampling its
+# reservoir with random generator rng (a new one if rng is None)
+def update_accumulator(accumulator, v, rng=None):
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    n_b = len(v)
+    if n_b == 0:
+        return accumulator
+    if accumulator['mean'] is None:
+        accumulator['mean'] = np.zeros(v.shape[1])
+        accumulator['m2'] = np.zeros(v.shape[1])
+        accumulator['reservoir'] = np.zeros((accumulator['keep'], v.shape[1]))
+
+    # Combines mean & sum of squared differences of block with those of accumulator (Chan et al.)
+    mean_b = np.mean(v, axis=0)
+    m2_b = np.sum((v - mean_b) ** 2, axis=0)
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    # Keeps each waveform in reservoir with probability keep / n
+    rng = np.random.default_rng(rng)
+    for j in range(n_b):
+        if accumulator['n_res'] < accumulator['keep']:
+            accumulator['reservoir'][accumulator['n_res']] = v[j]
+            accumulator['n_res'] += 1
+        else:
+            k = rng.integers(0, n_a + j + 1)
+            if k < accumulator['keep']:
+                accumulator['reservoir'][k] = v[j]
+
+    return accumulator
+
+
+# Adds each waveform from an iterable of waveforms (list of arrays, generator, or 2-D array) to accumulator
+def accumulate_waveforms(accumulator, waveforms, rng=None):
+    rng = np.random.default_rng(rng)
+    for v in waveforms:
+        update_accumulator(accumulator, v, rng)
+    return accumulator
+
+
+# Combines two accumulators (e.g. from different workers) into a new accumulator, sampling its reservoir with random
+# generator rng (a new one if rng is None)
+def merge_accumulators(acc_a, acc_b, rng=None):
+    if acc_a['n'] == 0:
+        return acc_b
+    if acc_b['n'] == 0:
+        return acc_a
+    accumulator = init_accumulator(max(acc_a['keep'], acc_b['keep']))
+    n = acc_a['n'] + acc_b['n']
+    delta = acc_b['mean'] - acc_a['mean']
+    accumulator['n'] = n
+    accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+    accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+
+    # Combines reservoirs, choosing waveforms from each in proportion to number of waveforms each reservoir stands for
+    res = np.concatenate((acc_a['reservoir'][:acc_a['n_res']], acc_b['reservoir'][:acc_b['n_res']]))
+    weights = np.concatenate((np.full(acc_a['n_res'], acc_a['n'] / acc_a['n_res']),
+                              np.full(acc_b['n_res'], acc_b['n'] / acc_b['n_res'])))
+    n_res = min(accumulator['keep'], len(res))
+    idx = np.random.default_rng(rng).choice(len(res), n_res, replace=False, p=weights / np.sum(weights))
+    accumulator['reservoir'] = np.zeros((accumulator['keep'], res.shape[1]))
+    accumulator['reservoir'][:n_res] = res[idx]
+    accumulator['n_res'] = n_res
+
+    return accumulator
+
+
+# Returns mean, standard deviation, and lower & upper percentile bands of waveforms in accumulator
+def accumulator_stats(accumulator, low=15.87, high=84.13):
+    n = accumulator['n']
+    if n == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    mean = accumulator['mean']
+    if n > 1:
+        sd = np.sqrt(accumulator['m2'] / (n - 1))
+    else:
+        sd = np.zeros(len(mean))
+    res = accumulator['reservoir'][:accumulator['n_res']]
+    band_low = np.percentile(res, low, axis=0)
+    band_high = np.percentile(res, high, axis=0)
+
+    return mean, sd, band_low, band_high
 
 
 # AVERAGE/PLOT WAVEFORM
 
 
-# Calculates average waveform of spe
-def average_waveform(array, dest_path, shaping, shaping_name, delay_path, delay_name, delay_folder, nhdr, fsps_new):
+# Returns index where averaging window of a waveform starts and fraction of a point from that index to the start of the
+# window (after downsampling, t = 0 usually falls between points), or -1 if waveform does not have n_before points
+# before t = 0 and length points in total
+# If align is 'sample', window starts at nearest point instead
+def window_position(t0, dt, n_before, length, array_length, align):
+    x_start = -t0 / dt - n_before                   # Finds position of start of window in points
+    idx_start = int(round(x_start))
+    if idx_start < 0 or idx_start + length > array_length - 1:
+        return -1, 0.
+    frac = 0.
+    if align == 'subsample':
+        frac = x_start - idx_start
+        if frac < 0 and idx_start > 0:              # Interpolates from point before nearest point
+            idx_start -= 1
+            frac += 1
+        elif frac < 0:                              # No point before first point, so uses nearest point
+            frac = 0.
+    return idx_start, frac
+
+
+# Shifts each waveform in a block (one waveform per row, with one extra point at the end) by a fraction of a point
+# using linear interpolation
+def shift_block(block, fracs):
+    return block[:, :-1] + fracs[:, np.newaxis] * (block[:, 1:] - block[:, :-1])
+
+
+# Chooses averaging window from a waveform file
+# Returns number of points before t = 0, number of points in window, and time step
+def average_window(file_name, nhdr):
+    t, v, hdr = rw(file_name, nhdr)
+    array_length = len(t)
+    dt = (t[-1] - t[0]) / (array_length - 1)
+    # Window from t = -25 ns that is 150 ns long
+    n_before = int(round(2.5e-8 / dt))
+    length = int(round(1.5e-7 / dt))
+    return n_before, length, dt
+
+
+# Reads a shard of waveform files and adds each aligned, normalized waveform to the accumulator of its group
+# jobs is a list of (group, file name) and windows holds number of points before t = 0 & window length of each group
+# Returns dictionary of accumulator for each group (reservoirs are sampled with a random generator seeded from seed)
+def average_shard(jobs, nhdr, windows, align='subsample', seed=None):
+    rng = np.random.default_rng(seed)
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of waveform windows (with one extra point)
+    fracs = {}                                      # Fractions of a point to shift each waveform in blocks
+    ks = {}
+
+    for group, file_name in jobs:
+        n_before, length = windows[group]
+        if group not in accs:
+            accs[group] = init_accumulator()
+            blocks[group] = np.empty((500, length + 1))
+            fracs[group] = np.zeros(500)
+            ks[group] = 0
+        print('Reading file', Path(file_name).name)
+        t, v, hdr = rw(file_name, nhdr)             # Reads a waveform file
+        array_length = len(t)
+        dt = (t[-1] - t[0]) / (array_length - 1)
+        idx_start, frac = window_position(t[0], dt, n_before, length, array_length, align)
+        # Only averages waveform files that have enough points before t = 0 & after the spe
+        if idx_start >= 0:
+            k = ks[group]
+            blocks[group][k] = v[idx_start:idx_start + length + 1]
+            blocks[group][k] /= min(v)              # Normalizes voltages
+            fracs[group][k] = frac
+            ks[group] = k + 1
+            if ks[group] == len(blocks[group]):     # Aligns & adds full block of waveforms to accumulator
+                update_accumulator(accs[group], shift_block(blocks[group], fracs[group]), rng)
+                ks[group] = 0
+    for group in accs:
+        k = ks[group]
+        update_accumulator(accs[group], shift_block(blocks[group][:k], fracs[group][:k]), rng)
+
+    return accs
+
+
+# Averages waveform files of every group in one pass, splitting them into one shard per worker process and merging the
+# accumulators at the end (jobs is a list of (group, file name))
+# Returns dictionaries of accumulator and time array of average waveform for each group
+def average_files(jobs, nhdr, nworkers=1, align='subsample'):
+    windows = {}
+    times = {}
+    for group, file_name in jobs:                   # Chooses window of each group from its first file
+        if group not in windows:
+            n_before, length, dt = average_window(file_name, nhdr)
+            windows[group] = (n_before, length)
+            times[group] = (np.arange(length) - n_before) * dt
+
+    if nworkers > 1 and len(jobs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(jobs[j * len(jobs) // nworkers:(j + 1) * len(jobs) // nworkers], nhdr, windows, align, seeds[j])
+                  for j in range(nworkers)]
+        pool = Pool(nworkers)
+        shard_accs = pool.starmap(average_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        shard_accs = [average_shard(jobs, nhdr, windows, align)]
+
+    accs = {}
+    for group in windows:
+        accs[group] = init_accumulator()
+        for shard_acc in shard_accs:
+            if group in shard_acc:
+                accs[group] = merge_accumulators(accs[group], shard_acc[group])
+
+    return accs, times
+
+
+# Calculates average waveforms of double spe for a list of (file array, shaping, shaping name, delay path, delay name,
+# delay folder) groups, reading the waveform files of every group in one pass
+def average_waveforms(groups, dest_path, nhdr, fsps_new, nworkers=1, align='subsample'):
+    folder_files = {}
+    for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+        folder_files[(delay_folder, shaping)] = set(os.listdir(delay_path))
+
+    jobs = []
+    for j in range(max([len(group[0]) for group in groups])):
+        for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+            if j < len(array):
+                file_name = 'D3--waveforms--%s.txt' % array[j]
+                if file_name in folder_files[(delay_folder, shaping)]:
+                    jobs.append(((delay_folder, shaping), str(delay_path / file_name)))
+
+    # Reads and averages waveforms in nworkers processes, shifting each by a fraction of a point so that t = 0 lines up
+    accs, times = average_files(jobs, nhdr, nworkers, align)
+
+    for array, shaping, shaping_name, delay_path, delay_name, delay_folder in groups:
+        group = (delay_folder, shaping)
+        if group in accs and accs[group]['n'] > 0:
+            save_average(accs[group], times[group], dest_path, shaping, shaping_name, delay_name, delay_folder,
+                         fsps_new)
+        else:
+            print('No ' + delay_folder + ' ' + shaping + ' waveforms to average')
+
+
+# Calculates average waveform of double spe for one shaping & delay
+def average_waveform(array, dest_path, shaping, shaping_name, delay_path, delay_name, delay_folder, nhdr, fsps_new,
+                     nworkers=1, align='subsample'):
+    average_waveforms([(array, shaping, shaping_name, delay_path, delay_name, delay_folder)], dest_path, nhdr, fsps_new,
+                      nworkers, align)
+
+
+# Plots and saves average waveform & standard deviation of waveforms for a shaping & delay
+def save_average(acc, t_avg, dest_path, shaping, shaping_name, delay_name, delay_folder, fsps_new):
     save_file = Path(dest_path / 'plots')
-    tsum = 0
-    vsum = 0
-    n = 0
 
-    for item in array:
-        file_name = 'D3--waveforms--%s.txt' % item
-        if os.path.isfile(delay_path / file_name):
-            print('Reading file #', item)
-            t, v, hdr = rw(delay_path / file_name, nhdr)    # Reads a waveform file
-            v = v / min(v)                                  # Normalizes voltages
-            try:
-                idx = np.where(t == 0)                      # Finds index of t = 0 point
-                idx = int(idx[0])
-                t = np.roll(t, -idx)                        # Rolls time array so that t = 0 point is at index 0
-                v = np.roll(v, -idx)                        # Rolls voltage array so that 50% max point is at index 0
-                idx2 = int(np.where(t == min(t))[0])        # Finds index of point of minimum t
-                idx3 = int(np.where(t == max(t))[0])        # Finds index of point of maximum t
-                idx_low = int(np.where(t == -2.5e-8)[0])
-                idx_high = int(np.where(t == 1.5e-7)[0])
-                # Only averages waveform files that have enough points before t = 0 & after the spe
-                if idx2 <= idx_low:
-                    # Removes points between point of maximum t & chosen minimum t in time & voltage arrays
-                    t = np.concatenate((t[:idx3], t[idx_low:]))
-                    v = np.concatenate((v[:idx3], v[idx_low:]))
-                    # Rolls time & voltage arrays so that point of chosen minimum t is at index 0
-                    t = np.roll(t, -idx3)
-                    v = np.roll(v, -idx3)
-                    if len(t) >= idx_high:
-                        # Removes points after chosen point of maximum t in time & voltage arrays
-                        t = t[:idx_high]
-                        v = v[:idx_high]
-                        # Sums time & voltage arrays
-                        tsum += t
-                        vsum += v
-                        n += 1
-            except Exception:
-                pass
-    # Finds average time & voltage arrays
-    t_avg = tsum / n
-    v_avg = vsum / n
-    v_avg = v_avg / max(v_avg)
-
-    # Plots average waveform & saves image
-    plt.plot(t_avg, v_avg)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveform (' + delay_name + ', ' + shaping_name + ')')
-    plt.savefig(save_file / str('avg_waveform_double_' + str(int(fsps_new / 1e6)) + ' Msps_' + delay_folder + "_" +
-                                shaping + '.png'), dpi=360)
+    # Finds average voltage array and standard deviation & 68% band of voltage arrays
+    v_avg, v_sd, v_low, v_high = accumulator_stats(acc)
+    v_max = max(v_avg)
+    v_avg, v_sd, v_low, v_high = v_avg / v_max, v_sd / v_max, v_low / v_max, v_high / v_max
 
     # Saves average waveform data
     file_name = dest_path / 'hist_data_double' / str('avg_waveform_' + str(int(fsps_new / 1e6)) + ' Msps_' +
                                                      delay_folder + "_" + shaping + '.txt')
     hdr = 'Average Waveform\n\n\n\nTime,Ampl'
     ww(t_avg, v_avg, file_name, hdr)
+    ww(t_avg, v_sd, str(file_name)[:-4] + '_sd.txt', 'Waveform Standard Deviation\n\n\n\nTime,Ampl')
 
-    plt.close()
+    # Queues average waveform & 68% band to be plotted
+    queue_plot('waveform', save_file / str('avg_waveform_double_' + str(int(fsps_new / 1e6)) + ' Msps_' +
+                                           delay_folder + "_" + shaping + '.png'),
+               {'t': t_avg, 'v': v_avg, 'v_low': v_low, 'v_high': v_high,
+                'title': 'Average Waveform (' + delay_name + ', ' + shaping_name + ')'})
 
 
 # Shows a waveform plot to user
 def show_waveform(file_name, version):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(file_name, 5)
     print("\nHeader:\n\n" + str(hdr))
     plt.plot(t, v)
@@ -427,9 +1099,10 @@ def calculate_t1_t2(t, v):
     idx1 = np.inf
     idx2 = np.inf
     idx3 = np.inf
+    v_min = min(v)                  # Minimum voltage (found once instead of at every point)
 
     for i in range(len(v)):
-        if v[i] <= 0.1 * min(v):
+        if v[i] <= 0.1 * v_min:
             idx1 = i
             break
         else:
@@ -439,7 +1112,7 @@ def calculate_t1_t2(t, v):
         return 0, -1
     else:
         for i in range(idx1, len(v)):
-            if v[i] == min(v):
+            if v[i] == v_min:
                 idx2 = i
                 break
             else:
@@ -448,7 +1121,7 @@ def calculate_t1_t2(t, v):
             return 0, -1
         else:
             for i in range(len(v) - 1, idx2, -1):
-                if v[i] <= 0.1 * min(v):
+                if v[i] <= 0.1 * v_min:
                     idx3 = i
                     break
                 else:
@@ -466,10 +1139,10 @@ def calculate_average(t, v):
     t1, t2 = calculate_t1_t2(t, v)
 
     try:
-        for i in range(int(np.where(t == t1)[0] - (.1 * len(t)))):
+        for i in range(int(np.where(t == t1)[0][0] - (.1 * len(t)))):
             v_sum += v[i]
 
-        average = v_sum / (int(np.where(t == t1)[0] - (.1 * len(t))))
+        average = v_sum / (int(np.where(t == t1)[0][0] - (.1 * len(t))))
 
         return average
 
@@ -747,9 +1420,6 @@ def make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8, fsps
     if not os.path.exists(Path(dest_path / 'plots')):
         print('Creating plots folder')
         os.mkdir(Path(dest_path / 'plots'))
-    if not os.path.exists(Path(dest_path / 'unusable_data')):
-        print('Creating unusable data folder')
-        os.mkdir(Path(dest_path / 'unusable_data'))
 
 
 # Makes arrays of existing single and double spe files
@@ -772,14 +1442,14 @@ def initial_arrays(filt_path1_s, delay_path1):
 
 
 # Makes arrays of existing single and double spe files
-def initial_arrays_2(filt_path1_s, delay_path1):
+def initial_arrays_2(filt_path1_s, delay_path1, ledger):
     single_file_array = np.array([])
     double_file_array = np.array([])
 
     print('Checking existing d2 single spe files...')
     for i in range(99999):                                  # Makes array of all spe file names
         file_name = 'D2--waveforms--%05d.txt' % i
-        if os.path.isfile(filt_path1_s / file_name):
+        if os.path.isfile(filt_path1_s / file_name) and check_rejected(ledger, '%05d' % i) == 'no':
             single_file_array = np.append(single_file_array, i)
 
     print('Checking existing d2 double spe files...')
@@ -915,6 +1585,8 @@ def digitize(v, noise):
 # Downsamples and digitizes files
 def down_dig(single_file_array, double_file_array, filt_path1, filt_path2, filt_path4, filt_path8, dest_path,
              delay_folder, fsps, fsps_new, noise, nhdr):
+    ledger = read_ledger(dest_path)
+
     for item in single_file_array:
         file_name1 = str(dest_path / 'rt_1_single' / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') /
                          'D3--waveforms--%05d.txt') % item
@@ -933,7 +1605,7 @@ def down_dig(single_file_array, double_file_array, filt_path1, filt_path2, filt_
         save_name8 = str(dest_path / 'rt_8_single_2' / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') /
                          'D3--waveforms--%05d.txt') % item
 
-        if os.path.isfile(file_name1):
+        if os.path.isfile(file_name1) and check_rejected(ledger, single_id(item, fsps_new)) == 'no':
             if os.path.isfile(save_name1):
                 print('File #%05d downsampled' % item)
             else:
@@ -982,7 +1654,7 @@ def down_dig(single_file_array, double_file_array, filt_path1, filt_path2, filt_
         save_name8 = str(dest_path / 'rt_8_single_2' / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') /
                          'D3--waveforms--%05d.txt') % item
 
-        if os.path.isfile(file_name1):
+        if os.path.isfile(file_name1) and check_rejected(ledger, single_id(item, fsps_new)) == 'no':
             if os.path.isfile(save_name1):
                 print('File #%05d digitized' % item)
             else:
@@ -1118,58 +1790,25 @@ def append_arrays(t1, t2, charge, amplitude, fwhm, t1_array, t2_array, charge_ar
     return t1_array, t2_array, charge_array, amplitude_array, fwhm_array
 
 
-# Removes single spe waveform from all spe folders
-def remove_spe_s(rt_1_path_raw, rt_1_path_dig, rt_2_path_dig, rt_4_path_dig, rt_8_path_dig, rt_1_path_dow,
-                 rt_2_path_dow, rt_4_path_dow, rt_8_path_dow, dest_path, number, nhdr, shaping, fsps_new):
-    t, v, hdr = rw(str(Path(rt_1_path_raw) / 'D3--waveforms--%05d.txt') % number, nhdr)
-    ww(t, v, str(dest_path / 'unusable_data' / 'D3--waveforms--%05d.txt') % number, hdr)
-    if os.path.isfile(str(Path(rt_1_path_dig) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_1_path_dig) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_2_path_dig) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_2_path_dig) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_4_path_dig) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_4_path_dig) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_8_path_dig) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_8_path_dig) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_1_path_dow) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_1_path_dow) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_2_path_dow) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_2_path_dow) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_4_path_dow) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_4_path_dow) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(rt_8_path_dow) / 'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(rt_8_path_dow) / 'D3--waveforms--%05d.txt') % number)
-    if os.path.isfile(str(Path(dest_path) / 'calculations_single' / str(str(int(fsps_new / 1e6)) + '_Msps') / shaping /
-                          'D3--waveforms--%05d.txt') % number):
-        os.remove(str(Path(dest_path) / 'calculations_single' / str(str(int(fsps_new / 1e6)) + '_Msps') / shaping /
-                      'D3--waveforms--%05d.txt') % number)
-
-
-# Removes double spe waveform from all spe folders
-def remove_spe_d(rt_1_path_raw, rt_1_path_dig, rt_2_path_dig, rt_4_path_dig, rt_8_path_dig, rt_1_path_dow,
-                 rt_2_path_dow, rt_4_path_dow, rt_8_path_dow, dest_path, number, nhdr, delay_folder, shaping, fsps_new):
-    t, v, hdr = rw(str(Path(rt_1_path_raw) / 'D3--waveforms--%s.txt') % number, nhdr)
-    ww(t, v, str(Path(dest_path) / 'unusable_data' / 'D3--waveforms--%s.txt') % number, hdr)
-    if os.path.isfile(str(Path(rt_1_path_dig) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_1_path_dig) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_2_path_dig) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_2_path_dig) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_4_path_dig) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_4_path_dig) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_8_path_dig) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_8_path_dig) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_1_path_dow) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_1_path_dow) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_2_path_dow) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_2_path_dow) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_4_path_dow) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_4_path_dow) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(rt_8_path_dow) / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(rt_8_path_dow) / 'D3--waveforms--%s.txt') % number)
-    if os.path.isfile(str(Path(dest_path) / 'calculations_double' / str(str(int(fsps_new / 1e6)) + '_Msps') /
-                          delay_folder / shaping / 'D3--waveforms--%s.txt') % number):
-        os.remove(str(Path(dest_path) / 'calculations_double' / str(str(int(fsps_new / 1e6)) + '_Msps') /
-                      delay_folder / shaping / 'D3--waveforms--%s.txt') % number)
+# Returns ledger id of a single spe waveform at a sample rate
+def single_id(number, fsps_new):
+    return '%s_Msps/%05d' % (int(fsps_new / 1e6), number)
+
+
+# Returns ledger id of a double spe waveform at a delay and sample rate
+def double_id(number, delay_folder, fsps_new):
+    return '%s_Msps/%s/%s' % (int(fsps_new / 1e6), delay_folder, number)
+
+
+# Removes single spe waveform from data set at a sample rate by labeling it as rejected in ledger
+def remove_spe_s(dest_path, ledger, number, shaping, fsps_new):
+    label_waveform(dest_path, ledger, single_id(number, fsps_new), 'rejected', 'impossible values', 'p3 ' + shaping)
+
+
+# Removes double spe waveform from data set at a sample rate by labeling it as rejected in ledger
+def remove_spe_d(dest_path, ledger, number, delay_folder, shaping, fsps_new):
+    label_waveform(dest_path, ledger, double_id(number, delay_folder, fsps_new), 'rejected', 'impossible values',
+                   'p3 ' + shaping)
 
 
 # Calculates beginning & end times of spe waveform, charge, amplitude, fwhm, 10-90 & 20-80 rise times, 10-90 & 20-80
@@ -1193,24 +1832,12 @@ def read_calculations(filename):
 
 # Removes spe file if values are impossible, appends values to arrays if not, and creates calculations file if it does
 # not already exist
-def create_arrays_s(calc_file, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_path, number, t1_array, t2_array,
-                    charge_array, amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, nhdr,
-                    fsps_new, shaping):
-    rt_1_path_raw = str(rt_1_path / 'raw')
-    rt_1_path_dow = str(rt_1_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_1_path_dig = str(rt_1_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_2_path_dow = str(rt_2_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_2_path_dig = str(rt_2_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_4_path_dow = str(rt_4_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_4_path_dig = str(rt_4_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_8_path_dow = str(rt_8_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps'))
-    rt_8_path_dig = str(rt_8_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps'))
-
-    # Any spe waveform that returns impossible values is put into the not_spe folder
+def create_arrays_s(calc_file, dest_path, ledger, number, t1_array, t2_array, charge_array, amplitude_array,
+                    fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, fsps_new, shaping):
+    # Any spe waveform that returns impossible values is rejected
     if possibility == 'impossible' and not shaping == 'rt_8':
         print('Removing file #%05d' % number)
-        remove_spe_s(rt_1_path_raw, rt_1_path_dig, rt_2_path_dig, rt_4_path_dig, rt_8_path_dig, rt_1_path_dow,
-                     rt_2_path_dow, rt_4_path_dow, rt_8_path_dow, dest_path, number, nhdr, shaping, fsps_new)
+        remove_spe_s(dest_path, ledger, number, shaping, fsps_new)
 
     # All other spe waveforms' calculations are placed into arrays
     else:
@@ -1225,25 +1852,12 @@ def create_arrays_s(calc_file, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_
 
 # Removes spe file if values are impossible, appends values to arrays if not, and creates calculations file if it does
 # not already exist
-def create_arrays_d(calc_file, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_path, number, t1_array, t2_array,
-                    charge_array, amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, nhdr,
-                    fsps_new, delay_folder, shaping):
-    rt_1_path_raw = str(rt_1_path / 'raw' / delay_folder)
-    rt_1_path_dow = str(rt_1_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_1_path_dig = str(rt_1_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_2_path_dow = str(rt_2_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_2_path_dig = str(rt_2_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_4_path_dow = str(rt_4_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_4_path_dig = str(rt_4_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_8_path_dow = str(rt_8_path / str('downsampled_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-    rt_8_path_dig = str(rt_8_path / str('digitized_' + str(int(fsps_new / 1e6)) + '_Msps') / delay_folder)
-
-    # Any spe waveform that returns impossible values is put into the not_spe folder
+def create_arrays_d(calc_file, dest_path, ledger, number, t1_array, t2_array, charge_array, amplitude_array,
+                    fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, fsps_new, delay_folder, shaping):
+    # Any spe waveform that returns impossible values is rejected
     if possibility == 'impossible' and not shaping == 'rt_8':
         print('Removing file #%s' % number)
-        remove_spe_d(rt_1_path_raw, rt_1_path_dig, rt_2_path_dig, rt_4_path_dig, rt_8_path_dig, rt_1_path_dow,
-                     rt_2_path_dow, rt_4_path_dow, rt_8_path_dow, dest_path, number, nhdr, delay_folder, shaping,
-                     fsps_new)
+        remove_spe_d(dest_path, ledger, number, delay_folder, shaping, fsps_new)
 
     elif possibility == 'impossible' and shaping == 'rt_8':
         if not os.path.isfile(calc_file):
@@ -1264,13 +1878,14 @@ def create_arrays_d(calc_file, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_
 # Returns arrays of beginning & end times of spe waveform, charge, amplitude, and fwhm
 def make_arrays_s(save_shift, dest_path, array, nhdr, r, fsps_new, shaping):
     t1_array, t2_array, charge_array, amplitude_array, fwhm_array = initialize_arrays()
+    ledger = read_ledger(dest_path)
 
     for item in array:
         file_name1 = str(save_shift / 'D3--waveforms--%05d.txt') % item
         file_name2 = str(dest_path / 'calculations_single' / str(str(int(fsps_new / 1e6)) + '_Msps') / shaping /
                          'D3--waveforms--%05d.txt') % item
 
-        if os.path.isfile(file_name1):
+        if os.path.isfile(file_name1) and check_rejected(ledger, single_id(item, fsps_new)) == 'no':
             # If the calculations were done previously, they are read from a file
             if os.path.isfile(file_name2):
                 print("Reading calculations from file #%05d" % item)
@@ -1282,15 +1897,10 @@ def make_arrays_s(save_shift, dest_path, array, nhdr, r, fsps_new, shaping):
                 t1, t2, charge, amplitude, fwhm = calculations(t, v, r)     # Calculations are done
                 possibility = check_if_impossible(t1, t2, charge, amplitude, fwhm)
 
-            rt_1_path = Path(dest_path / 'rt_1_single_2')
-            rt_2_path = Path(dest_path / 'rt_2_single_2')
-            rt_4_path = Path(dest_path / 'rt_4_single_2')
-            rt_8_path = Path(dest_path / 'rt_8_single_2')
-
             t1_array, t2_array, charge_array, amplitude_array, fwhm_array = \
-                create_arrays_s(file_name2, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_path, item, t1_array,
-                                t2_array, charge_array, amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm,
-                                possibility, nhdr, fsps_new, shaping)
+                create_arrays_s(file_name2, dest_path, ledger, item, t1_array, t2_array, charge_array,
+                                amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, fsps_new,
+                                shaping)
 
     return t1_array, t2_array, charge_array, amplitude_array, fwhm_array
 
@@ -1299,13 +1909,14 @@ def make_arrays_s(save_shift, dest_path, array, nhdr, r, fsps_new, shaping):
 # Returns arrays of beginning & end times of spe waveform, charge, amplitude, and fwhm
 def make_arrays_d(save_shift, dest_path, delay_folder, array, nhdr, r, fsps_new, shaping):
     t1_array, t2_array, charge_array, amplitude_array, fwhm_array = initialize_arrays()
+    ledger = read_ledger(dest_path)
 
     for item in array:
         file_name1 = str(save_shift / 'D3--waveforms--%s.txt') % item
         file_name2 = str(dest_path / 'calculations_double' / str(str(int(fsps_new / 1e6)) + '_Msps') / delay_folder /
                          shaping / 'D3--waveforms--%s.txt') % item
 
-        if os.path.isfile(file_name1):
+        if os.path.isfile(file_name1) and check_rejected(ledger, double_id(item, delay_folder, fsps_new)) == 'no':
             # If the calculations were done previously, they are read from a file
             if os.path.isfile(file_name2):
                 print("Reading calculations from file #%s" % item)
@@ -1317,19 +1928,336 @@ def make_arrays_d(save_shift, dest_path, delay_folder, array, nhdr, r, fsps_new,
                 t1, t2, charge, amplitude, fwhm = calculations(t, v, r)             # Calculations are done
                 possibility = check_if_impossible(t1, t2, charge, amplitude, fwhm)
 
-            rt_1_path = Path(dest_path / 'rt_1_double')
-            rt_2_path = Path(dest_path / 'rt_2_double')
-            rt_4_path = Path(dest_path / 'rt_4_double')
-            rt_8_path = Path(dest_path / 'rt_8_double')
-
             t1_array, t2_array, charge_array, amplitude_array, fwhm_array = \
-                create_arrays_d(file_name2, rt_1_path, rt_2_path, rt_4_path, rt_8_path, dest_path, item, t1_array,
-                                t2_array, charge_array, amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm,
-                                possibility, nhdr, fsps_new, delay_folder, shaping)
+                create_arrays_d(file_name2, dest_path, ledger, item, t1_array, t2_array, charge_array,
+                                amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm, possibility, fsps_new,
+                                delay_folder, shaping)
 
     return t1_array, t2_array, charge_array, amplitude_array, fwhm_array
 
 
+# Shapings of double spe waveforms (unshaped, then 2x, 4x, and 8x the rise time)
+double_shapings = ['rt_1', 'rt_2', 'rt_4', 'rt_8']
+
+
+# Returns name of pair manifest file of a delay folder
+def manifest_name(dest_path, delay_folder):
+    return Path(dest_path / str('pairs_' + delay_folder + '.txt'))
+
+
+# Reads pair manifest into dict (pairs is an array of single spe file numbers), or returns None if there is no manifest
+def read_manifest(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    manifest = {}
+    pairs = []
+    for row in csv.reader(myfile):
+        if 'pairs' in manifest:
+            pairs.append([int(row[0]), int(row[1])])
+        else:
+            manifest[row[0]] = row[1]
+    myfile.close()
+    manifest['seed'] = int(manifest['seed'])
+    manifest['delay'] = float(manifest['delay'])
+    manifest['fsps'] = float(manifest['fsps'])
+    manifest['pairs'] = np.array(pairs, dtype=int).reshape(-1, 2)
+    return manifest
+
+
+# Rounds times to 4 digits after the decimal point in scientific notation (the same as float(format(t, '.4e')))
+def round_times(t):
+    t = np.asarray(t, dtype=float)
+    exponent = np.floor(np.log10(np.abs(np.where(t == 0, 1., t))))
+    scale = 10. ** (4 - exponent)
+    return np.round(t * scale) / scale
+
+
+# Zeroes voltages of each row of v_matrix (spe waveforms on rounded time array t) before spe begins and from where spe
+# ends (found as in calculate_t1_t2_add) up to the last point
+# Returns matrix of zeroed waveforms & whether end of spe was found for each row
+def zero_tails(t, v_matrix):
+    v = np.array(v_matrix, dtype=float, ndmin=2)
+    n = v.shape[1]
+    v_min = np.min(v, axis=1)[:, np.newaxis]
+    cols = np.arange(n - 1)[np.newaxis, :]
+    inner = v[:, :n - 1]
+
+    below = inner <= 0.05 * v_min                               # Points past 5% of max
+    idx1 = np.argmax(below, axis=1)                             # Beginning of spe
+    at_min = (inner == v_min) & (cols >= idx1[:, np.newaxis])
+    found = np.any(below, axis=1) & np.any(at_min, axis=1)
+    idx2 = np.argmax(at_min, axis=1)                            # Minimum of spe
+    above = (inner >= 0.05 * v_min) & (cols >= idx2[:, np.newaxis])
+    idx3 = np.argmax(above, axis=1)                             # End of spe
+    valid = ~found | np.any(above, axis=1)
+
+    # Spes without a beginning & minimum are zeroed from t = 0 and from first point, as calculate_t1_t2_add gives 0, -1
+    start = np.where(found, np.searchsorted(t, t[idx1]), np.argmin(np.abs(t)))
+    end = np.where(found, np.searchsorted(t, t[idx3]), np.argmin(np.abs(t + 1)))
+    cols = np.arange(n)[np.newaxis, :]
+    v[(cols < start[:, np.newaxis]) | ((cols >= end[:, np.newaxis]) & (cols < n - 1))] = 0
+
+    return v, valid
+
+
+# Adds rows of v1_matrix & v2_matrix (waveforms on time arrays t1 & t2) with D = int(delay / dt) samples between them
+# The waveform whose time array starts first is delayed (the second one if they start at the same time), and the sum
+# is padded with zeros so both waveforms fit
+# Returns time array & matrix of summed waveforms
+def add_spe_kernel(t1, t2, v1_matrix, v2_matrix, delay):
+    t1 = round_times(t1)
+    t2 = round_times(t2)
+    v1 = np.array(v1_matrix, dtype=float, ndmin=2)
+    v2 = np.array(v2_matrix, dtype=float, ndmin=2)
+    if v1.shape != v2.shape:
+        raise ValueError('Waveforms to add must have the same number of points')
+
+    time_int = float(format(t1[1] - t1[0], '.4e'))
+    delay_amt = int(delay / time_int) * time_int
+    if t1[0] < t2[0]:
+        t1 = t1 + delay_amt
+    else:
+        t2 = t2 + delay_amt
+    k = int(round(abs(t2[0] - t1[0]) / time_int))              # Number of points between starts of waveforms
+
+    n = v1.shape[1]
+    v = np.zeros((v1.shape[0], n + k))
+    if t1[0] <= t2[0]:
+        v[:, :n] += v1
+        v[:, k:] += v2
+        t = np.concatenate((t1, round_times(t1[-1] + time_int * np.arange(1, k + 1))))
+    else:
+        v[:, k:] += v1
+        v[:, :n] += v2
+        t = np.concatenate((round_times(t1[0] - time_int * np.arange(k, 0, -1)), t1))
+
+    return t, v
+
+
+# Adds block of pairs of single spe waveforms (rows of v1_matrix on time array t1 & rows of v2_matrix on time array t2),
+# with second waveform of each pair zeroed outside its spe and both delayed as in add_spe_kernel
+# Returns time array, matrix of double spe waveforms & whether each pair could be added
+def add_spe_pairs(t1, t2, v1_matrix, v2_matrix, delay):
+    v2, valid = zero_tails(round_times(t2), v2_matrix)
+    t_sum, v_sum = add_spe_kernel(t1, t2, v1_matrix, v2, delay)
+
+    return t_sum, v_sum, valid
+
+
+# Puts voltage array through a lowpass filter given a tau and sample rate
+# Filter is the single pole recursion v_filtered[i] = alpha * v[i] + (1 - alpha) * v_filtered[i - 1], starting from
+# v_filtered[0] = v[0], applied along axis of v so a matrix of waveforms can be filtered at once
+# If out is v, filters in place
+def lowpass_filter(v, tau, fsps, axis=-1, out=None):
+    from scipy.signal import lfilter
+    v = np.asarray(v, dtype=float)
+    if out is None:
+        out = np.empty_like(v)
+    if v.shape[axis] == 0:
+        return out
+    alpha = 1 - np.exp(-1. / (fsps * tau))
+    v_moved = np.moveaxis(v, axis, 0)
+    out_moved = np.moveaxis(out, axis, 0)
+    first = v_moved[:1].copy()                  # First sample passes through unchanged
+    rest, zf = lfilter([alpha], [1., alpha - 1], v_moved[1:], axis=0, zi=(1 - alpha) * first)
+    out_moved[0] = first[0]
+    out_moved[1:] = rest
+    return out
+
+
+# Shapes voltage array with n RC lowpass stages (rc), or with a CR highpass stage followed by n RC lowpass stages
+# (crrc), all with the same tau
+def shape_filter(v, tau, fsps, kind='rc', order=1, axis=-1):
+    v = np.asarray(v, dtype=float)
+    if kind == 'crrc':
+        v = v - lowpass_filter(v, tau, fsps, axis)
+    for j in range(order):
+        v = lowpass_filter(v, tau, fsps, axis)
+    return v
+
+
+# Shapes voltage array with each tau in turn, each shaping starting from the last one (before gain), and returns list
+# of shaped voltage arrays
+# Filters are single RC stages unless ladder (levels after the unshaped one) is given
+# method is 'recursive' (filters in time domain), 'fft' (filters in frequency domain), or 'auto' (whichever is faster)
+def shaping_cascade(v, tau_list, fsps, axis=-1, ladder=None, method='auto'):
+    if method == 'auto':
+        method = shaping_engine(v, tau_list, fsps, axis, ladder)
+    if method == 'fft':
+        return shaping_cascade_fft(v, tau_list, fsps, axis, ladder)
+
+    v_list = []
+    for j in range(len(tau_list)):
+        if ladder is None:
+            v = lowpass_filter(v, tau_list[j], fsps, axis)
+        else:
+            v = shape_filter(v, tau_list[j], fsps, ladder[j][2], ladder[j][3], axis)
+        v_list.append(v)
+    return v_list
+
+
+# Returns transfer function of single pole lowpass filter (starting from 0) given z^-1 at each frequency
+def lowpass_response(tau, fsps, z_inv):
+    alpha = 1 - np.exp(-1. / (fsps * tau))
+    return alpha / (1 - (1 - alpha) * z_inv)
+
+
+# Shapes voltage array the same way as shaping_cascade, but transforms it once with FFT, multiplies by transfer function
+# of each shaping in turn, and transforms each shaping back
+# Filters start from first voltage (as lowpass_filter does), so first voltage is taken off before transforming and put
+# back after (except after a CR stage, which starts from 0)
+# Waveform is zero padded until impulse response of every stage has died away (to 1e-13) so it does not wrap around
+def shaping_cascade_fft(v, tau_list, fsps, axis=-1, ladder=None):
+    from scipy import fft
+    if ladder is None:
+        ladder = [('', 0., 'rc', 1)] * len(tau_list)
+    v = np.moveaxis(np.asarray(v, dtype=float), axis, -1)
+    length = v.shape[-1]
+    if length == 0:
+        return [np.moveaxis(v.copy(), -1, axis) for tau in tau_list]
+
+    pad = 0
+    for tau, level in zip(tau_list, ladder):
+        decay = max(np.exp(-1. / (fsps * tau)), 1e-300)         # Impulse response falls by decay each sample
+        pad += (level[3] + (level[2] == 'crrc')) * int(np.ceil(np.log(1e-13) / np.log(decay)))
+    nfft = fft.next_fast_len(length + pad, real=True)
+
+    offset = v[..., :1]
+    spectrum = fft.rfft(v - offset, nfft)
+    z_inv = np.exp(-2j * np.pi * np.arange(nfft // 2 + 1) / nfft)     # z^-1 at each frequency of rfft
+    v_list = []
+    for tau, level in zip(tau_list, ladder):
+        response = lowpass_response(tau, fsps, z_inv)
+        if level[2] == 'crrc':
+            spectrum = spectrum * (1 - response)
+            offset = np.zeros_like(offset)
+        spectrum = spectrum * response ** level[3]
+        v_list.append(np.moveaxis(fft.irfft(spectrum, nfft)[..., :length] + offset, -1, axis))
+    return v_list
+
+
+# Shaping engine found for each trace length, number of waveforms & shapings (used by shaping_cascade with 'auto')
+shaping_engines = {}
+
+
+# Returns faster shaping engine ('recursive' or 'fft') for waveforms like v, timing both the first time they are used
+# for its trace length, number of waveforms & shapings
+def shaping_engine(v, tau_list, fsps, axis=-1, ladder=None):
+    shape = np.shape(v)
+    key = (shape[axis], int(np.prod(shape)) // max(shape[axis], 1), tuple(tau_list), str(ladder))
+    if key not in shaping_engines:
+        times = {}
+        for method in ['recursive', 'fft']:
+            shaping_cascade(v, tau_list, fsps, axis, ladder, method)        # Runs once first so imports are not timed
+            start_time = time.time()
+            for j in range(3):
+                shaping_cascade(v, tau_list, fsps, axis, ladder, method)
+            times[method] = time.time() - start_time
+        shaping_engines[key] = min(times, key=times.get)
+    return shaping_engines[key]
+
+
+# Generates double spe waveforms of the pairs in manifest on demand without writing them, reading each single spe file
+# once; pairs whose single spe waveforms have the same time arrays are added & shaped (with calibration taus & gain
+# factors of 2x, 4x, and 8x shapings) together in blocks of up to block pairs
+# Yields id, time array, and dict of waveform of each shaping in shapings for each pair that can be added
+def virtual_doubles(manifest, single_path, shapings, tau_list, factor_list, nhdr, block=500):
+    levels = [double_shapings.index(shaping) for shaping in shapings]
+    factors = [1.] + list(factor_list)
+    singles = {}
+    time_keys = {}
+    groups = {}
+    for file_1, file_2 in manifest['pairs']:
+        for item in [file_1, file_2]:
+            if item not in singles:
+                t, v, hdr = rw(str(single_path / 'D2--waveforms--%05d.txt') % item, nhdr)
+                singles[item] = (t, v)
+                time_keys[item] = round_times(t).tobytes()
+        # Pairs of missing files or files of different lengths are skipped as in add_spe
+        if len(singles[file_1][1]) == 0 or len(singles[file_1][1]) != len(singles[file_2][1]):
+            print('Could not add pair #%05d--%05d' % (file_1, file_2))
+            continue
+        key = (time_keys[file_1], time_keys[file_2])
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((file_1, file_2))
+
+    for key in groups:
+        pairs = groups[key]
+        t1 = singles[pairs[0][0]][0]
+        t2 = singles[pairs[0][1]][0]
+        for j in range(0, len(pairs), block):
+            block_pairs = pairs[j:j + block]
+            v1_matrix = np.array([singles[file_1][1] for file_1, file_2 in block_pairs])
+            v2_matrix = np.array([singles[file_2][1] for file_1, file_2 in block_pairs])
+            t, v, valid = add_spe_pairs(t1, t2, v1_matrix, v2_matrix, manifest['delay'])
+            v_list = [v] + shaping_cascade(v, tau_list[:max(levels)], manifest['fsps'])
+            for k in range(len(block_pairs)):
+                item = '%05d--%05d' % block_pairs[k]
+                # Spes with no end are skipped as in add_spe
+                if not valid[k]:
+                    print('Could not add pair #%s' % item)
+                    continue
+                yield item, t, dict((shaping, v_list[level][k] * factors[level]) for shaping, level in
+                                    zip(shapings, levels))
+
+
+# Appends calculations of each shaping of a double spe to its arrays in dict of arrays, reading them from calculation
+# files where they exist and otherwise calculating them from downsampled & digitized waveforms of v_dict
+def virtual_calculations_d(arrays, item, t, v_dict, dest_path, ledger, delay_folder, r, fsps, fsps_new, noise):
+    for shaping in double_shapings:
+        calc_file = str(dest_path / 'calculations_double' / str(str(int(fsps_new / 1e6)) + '_Msps') / delay_folder /
+                        shaping / 'D3--waveforms--%s.txt') % item
+
+        if check_rejected(ledger, double_id(item, delay_folder, fsps_new)) == 'no':
+            # If the calculations were done previously, they are read from a file
+            if os.path.isfile(calc_file):
+                print("Reading calculations from file #%s" % item)
+                t1, t2, charge, amplitude, fwhm, possibility = read_calculations(calc_file)
+            # If the calculations were not done yet, they are calculated
+            else:
+                print("Calculating file #%s" % item)
+                t_ds, v_ds = downsample(t, v_dict[shaping], fsps, fsps_new)
+                v_dig = digitize(v_ds, noise)
+                t1, t2, charge, amplitude, fwhm = calculations(t_ds, v_dig, r)
+                possibility = check_if_impossible(t1, t2, charge, amplitude, fwhm)
+
+            t1_array, t2_array, charge_array, amplitude_array, fwhm_array = arrays[shaping]
+            arrays[shaping] = create_arrays_d(calc_file, dest_path, ledger, item, t1_array, t2_array, charge_array,
+                                              amplitude_array, fwhm_array, t1, t2, charge, amplitude, fwhm,
+                                              possibility, fsps_new, delay_folder, shaping)
+
+
+# Calculates beginning & end times of spe waveform, charge, amplitude, and fwhm of each shaping for each double spe of
+# a virtual data set, generating, downsampling, and digitizing waveforms from pair manifest in memory
+# Returns dict of arrays of beginning & end times of spe waveform, charge, amplitude, and fwhm for each shaping
+def make_arrays_d_virtual(manifest, single_path, dest_path, delay_folder, tau_list, factor_list, nhdr, r, fsps,
+                          fsps_new, noise):
+    ledger = read_ledger(dest_path)
+    arrays = {}
+    for shaping in double_shapings:
+        arrays[shaping] = initialize_arrays()
+
+    # Double spes with calculation files for every shaping are read from files, the others are generated again
+    pairs = []
+    for file_1, file_2 in manifest['pairs']:
+        item = '%05d--%05d' % (file_1, file_2)
+        if all(os.path.isfile(str(dest_path / 'calculations_double' / str(str(int(fsps_new / 1e6)) + '_Msps') /
+                                  delay_folder / shaping / 'D3--waveforms--%s.txt') % item)
+               for shaping in double_shapings):
+            virtual_calculations_d(arrays, item, None, None, dest_path, ledger, delay_folder, r, fsps, fsps_new,
+                                   noise)
+        elif check_rejected(ledger, double_id(item, delay_folder, fsps_new)) == 'no':
+            pairs.append([file_1, file_2])
+
+    for item, t, v_dict in virtual_doubles(dict(manifest, pairs=pairs), single_path, double_shapings, tau_list,
+                                           factor_list, nhdr):
+        virtual_calculations_d(arrays, item, t, v_dict, dest_path, ledger, delay_folder, r, fsps, fsps_new, noise)
+
+    return arrays
+
+
 # P3_DOUBLE_STUDIES_2
 
 
@@ -1346,102 +2274,57 @@ def initialize_folders2(date, filter_band):
 
 # Creates p3 double histogram file names
 def initialize_names(hist_single, hist_double, shaping, fsps_new):
-    amp_sing = Path(hist_single / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping + '_single.txt'))
-    charge_sing = Path(hist_single / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping + '_single.txt'))
-    fwhm_sing = Path(hist_single / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping + '_single.txt'))
-
-    amp_doub_no_delay = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                               '_double_no_delay.txt'))
-    amp_doub_05rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_0.5x_rt.txt'))
-    amp_doub_1rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_1x_rt.txt'))
-    amp_doub_15rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_1.5x_rt.txt'))
-    amp_doub_2rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_2x_rt.txt'))
-    amp_doub_25rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_2.5x_rt.txt'))
-    amp_doub_3rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_3x_rt.txt'))
-    amp_doub_35rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_3.5x_rt.txt'))
-    amp_doub_4rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_4x_rt.txt'))
-    amp_doub_45rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_4.5x_rt.txt'))
-    amp_doub_5rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_5x_rt.txt'))
-    amp_doub_55rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_5.5x_rt.txt'))
-    amp_doub_6rt = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                          '_double_6x_rt.txt'))
-    amp_doub_40ns = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_40_ns.txt'))
-    amp_doub_80ns = Path(hist_double / str('amplitude_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_80_ns.txt'))
-
-    charge_doub_no_delay = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                                  '_double_no_delay.txt'))
-    charge_doub_05rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_0.5x_rt.txt'))
-    charge_doub_1rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_1x_rt.txt'))
-    charge_doub_15rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_1.5x_rt.txt'))
-    charge_doub_2rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_2x_rt.txt'))
-    charge_doub_25rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_2.5x_rt.txt'))
-    charge_doub_3rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_3x_rt.txt'))
-    charge_doub_35rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_3.5x_rt.txt'))
-    charge_doub_4rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_4x_rt.txt'))
-    charge_doub_45rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_4.5x_rt.txt'))
-    charge_doub_5rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_5x_rt.txt'))
-    charge_doub_55rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_5.5x_rt.txt'))
-    charge_doub_6rt = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                             '_double_6x_rt.txt'))
-    charge_doub_40ns = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_40_ns.txt'))
-    charge_doub_80ns = Path(hist_double / str('charge_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                              '_double_80_ns.txt'))
-
-    fwhm_doub_no_delay = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                                '_double_no_delay.txt'))
-    fwhm_doub_05rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_0.5x_rt.txt'))
-    fwhm_doub_1rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_1x_rt.txt'))
-    fwhm_doub_15rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_1.5x_rt.txt'))
-    fwhm_doub_2rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_2x_rt.txt'))
-    fwhm_doub_25rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_2.5x_rt.txt'))
-    fwhm_doub_3rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_3x_rt.txt'))
-    fwhm_doub_35rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_3.5x_rt.txt'))
-    fwhm_doub_4rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_4x_rt.txt'))
-    fwhm_doub_45rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_4.5x_rt.txt'))
-    fwhm_doub_5rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_5x_rt.txt'))
-    fwhm_doub_55rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_5.5x_rt.txt'))
-    fwhm_doub_6rt = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                           '_double_6x_rt.txt'))
-    fwhm_doub_40ns = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_40_ns.txt'))
-    fwhm_doub_80ns = Path(hist_double / str('fwhm_' + str(int(fsps_new / 1e6)) + '_Msps_' + shaping +
-                                            '_double_80_ns.txt'))
+    amp_sing = Path(hist_single / str(hist_data_name('amplitude', fsps_new, shaping, '') + '.npy'))
+    charge_sing = Path(hist_single / str(hist_data_name('charge', fsps_new, shaping, '') + '.npy'))
+    fwhm_sing = Path(hist_single / str(hist_data_name('fwhm', fsps_new, shaping, '') + '.npy'))
+
+    amp_doub_no_delay = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, 'no_delay') + '.npy'))
+    amp_doub_05rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '0.5x_rt') + '.npy'))
+    amp_doub_1rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '1x_rt') + '.npy'))
+    amp_doub_15rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '1.5x_rt') + '.npy'))
+    amp_doub_2rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '2x_rt') + '.npy'))
+    amp_doub_25rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '2.5x_rt') + '.npy'))
+    amp_doub_3rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '3x_rt') + '.npy'))
+    amp_doub_35rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '3.5x_rt') + '.npy'))
+    amp_doub_4rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '4x_rt') + '.npy'))
+    amp_doub_45rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '4.5x_rt') + '.npy'))
+    amp_doub_5rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '5x_rt') + '.npy'))
+    amp_doub_55rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '5.5x_rt') + '.npy'))
+    amp_doub_6rt = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '6x_rt') + '.npy'))
+    amp_doub_40ns = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '40_ns') + '.npy'))
+    amp_doub_80ns = Path(hist_double / str(hist_data_name('amplitude', fsps_new, shaping, '80_ns') + '.npy'))
+
+    charge_doub_no_delay = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, 'no_delay') + '.npy'))
+    charge_doub_05rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '0.5x_rt') + '.npy'))
+    charge_doub_1rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '1x_rt') + '.npy'))
+    charge_doub_15rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '1.5x_rt') + '.npy'))
+    charge_doub_2rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '2x_rt') + '.npy'))
+    charge_doub_25rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '2.5x_rt') + '.npy'))
+    charge_doub_3rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '3x_rt') + '.npy'))
+    charge_doub_35rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '3.5x_rt') + '.npy'))
+    charge_doub_4rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '4x_rt') + '.npy'))
+    charge_doub_45rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '4.5x_rt') + '.npy'))
+    charge_doub_5rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '5x_rt') + '.npy'))
+    charge_doub_55rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '5.5x_rt') + '.npy'))
+    charge_doub_6rt = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '6x_rt') + '.npy'))
+    charge_doub_40ns = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '40_ns') + '.npy'))
+    charge_doub_80ns = Path(hist_double / str(hist_data_name('charge', fsps_new, shaping, '80_ns') + '.npy'))
+
+    fwhm_doub_no_delay = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, 'no_delay') + '.npy'))
+    fwhm_doub_05rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '0.5x_rt') + '.npy'))
+    fwhm_doub_1rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '1x_rt') + '.npy'))
+    fwhm_doub_15rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '1.5x_rt') + '.npy'))
+    fwhm_doub_2rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '2x_rt') + '.npy'))
+    fwhm_doub_25rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '2.5x_rt') + '.npy'))
+    fwhm_doub_3rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '3x_rt') + '.npy'))
+    fwhm_doub_35rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '3.5x_rt') + '.npy'))
+    fwhm_doub_4rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '4x_rt') + '.npy'))
+    fwhm_doub_45rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '4.5x_rt') + '.npy'))
+    fwhm_doub_5rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '5x_rt') + '.npy'))
+    fwhm_doub_55rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '5.5x_rt') + '.npy'))
+    fwhm_doub_6rt = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '6x_rt') + '.npy'))
+    fwhm_doub_40ns = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '40_ns') + '.npy'))
+    fwhm_doub_80ns = Path(hist_double / str(hist_data_name('fwhm', fsps_new, shaping, '80_ns') + '.npy'))
 
     return amp_sing, charge_sing, fwhm_sing, amp_doub_no_delay, amp_doub_05rt, amp_doub_1rt, amp_doub_15rt, \
            amp_doub_2rt, amp_doub_25rt, amp_doub_3rt, amp_doub_35rt, amp_doub_4rt, amp_doub_45rt, amp_doub_5rt, \
@@ -1637,6 +2520,7 @@ def false_spes_vs_delay(start, end, factor, parameter, parameter_title, units, f
                         mean15, mean2, mean25, mean3, mean35, mean4, mean45, mean5, mean55, mean6, mean40, mean80,
                         sds, sdno, sd05, sd1, sd15, sd2, sd25, sd3, sd35, sd4, sd45, sd5, sd55, sd6, sd40, sd80,
                         dest_path, shaping):
+    import matplotlib.pyplot as plt
     cutoff_array = np.array([])
     spes_as_mpes_array = np.array([])
     mpes_as_spes_array = np.array([])
@@ -1757,6 +2641,7 @@ def false_spes_vs_delay(start, end, factor, parameter, parameter_title, units, f
 # Creates plots of false SPE & MPE rate vs cutoff
 def false_spes_mpes(start, end, factor, parameter, parameter_title, units, means, meand, sds, sdd, fsps_new, dest_path,
                     shaping):
+    import matplotlib.pyplot as plt
     cutoff_array = np.array([])
     spes_as_mpes_array = np.array([])
     mpes_as_spes_array = np.array([])
@@ -1922,11 +2807,14 @@ def sort(amp, charge, fwhm, amp_cut, charge_cut, fwhm_cut):
 
 def sort_single(amp_cut, charge_cut, fwhm_cut, calc_path, fsps_new, shaping):
     folder_name = Path(calc_path / str(str(int(fsps_new / 1e6)) + '_Msps') / shaping)
+    ledger = read_ledger(Path(calc_path).parent)
     spes_as_spes = 0
     spes_as_mpes = 0
     i = 0
 
     for item in os.listdir(folder_name):
+        if check_rejected(ledger, single_id(int(item[15:20]), fsps_new)) == 'yes':
+            continue
         i += 1
         filename = folder_name / item
         t1, t2, charge, amplitude, fwhm = read_calc(filename)
@@ -1947,11 +2835,14 @@ def sort_single(amp_cut, charge_cut, fwhm_cut, calc_path, fsps_new, shaping):
 
 def sort_double(amp_cut, charge_cut, fwhm_cut, calc_path, fsps_new, delay_folder, shaping):
     folder_name = Path(calc_path / str(str(int(fsps_new / 1e6)) + '_Msps') / delay_folder / shaping)
+    ledger = read_ledger(Path(calc_path).parent)
     mpes_as_mpes = 0
     mpes_as_spes = 0
     i = 0
 
     for item in os.listdir(folder_name):
+        if check_rejected(ledger, double_id(item[15:27], delay_folder, fsps_new)) == 'yes':
+            continue
         i += 1
         filename = folder_name / item
         t1, t2, charge, amplitude, fwhm = read_calc(filename)
@@ -3,27 +3,37 @@ from p3_functions import *
 
 # Downsamples and digitizes spe waveforms
 def p3(start, end, date, date_time, filter_band, nhdr, fsps, r, pmt_hv, gain, offset, trig_delay, amp, band, nfilter,
-       fsps_new, noise):
+       fsps_new, noise, nworkers=1, align='subsample', dpi=360, no_plots=False):
     gen_path, save_path, data_path, dest_path, filt_path1, filt_path2, filt_path4, filt_path8 = \
         initialize_folders(date, filter_band)
     make_folders(dest_path, filt_path1, filt_path2, filt_path4, filt_path8, fsps_new)
 
-    # Copies waveforms with 1x, 2x, 4x, and 8x initial rise times to d3 folder
+    # Keeps calibration of shapings from p2 with d3 waveforms
+    copy_calibration(data_path, dest_path)
+
+    # Copies waveforms with 1x, 2x, 4x, and 8x initial rise times to d3 folder (except waveforms rejected in p2)
+    ledger = read_ledger(data_path)
     for i in range(start, end + 1):
-        transfer_files(data_path, filt_path1, filt_path2, filt_path4, filt_path8, i, nhdr)
+        if check_rejected(ledger, '%05d' % i) == 'no':
+            transfer_files(data_path, filt_path1, filt_path2, filt_path4, filt_path8, i, nhdr)
 
     # Downsamples and digitizes waveforms
     down_dig(filt_path1, filt_path2, filt_path4, filt_path8, fsps, fsps_new, noise, start, end, nhdr)
 
     # Plots and saves average waveforms
-    average_waveform(start, end, dest_path, 'rt_1', 'No Shaping', nhdr, fsps_new)
-    average_waveform(start, end, dest_path, 'rt_2', '2x Rise Time Shaping', nhdr, fsps_new)
-    average_waveform(start, end, dest_path, 'rt_4', '4x Rise Time Shaping', nhdr, fsps_new)
-    average_waveform(start, end, dest_path, 'rt_8', '8x Rise Time Shaping', nhdr, fsps_new)
+    average_waveforms(start, end, dest_path, ['rt_1', 'rt_2', 'rt_4', 'rt_8'],
+                      ['No Shaping', '2x Rise Time Shaping', '4x Rise Time Shaping', '8x Rise Time Shaping'], nhdr,
+                      fsps_new, nworkers, align)
 
     # Writes info file
     info_file(date_time, data_path, dest_path, pmt_hv, gain, offset, trig_delay, amp, fsps, band, nfilter, r)
 
+    # Renders plots after statistics have been saved
+    if no_plots:
+        clear_plots()
+    else:
+        render_plots(dpi, nworkers)
+
 
 if __name__ == '__main__':
     import argparse
@@ -46,6 +56,12 @@ if __name__ == '__main__':
     parser.add_argument("--fsps_new", type=float, help='new samples per second (Hz) (suggested=500000000.)')
     parser.add_argument("--noise", type=float, help='noise to add (bits) (suggested=3.30)')
     parser.add_argument("--info_file", type=str, help='path to d2 info file')
+    parser.add_argument("--dpi", type=int, help='resolution of plots (default=360)', default=360)
+    parser.add_argument("--no_plots", action='store_true', help='do not render plots')
+    parser.add_argument("--cores", type=int, help='number of processes for averaging waveforms (default=1)', default=1)
+    parser.add_argument("--align", type=str, help='align waveforms to nearest point ("sample") or by interpolating '
+                                                  'between points ("subsample") when averaging (default=subsample)',
+                        default='subsample')
     args = parser.parse_args()
 
     if not args.info_file:
@@ -56,7 +72,7 @@ if __name__ == '__main__':
         else:
             p3(args.start, args.end, args.date, args.date_time, args.fil_band, args.nhdr, args.fsps, args.r,
                args.pmt_hv, args.gain, args.offset, args.trig_delay, args.amp, args.band, args.nfilter, args.fsps_new,
-                args.noise)
+                args.noise, args.cores, args.align, args.dpi, args.no_plots)
     elif not (args.fsps_new or args.noise):
         print('Error: Must provide new fsps and noise level')
     else:
@@ -82,6 +98,7 @@ if __name__ == '__main__':
         i_date = int(i_date)
 
         p3(args.start, args.end, i_date, i_date_time, i_fil_band, args.nhdr, i_fsps, i_r, i_pmt_hv, i_gain, i_offset,
-           i_trig_delay, i_amp, i_band, i_nfilter, args.fsps_new, args.noise)
+           i_trig_delay, i_amp, i_band, i_nfilter, args.fsps_new, args.noise, args.cores,
+           args.align, args.dpi, args.no_plots)
 
         myfile.close()
\ No newline at end of file
@@ -2,8 +2,8 @@ import os
 import csv
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
+from multiprocessing import Pool
 import random
 
 # FILE READING/WRITING
@@ -95,72 +95,383 @@ def read_info(myfile):
         i_amp, i_band, i_nfilter
 
 
-# AVERAGE/PLOT WAVEFORM
+# Writes calibration file (dict of name & value rows, e.g. md5 checksum of average waveform template, taus & gain
+# factors of shapings)
+def write_calibration(file_name, calibration):
+    myfile = open(file_name, 'w', newline='')
+    csv_writer = csv.writer(myfile)
+    for name in calibration:
+        csv_writer.writerow([name, calibration[name]])
+    myfile.close()
 
 
-# Calculates average waveform of spe
-def average_waveform(start, end, dest_path, shaping, shaping_name, nhdr, fsps_new):
-    data_file = Path(Path(dest_path / (str(shaping + '_single')) / str('digitized_' + str(int(fsps_new / 1e6)) +
-                                                                       '_Msps')))
-    save_file = Path(dest_path / 'plots')
-    tsum = 0
-    vsum = 0
-    n = 0
+# Reads calibration file into dict (values are strings), or returns None if there is no calibration file
+def read_calibration(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    myfile = open(file_name, 'r', newline='')
+    calibration = {}
+    for row in csv.reader(myfile):
+        calibration[row[0]] = row[1]
+    myfile.close()
+    return calibration
+
+
+# Reads calibration file of d2 (taus & gain factors of shapings made by p2) and copies it to d3, warning if d3 already
+# has waveforms shaped with a calibration from a different average waveform
+# Returns calibration dict, or None if d2 has no calibration file
+def copy_calibration(data_path, dest_path):
+    calibration = read_calibration(Path(data_path / 'calibration.txt'))
+    if calibration is None:
+        print('No calibration file in d2')
+        return None
+    old_calibration = read_calibration(Path(dest_path / 'calibration.txt'))
+    if old_calibration is not None and old_calibration.get('template_md5') != calibration.get('template_md5'):
+        print('Warning: d3 has waveforms shaped with a different calibration (rerun p3 on all waveforms)')
+    write_calibration(Path(dest_path / 'calibration.txt'), calibration)
+    print('Shaping taus (s): ' + ', '.join(['rt_' + name[4:] + ' ' + calibration[name] for name in calibration
+                                             if name.startswith('tau_') and name != 'tau_1']))
+    return calibration
+
+
+# LEDGER
+
+
+# Reads ledger of waveform labels
+# Returns dictionary of waveform id: (status, reason, stage)
+def read_ledger(dest_path):
+    ledger = {}
+    file_name = Path(dest_path) / 'ledger.txt'
+    if os.path.isfile(file_name):
+        myfile = open(file_name, 'r')
+        for row in csv.reader(myfile):          # Later labels of a waveform replace earlier ones
+            ledger[row[0]] = (row[1], row[2], row[3])
+        myfile.close()
+
+    return ledger
+
+
+# Checks if a waveform has been rejected
+def check_rejected(ledger, waveform_id):
+    if str(waveform_id) in ledger and ledger[str(waveform_id)][0] == 'rejected':
+        return 'yes'
+    else:
+        return 'no'
+
+
+# PLOTTING
+
+
+plot_queue = []         # Plots waiting to be rendered by render_plots
+
+
+# Adds a plot to plot queue (kind is 'waveform', and data holds what is needed to draw it)
+def queue_plot(kind, file_name, data):
+    plot_queue.append((kind, str(file_name), data))
+
+
+# Draws a queued plot with the non-interactive Agg backend and saves it
+def draw_plot(kind, file_name, data, dpi):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    if kind == 'waveform':
+        plt.plot(data['t'], data['v'])
+        plt.fill_between(data['t'], data['v_low'], data['v_high'], alpha=0.3)     # Plots band with 68% of waveforms
+        plt.xlabel('Time (s)')
+        plt.ylabel('Normalized Voltage')
+        plt.title(data['title'])
+    plt.savefig(file_name, dpi=dpi)
+    plt.close()
+
 
+# Renders queued plots in nworkers processes and empties plot queue
+def render_plots(dpi=360, nworkers=1):
+    plots = [(kind, file_name, data, dpi) for kind, file_name, data in plot_queue]
+    del plot_queue[:]
+    print('Rendering %d plots' % len(plots))
+    if nworkers > 1 and len(plots) > 1:
+        pool = Pool(min(nworkers, len(plots)))
+        pool.starmap(draw_plot, plots)
+        pool.close()
+        pool.join()
+    else:
+        for plot in plots:
+            draw_plot(*plot)
+
+
+# Empties plot queue without rendering (for runs with no plots)
+def clear_plots():
+    del plot_queue[:]
+
+
+# WAVEFORM ACCUMULATOR
+
+
+# Creates accumulator for mean & variance of waveforms (Welford's method) that also keeps a random sample of up to keep
+# waveforms for percentile bands
+def init_accumulator(keep=500):
+    accumulator = {'n': 0, 'mean': None, 'm2': None, 'keep': keep, 'reservoir': None, 'n_res': 0}
+    return accumulator
+
+
+# Adds a waveform (1-D array) or block of waveforms (2-D array, one waveform per row) to accumulator, sampling its
+# reservoir with random generator rng (a new one if rng is None)
+def update_accumulator(accumulator, v, rng=None):
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    n_b = len(v)
+    if n_b == 0:
+        return accumulator
+    if accumulator['mean'] is None:
+        accumulator['mean'] = np.zeros(v.shape[1])
+        accumulator['m2'] = np.zeros(v.shape[1])
+        accumulator['reservoir'] = np.zeros((accumulator['keep'], v.shape[1]))
+
+    # Combines mean & sum of squared differences of block with those of accumulator (Chan et al.)
+    mean_b = np.mean(v, axis=0)
+    m2_b = np.sum((v - mean_b) ** 2, axis=0)
+    n_a = accumulator['n']
+    n = n_a + n_b
+    delta = mean_b - accumulator['mean']
+    accumulator['mean'] = accumulator['mean'] + delta * n_b / n
+    accumulator['m2'] = accumulator['m2'] + m2_b + delta ** 2 * n_a * n_b / n
+    accumulator['n'] = n
+
+    # Keeps each waveform in reservoir with probability keep / n
+    rng = np.random.default_rng(rng)
+    for j in range(n_b):
+        if accumulator['n_res'] < accumulator['keep']:
+            accumulator['reservoir'][accumulator['n_res']] = v[j]
+            accumulator['n_res'] += 1
+        else:
+            k = rng.integers(0, n_a + j + 1)
+            if k < accumulator['keep']:
+                accumulator['reservoir'][k] = v[j]
+
+    return accumulator
+
+
+# Adds each waveform from an iterable of waveforms (list of arrays, generator, or 2-D array) to accumulator
+def accumulate_waveforms(accumulator, waveforms, rng=None):
+    rng = np.random.default_rng(rng)
+    for v in waveforms:
+        update_accumulator(accumulator, v, rng)
+    return accumulator
+
+
+# Combines two accumulators (e.g. from different workers) into a new accumulator, sampling its reservoir with random
+# generator rng (a new one if rng is None)
+def merge_accumulators(acc_a, acc_b, rng=None):
+    if acc_a['n'] == 0:
+        return acc_b
+    if acc_b['n'] == 0:
+        return acc_a
+    accumulator = init_accumulator(max(acc_a['keep'], acc_b['keep']))
+    n = acc_a['n'] + acc_b['n']
+    delta = acc_b['mean'] - acc_a['mean']
+    accumulator['n'] = n
+    accumulator['mean'] = acc_a['mean'] + delta * acc_b['n'] / n
+    accumulator['m2'] = acc_a['m2'] + acc_b['m2'] + delta ** 2 * acc_a['n'] * acc_b['n'] / n
+
+    # Combines reservoirs, choosing waveforms from each in proportion to number of waveforms each reservoir stands for
+    res = np.concatenate((acc_a['reservoir'][:acc_a['n_res']], acc_b['reservoir'][:acc_b['n_res']]))
+    weights = np.concatenate((np.full(acc_a['n_res'], acc_a['n'] / acc_a['n_res']),
+                              np.full(acc_b['n_res'], acc_b['n'] / acc_b['n_res'])))
+    n_res = min(accumulator['keep'], len(res))
+    idx = np.random.default_rng(rng).choice(len(res), n_res, replace=False, p=weights / np.sum(weights))
+    accumulator['reservoir'] = np.zeros((accumulator['keep'], res.shape[1]))
+    accumulator['reservoir'][:n_res] = res[idx]
+    accumulator['n_res'] = n_res
+
+    return accumulator
+
+
+# Returns mean, standard deviation, and lower & upper percentile bands of waveforms in accumulator
+def accumulator_stats(accumulator, low=15.87, high=84.13):
+    n = accumulator['n']
+    if n == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    mean = accumulator['mean']
+    if n > 1:
+        sd = np.sqrt(accumulator['m2'] / (n - 1))
+    else:
+        sd = np.zeros(len(mean))
+    res = accumulator['reservoir'][:accumulator['n_res']]
+    band_low = np.percentile(res, low, axis=0)
+    band_high = np.percentile(res, high, axis=0)
+
+    return mean, sd, band_low, band_high
+
+
+# AVERAGE/PLOT WAVEFORM
+
+
+# Returns index where averaging window of a waveform starts and fraction of a point from that index to the start of the
+# window (after downsampling, t = 0 usually falls between points), or -1 if waveform does not have n_before points
+# before t = 0 and length points in total
+# If align is 'sample', window starts at nearest point instead
+def window_position(t0, dt, n_before, length, array_length, align):
+    x_start = -t0 / dt - n_before                   # Finds position of start of window in points
+    idx_start = int(round(x_start))
+    if idx_start < 0 or idx_start + length > array_length - 1:
+        return -1, 0.
+    frac = 0.
+    if align == 'subsample':
+        frac = x_start - idx_start
+        if frac < 0 and idx_start > 0:              # Interpolates from point before nearest point
+            idx_start -= 1
+            frac += 1
+        elif frac < 0:                              # No point before first point, so uses nearest point
+            frac = 0.
+    return idx_start, frac
+
+
+# Shifts each waveform in a block (one waveform per row, with one extra point at the end) by a fraction of a point
+# using linear interpolation
+def shift_block(block, fracs):
+    return block[:, :-1] + fracs[:, np.newaxis] * (block[:, 1:] - block[:, :-1])
+
+
+# Chooses averaging window from a waveform file
+# Returns number of points before t = 0, number of points in window, and time step
+def average_window(file_name, nhdr):
+    t, v, hdr = rw(file_name, nhdr)
+    array_length = len(t)
+    dt = (t[-1] - t[0]) / (array_length - 1)
+    # Window of points before t = 0 & after the spe
+    n_before = array_length - int(0.87 * array_length)
+    length = int(0.99 * array_length)
+    return n_before, length, dt
+
+
+# Reads a shard of waveform files and adds each aligned, normalized waveform to the accumulator of its group
+# jobs is a list of (group, file name) and windows holds number of points before t = 0 & window length of each group
+# Returns dictionary of accumulator for each group (reservoirs are sampled with a random generator seeded from seed)
+def average_shard(jobs, nhdr, windows, align='subsample', seed=None):
+    rng = np.random.default_rng(seed)
+    accs = {}
+    blocks = {}                                     # Preallocated blocks of waveform windows (with one extra point)
+    fracs = {}                                      # Fractions of a point to shift each waveform in blocks
+    ks = {}
+
+    for group, file_name in jobs:
+        n_before, length = windows[group]
+        if group not in accs:
+            accs[group] = init_accumulator()
+            blocks[group] = np.empty((500, length + 1))
+            fracs[group] = np.zeros(500)
+            ks[group] = 0
+        print('Reading file', Path(file_name).name)
+        t, v, hdr = rw(file_name, nhdr)             # Reads a waveform file
+        array_length = len(t)
+        dt = (t[-1] - t[0]) / (array_length - 1)
+        idx_start, frac = window_position(t[0], dt, n_before, length, array_length, align)
+        # Only averages waveform files that have enough points before t = 0 & after the spe
+        if idx_start >= 0:
+            k = ks[group]
+            blocks[group][k] = v[idx_start:idx_start + length + 1]
+            blocks[group][k] /= min(v)              # Normalizes voltages
+            fracs[group][k] = frac
+            ks[group] = k + 1
+            if ks[group] == len(blocks[group]):     # Aligns & adds full block of waveforms to accumulator
+                update_accumulator(accs[group], shift_block(blocks[group], fracs[group]), rng)
+                ks[group] = 0
+    for group in accs:
+        k = ks[group]
+        update_accumulator(accs[group], shift_block(blocks[group][:k], fracs[group][:k]), rng)
+
+    return accs
+
+
+# Averages waveform files of every group in one pass, splitting them into one shard per worker process and merging the
+# accumulators at the end (jobs is a list of (group, file name))
+# Returns dictionaries of accumulator and time array of average waveform for each group
+def average_files(jobs, nhdr, nworkers=1, align='subsample'):
+    windows = {}
+    times = {}
+    for group, file_name in jobs:                   # Chooses window of each group from its first file
+        if group not in windows:
+            n_before, length, dt = average_window(file_name, nhdr)
+            windows[group] = (n_before, length)
+            times[group] = (np.arange(length) - n_before) * dt
+
+    if nworkers > 1 and len(jobs) > nworkers:
+        seeds = np.random.SeedSequence().spawn(nworkers)        # Independent random streams of worker processes
+        shards = [(jobs[j * len(jobs) // nworkers:(j + 1) * len(jobs) // nworkers], nhdr, windows, align, seeds[j])
+                  for j in range(nworkers)]
+        pool = Pool(nworkers)
+        shard_accs = pool.starmap(average_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        shard_accs = [average_shard(jobs, nhdr, windows, align)]
+
+    accs = {}
+    for group in windows:
+        accs[group] = init_accumulator()
+        for shard_acc in shard_accs:
+            if group in shard_acc:
+                accs[group] = merge_accumulators(accs[group], shard_acc[group])
+
+    return accs, times
+
+
+# Calculates average waveform of spe for each shaping, reading the waveform files of every shaping in one pass
+def average_waveforms(start, end, dest_path, shapings, shaping_names, nhdr, fsps_new, nworkers=1,
+                      align='subsample'):
+    data_files = {}
+    folder_files = {}
+    for shaping in shapings:
+        data_files[shaping] = Path(dest_path / str(shaping + '_single') / str('digitized_' + str(int(fsps_new / 1e6)) +
+                                                                              '_Msps'))
+        folder_files[shaping] = set(os.listdir(data_files[shaping]))
+
+    jobs = []
     for i in range(start, end + 1):
         file_name = 'D3--waveforms--%05d.txt' % i
-        if os.path.isfile(data_file / file_name):
-            print('Reading file #', i)
-            t, v, hdr = rw(data_file / file_name, nhdr)     # Reads a waveform file
-            array_length = len(t)
-            v = v / min(v)                                  # Normalizes voltages
-            idx = np.where(t == 0)                          # Finds index of t = 0 point
-            idx = int(idx[0])
-            t = np.roll(t, -idx)                            # Rolls time array so that t = 0 point is at index 0
-            v = np.roll(v, -idx)                            # Rolls voltage array so that 50% max point is at index 0
-            idx2 = np.where(t == min(t))                    # Finds index of point of minimum t
-            idx2 = int(idx2[0])
-            idx3 = np.where(t == max(t))                    # Finds index of point of maximum t
-            idx3 = int(idx3[0])
-            # Only averages waveform files that have enough points before t = 0 & after the spe
-            if idx2 <= int(0.87 * array_length):
-                # Removes points between point of maximum t & chosen minimum t in time & voltage arrays
-                t = np.concatenate((t[:idx3], t[int(0.87 * array_length):]))
-                v = np.concatenate((v[:idx3], v[int(0.87 * array_length):]))
-                # Rolls time & voltage arrays so that point of chosen minimum t is at index 0
-                t = np.roll(t, -idx3)
-                v = np.roll(v, -idx3)
-                if len(t) >= int(0.99 * array_length):
-                    # Removes points after chosen point of maximum t in time & voltage arrays
-                    t = t[:int(0.99 * array_length)]
-                    v = v[:int(0.99 * array_length)]
-                    # Sums time & voltage arrays
-                    tsum += t
-                    vsum += v
-                    n += 1
-    # Finds average time & voltage arrays
-    t_avg = tsum / n
-    v_avg = vsum / n
-
-    # Plots average waveform & saves image
-    plt.plot(t_avg, v_avg)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Normalized Voltage')
-    plt.title('Average Waveform (' + shaping_name + ', ' + str(int(fsps_new / 1e6)) + ' Msps' + ')')
-    plt.savefig(save_file / str('avg_waveform_single_' + str(int(fsps_new / 1e6)) + ' Msps_' + shaping + '.png'),
-                dpi=360)
+        for shaping in shapings:
+            if file_name in folder_files[shaping]:
+                jobs.append((shaping, str(data_files[shaping] / file_name)))
+
+    # Reads and averages waveforms in nworkers processes, shifting each by a fraction of a point so that t = 0 lines up
+    accs, times = average_files(jobs, nhdr, nworkers, align)
+
+    for shaping, shaping_name in zip(shapings, shaping_names):
+        if shaping in accs and accs[shaping]['n'] > 0:
+            save_average(accs[shaping], times[shaping], dest_path, shaping, shaping_name, fsps_new)
+        else:
+            print('No ' + shaping + ' waveforms to average')
+
+
+# Calculates average waveform of spe for one shaping
+def average_waveform(start, end, dest_path, shaping, shaping_name, nhdr, fsps_new, nworkers=1,
+                     align='subsample'):
+    average_waveforms(start, end, dest_path, [shaping], [shaping_name], nhdr, fsps_new, nworkers, align)
+
+
+# Plots and saves average waveform & standard deviation of waveforms for a shaping
+def save_average(acc, t_avg, dest_path, shaping, shaping_name, fsps_new):
+    save_file = Path(dest_path / 'plots')
+
+    # Finds average voltage array and standard deviation & 68% band of voltage arrays
+    v_avg, v_sd, v_low, v_high = accumulator_stats(acc)
 
     # Saves average waveform data
     file_name = dest_path / 'hist_data_single' / str('avg_waveform_' + str(int(fsps_new / 1e6)) + ' Msps_' + shaping +
                                                      '.txt')
     hdr = 'Average Waveform\n\n\n\nTime,Ampl'
     ww(t_avg, v_avg, file_name, hdr)
+    ww(t_avg, v_sd, str(file_name)[:-4] + '_sd.txt', 'Waveform Standard Deviation\n\n\n\nTime,Ampl')
 
-    plt.close()
+    # Queues average waveform & 68% band to be plotted
+    queue_plot('waveform', save_file / str('avg_waveform_single_' + str(int(fsps_new / 1e6)) + ' Msps_' + shaping +
+                                           '.png'),
+               {'t': t_avg, 'v': v_avg, 'v_low': v_low, 'v_high': v_high,
+                'title': 'Average Waveform (' + shaping_name + ', ' + str(int(fsps_new / 1e6)) + ' Msps' + ')'})
 
 
 # Shows a waveform plot to user
 def show_waveform(file_name, version):
+    import matplotlib.pyplot as plt
     t, v, hdr = rw(file_name, 5)
     print("\nHeader:\n\n" + str(hdr))
     plt.plot(t, v)
@@ -0,0 +1,74 @@
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+# Stage folders & scripts in each
+stages = [('p1_single', 'p1_functions', ['p1.py', 'p1b.py', 'plot_waveform.py']),
+          ('p2_single', 'p2_functions', ['p2.py', 'plot_waveform.py']),
+          ('p2_double', 'p2_functions', ['p2_create_double.py', 'plot_waveform.py']),
+          ('p3_single', 'p3_functions', ['p3.py', 'plot_waveform.py']),
+          ('p3_double', 'p3_functions', ['p3_double_studies.py', 'p3_double_studies2.py', 'p3_double_studies3.py',
+                                         'plot_waveform.py'])]
+
+# Heavy modules that should only be imported once they are used
+heavy_modules = ['matplotlib.pyplot', 'scipy.optimize', 'scipy.stats', 'scipy.signal']
+
+
+# Runs command in folder and returns wall time (s) & output
+def run_timed(command, folder):
+    start_time = time.time()
+    result = subprocess.run(command, cwd=str(folder), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(' '.join(command) + ' failed:\n' + result.stderr)
+    return time.time() - start_time, result.stdout
+
+
+# Times importing functions module in a new interpreter and returns import time (s) & heavy modules it loaded
+def import_time(folder, module):
+    code = 'import sys, time\n' \
+           'start_time = time.time()\n' \
+           'import ' + module + '\n' \
+           'print(time.time() - start_time)\n' \
+           'print(",".join(name for name in ' + repr(heavy_modules) + ' if name in sys.modules))'
+    wall_time, output = run_timed([sys.executable, '-c', code], folder)
+    lines = output.strip().split('\n') + ['']
+    loaded = [name for name in lines[1].split(',') if name != '']
+    return float(lines[0]), loaded
+
+
+# Times each functions module import & each script's --help, taking the fastest of nrep runs
+def benchmark(root, nrep, limit):
+    slow = 0
+    for folder, module, scripts in stages:
+        path = root / folder
+        if not path.is_dir():
+            continue
+        results = [import_time(path, module) for j in range(nrep)]
+        loaded = results[0][1]
+        print('%s/%s: import %.3f s%s' % (folder, module, min(result[0] for result in results),
+                                          ('' if len(loaded) == 0 else ' (loads ' + ', '.join(loaded) + ')')))
+        if len(loaded) > 0:
+            slow += 1
+        for script in scripts:
+            if not (path / script).is_file():
+                continue
+            script_time = min(run_timed([sys.executable, script, '--help'], path)[0] for j in range(nrep))
+            print('    %s --help: %.3f s' % (script, script_time))
+            if script_time > limit:
+                slow += 1
+    return slow
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog="startup_benchmark", description="Times startup of stage scripts")
+    parser.add_argument("--nrep", type=int, help='number of times to start each script (default=3)', default=3)
+    parser.add_argument("--limit", type=float, help='max startup time of a script (s) (default=1.)', default=1.)
+    args = parser.parse_args()
+
+    n_slow = benchmark(Path(__file__).resolve().parent, args.nrep, args.limit)
+    if n_slow > 0:
+        print('%d slow imports or scripts' % n_slow)
+        sys.exit(1)